@@ -1,130 +1,116 @@
 import asyncio
 import time
-from bleak import BleakScanner, BleakClient
-import numpy as np
-import sounddevice as sd
-import logging,os
-
+from nelrx.pipeline import Pipeline, DROP_OLDEST
+from nelrx.conceal import ConcealingDecoder, FADE
+from nelrx.supervisor import LinkSupervisor
+from nelrx.linktune import negotiate, size_buffers, tune
+from nelrx.sinks import JitterSpeakerSink
+from nelrx.metrics import LogExporter, MetricsRegistry, MetricsReporter, ReceiverMetrics, TIME_EVERY
+
+# (bleak のログを見るときは logging と os を import して有効にする)
 # os.environ["BLEAK_LOG_LEVEL"] = "DEBUG"
 # logging.basicConfig(level=logging.DEBUG)
 
-# --------- ADPCM デコード処理 ---------
-step_table = np.array([
-    7, 8, 9, 10, 11, 12, 13, 14, 16, 17,
-    19, 21, 23, 25, 28, 31, 34, 37, 41, 45,
-    50, 55, 60, 66, 73, 80, 88, 97, 107, 118,
-    130, 143, 157, 173, 190, 209, 230, 253, 279, 307,
-    337, 371, 408, 449, 494, 544, 598, 658, 724, 796,
-    876, 963, 1060, 1166, 1282, 1411, 1552, 1707, 1878, 2066,
-    2272, 2499, 2749, 3024, 3327, 3660, 4026, 4428, 4871, 5358,
-    5894, 6484, 7132, 7845, 8630, 9493, 10442, 11487, 12635, 13899,
-    15289, 16818, 18500, 20350, 22385, 24623, 27086, 29794, 32767
-], dtype=np.int32)
-
-index_table = np.array([
-    -1, -1, -1, -1, 2, 4, 6, 8,
-    -1, -1, -1, -1, 2, 4, 6, 8
-], dtype=np.int8)
-
-predictor = 0
-step_index = 0
-
-def ima_adpcm_decode(adpcm_bytes: bytearray) -> np.ndarray:
-    """ADPCM データを PCM にデコードして返す。"""
-    global predictor, step_index
-    output = []
-    for byte in adpcm_bytes:
-        for shift in (0, 4):
-            nibble = (byte >> shift) & 0x0F
-            step = step_table[step_index]
-            diffq = step >> 3
-            if nibble & 4: diffq += step
-            if nibble & 2: diffq += step >> 1
-            if nibble & 1: diffq += step >> 2
-            if nibble & 8:
-                predictor -= diffq
-            else:
-                predictor += diffq
-
-            predictor = max(-32768, min(32767, predictor))
-            output.append(predictor)
-
-            step_index += index_table[nibble]
-            step_index = max(0, min(88, step_index))
-
-    return np.array(output, dtype=np.int16)
-
-def reset_decoder(pred, step):
-    global predictor, step_index
-    predictor = np.int32(pred)         # 32 bit に合わせる
-    step_index = int(step)
-
 # BLE UART Service UUIDs
 UART_SERVICE_UUID = "6E400001-B5A3-F393-E0A9-E50E24DCCA9E"
 UART_TX_CHAR_UUID = "6E400003-B5A3-F393-E0A9-E50E24DCCA9E"
 
-# ★ ここで計測用のカウンタを用意
-byte_cnt = 0
-last_print = time.time()
+# ★ 計測用のカウンタ (Notify ごとには足すだけ。表示は 1 秒ごとに別のタスクで)
+registry = MetricsRegistry()
+metrics = ReceiverMetrics(registry)
+# 1 秒ごとに出す項目 (Prometheus で見るなら PrometheusExporter(registry, 9464) も足す)
+SHOWN = ("nelrx_rx_bytes_total", "nelrx_rx_packets_total", "nelrx_queue_depth",
+         "nelrx_queue_dropped_total", "nelrx_seq_lost_total", "nelrx_seq_reordered_total",
+         "nelrx_audio_buffer_seconds", "nelrx_audio_latency_seconds",
+         "nelrx_audio_underruns_total", "nelrx_reconnects_total", "nelrx_decode_seconds")
 
 async def main():
-    # BLE デバイス探索
-    print("Scanning for BLE device named 'CatVoiceStreamer'...")
-    devices = await BleakScanner.discover(timeout=5.0)
-    target = next((d for d in devices if d.name and 'CatVoiceStreamer' in d.name), None)
-    if not target:
-        print("対象デバイスが見つかりませんでした。")
-        return
-    print(f"Found target device: {target.name} ({target.address})")
-    
-    # 接続
-    print(f"Connecting to {target.address}...")
-    async with BleakClient(target) as client:
-        # 接続完了
-        print(f"Connected to {target.address}")
-        # MTU 要求 (150)
-        # try:
-        #     mtu = await client.request_mtu(100)
-        #     print(f"MTU negotiated: {mtu}")
-        # except Exception as e:
-        #     print(f" MTU request failed or not supported: {e}")
-        # try:
-        #     await client.request_phy(2)
-        #     print("PHY updated to 2Mbps (if supported)")
-        # except Exception as e:
-        #     print(f"PHY request failed or not supported: {e}")
-        #     pass
-
-        # 音声再生ストリーム
-        fs = 8000
-        with sd.OutputStream(samplerate=fs, channels=1, dtype='int16') as stream:
-            # 通知ハンドラ
-            def handle_notify(_, data: bytearray):
-                global byte_cnt, last_print
-
-                seq        = data[0]
-                pred       = int.from_bytes(data[1:3], 'little', signed=True)
-                step       = data[3]
-                audio_data = memoryview(data)[4:]   # ヘッダ以降をスライス
-
-                reset_decoder(pred, step)           # ★ 状態をヘッダで上書き
-
-                byte_cnt += len(data)
-                now = time.time()
-                if now - last_print >= 1.0:
-                    print(f"RX {byte_cnt} B/s, packet size={len(data)} B, last seq={seq}")
-                    byte_cnt = 0
-                    last_print = now
-
-                pcm = ima_adpcm_decode(audio_data)
-                stream.write(pcm)
-
-
-            # Notify 開始
-            await client.start_notify(UART_TX_CHAR_UUID, handle_notify)
+    # デコーダ状態は接続ごとに持つ (各パケットのヘッダで上書き)
+    # seq が飛んだら欠けた分をフェードアウトで埋めて再生時間を保つ
+    decoder = ConcealingDecoder(FADE)
+
+    # 音声再生: ジッタバッファ経由でコールバック型ストリームに流す
+    # (接続して測ってから作る。つなぎ直しても作り直さない)
+    fs = 8000
+    speaker = None
+
+    # デコード (ワーカースレッド側)。speaker.write はバッファに積むだけ
+    def play_packet(data: memoryview):
+        if len(data) == 0:
+            # つなぎ直した目印: 切れる前の分を再生し終えてから、次のヘッダでやり直す
+            decoder.resync()
+            return
+        metrics.received(len(data))
+        # [補間フレーム..., 今回のフレーム] の順に speaker へ (デコード先は使い回し)
+        # デコード時間は TIME_EVERY 個に 1 回だけ測る
+        if metrics.rx_packets.value % TIME_EVERY:
+            decoder.decode_packet(data, speaker.write)
+        else:
+            t0 = time.perf_counter()
+            decoder.decode_packet(data, speaker.write)
+            metrics.decode_seconds.observe(time.perf_counter() - t0)
+
+    # 通知ハンドラはリングにコピーするだけ (再生が詰まっても受信を止めない)
+    def handle_notify(_, data: bytearray):
+        pipeline.push(data)
+
+    async def on_connect(client):
+        print(f"Connected to {client.address}")
+        if link.connects > 1:
+            profile = await negotiate(client)
+            print(f"MTU={profile.mtu}, PHY={profile.phy}")
+            pipeline.push(b"")
+
+    def on_disconnect():
+        st = link.stats()
+        print(f"Disconnected; reconnecting... (down {st['downtime_s']:.1f} s in total)")
+
+    # 接続: 前回つないだアドレスがあれば直接 (数秒のスキャンを省く)、だめならスキャン
+    # (名前か UART サービスの広告が届いた時点でスキャンをやめる)。
+    # 切れたら disconnected_callback で気づき、待ち時間をずらしながらつなぎ直して
+    # Notify を登録し直す
+    link = LinkSupervisor("CatVoiceStreamer", {UART_TX_CHAR_UUID: handle_notify},
+                          service_uuids=[UART_SERVICE_UUID],
+                          on_connect=on_connect, on_disconnect=on_disconnect)
+
+    print("Connecting to BLE device named 'CatVoiceStreamer'...")
+    try:
+        client = await link.open()
+        # MTU / PHY を (できるバックエンドなら) 要求し、0.5 秒受けて実際の B/s と
+        # packets/s を測る。キューとジッタバッファの大きさはその値から決める
+        # (測っている間に届いた分は捨てずに取っておき、パイプラインができたら流す)
+        early = []
+        profile = await tune(client, UART_TX_CHAR_UUID, probe_s=0.5,
+                             forward=lambda _, data: early.append(bytes(data)))
+        sizes = size_buffers(profile)
+        print(f"MTU={profile.mtu}, PHY={profile.phy}, {profile.bytes_per_s:.0f} B/s, "
+              f"{profile.packets_per_s:.1f} pkt/s, max packet={profile.max_packet} B "
+              f"→ queue={sizes['capacity']}x{sizes['slot_size']} B, "
+              f"buffer={sizes['initial_target_ms']:.0f} ms")
+        speaker = JitterSpeakerSink(fs, initial_target_ms=sizes["initial_target_ms"])
+        pipeline = Pipeline(play_packet, capacity=max(sizes["capacity"], len(early)),
+                            slot_size=sizes["slot_size"], policy=DROP_OLDEST)
+        metrics.watch_decoder(decoder)
+        metrics.watch_pipeline(pipeline)
+        metrics.watch_sink(speaker)
+        metrics.watch_link(link)
+        reporter = MetricsReporter(registry, [LogExporter(emit=print, names=SHOWN)], interval=1.0)
+        reporting = asyncio.create_task(reporter.run())   # 参照を持っておく (途中で GC されないように)
+        with pipeline:
+            for data in early:
+                pipeline.push(data)
+            early.clear()
             print("Receiving audio via BLE...")
-            # 終了しないように待機
-            await asyncio.Event().wait()
+            # 止めるまで (Ctrl+C) 受信を続ける
+            await link.run(asyncio.Event())
+    finally:
+        if speaker is not None:
+            speaker.close()
+        st = link.stats()
+        print(f"{st['reconnects']} reconnects, {st['downtime_s']:.1f} s down")
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    try:
+        asyncio.run(main())
+    except (ConnectionError, TimeoutError) as e:
+        print(f"対象デバイスが見つかりませんでした。({e})")
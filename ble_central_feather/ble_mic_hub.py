@@ -0,0 +1,75 @@
+import argparse
+import asyncio
+import logging
+from pathlib import Path
+
+from nelrx.capture import CaptureWriter
+from nelrx.hub import BleHub
+from nelrx.metrics import (JsonFileExporter, LogExporter, MetricsRegistry, MetricsReporter,
+                           PrometheusExporter)
+from nelrx.recorder import WavRecorder
+
+# 複数の CatVoiceStreamer (首輪) から同時に受信し、デバイスごとに WAV を書く
+# 例: python ble_mic_hub.py --max 6 --out recordings --segment 600
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s [%(levelname)s] %(message)s",
+    datefmt="%H:%M:%S",
+)
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--max', dest='max_connections', type=int, default=4, help='同時接続数の上限')
+parser.add_argument('--out', type=Path, default=Path('.'), help='WAV の出力先ディレクトリ')
+parser.add_argument('--fs', type=int, default=8000, help='サンプリングレート (ble_mic_ok は 8 kHz)')
+parser.add_argument('--scan', type=float, default=5.0, help='スキャン時間の上限 [s]')
+parser.add_argument('--expect', type=int, default=None, help='この台数が見つかったらスキャンを打ち切る')
+parser.add_argument('--settle', type=float, default=None,
+                    help='最初の 1 台が見つかってからこの秒数でスキャンを打ち切る')
+parser.add_argument('--segment', type=float, default=None, help='この秒数ごとに WAV を分ける')
+parser.add_argument('--capture', type=Path, default=None,
+                    help='受信したままの Notify をこのファイルに記録する (python -m nelrx replay で再生)')
+parser.add_argument('--metrics-port', type=int, default=None,
+                    help='http://127.0.0.1:PORT/metrics でデバイスごとのメトリクスを Prometheus 形式で出す')
+parser.add_argument('--metrics-json', type=Path, default=None, help='メトリクスを定期的にこの JSON に書く')
+parser.add_argument('--metrics-interval', type=float, default=10.0,
+                    help='メトリクスをログ / JSON に出す間隔 [s]')
+args = parser.parse_args()
+
+
+def open_sink(device):
+    # 1 秒ごとにディスクへ書き出すので、途中で落ちてもそこまでの WAV は残る
+    return WavRecorder(args.out, args.fs, prefix=device.address.replace(':', ''),
+                       max_seconds=args.segment)
+
+
+async def main():
+    args.out.mkdir(parents=True, exist_ok=True)
+    capture = None
+    if args.capture:
+        capture = CaptureWriter(args.capture, meta={"codec": "adpcm-hdr", "samplerate": args.fs})
+    # 受信量 / 欠落 / デコード時間 / 再接続をデバイスごとに数え、定期的にログ (と JSON / HTTP) に出す
+    registry = MetricsRegistry()
+    exporters = [LogExporter()]
+    if args.metrics_json:
+        exporters.append(JsonFileExporter(args.metrics_json))
+    if args.metrics_port:
+        exporters.append(PrometheusExporter(registry, args.metrics_port))
+    reporter = MetricsReporter(registry, exporters, args.metrics_interval)
+    stop = asyncio.Event()
+    exporting = asyncio.create_task(reporter.run(stop))
+    hub = BleHub(open_sink, max_connections=args.max_connections, capture=capture,
+                 expected=args.expect, settle=args.settle, metrics_registry=registry)
+    try:
+        await hub.run(scan_timeout=args.scan)
+    finally:
+        stop.set()
+        await exporting
+        if capture is not None:
+            capture.close()
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        print("Stopped by user")
@@ -1,26 +1,32 @@
+import argparse
 import asyncio
-from bleak import BleakClient, BleakScanner
-import struct
+from nelrx.ble import SENSOR_SERVICE_UUID
+from nelrx.connect import open_device
+from nelrx.sensor import SensorBatcher, format_row
+from nelrx.telemetry import TelemetryStore
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--store', default=None, help='センサー値をこのディレクトリに列ごとに保存する')
+args = parser.parse_args()
+store = TelemetryStore(args.store) if args.store else None
 
 # BLE UUIDs
 SENSOR_CHAR_UUID = "00002A58-0000-1000-8000-00805F9B34FB"
 AUDIO_CHAR_UUID = "00002A59-0000-1000-8000-00805F9B34FB"
 
 # センサー通知のコールバック
-def handle_sensor_data(_, data: bytearray):
-    if len(data) != 17:
-        print("Invalid sensor packet length.")
-        return
-
-    proximity = data[0]
-    accel = [(data[i] - 128) / 8.0 for i in range(1, 4)]
-    magnetic = [(data[i] - 128) / 1.25 for i in range(4, 7)]
-    gyro = [struct.unpack("<H", data[i:i+2])[0] * 4000 / 65535 - 2000 for i in range(7, 13, 2)]
-    temperature = data[13] * 125 / 255 - 40
-    clear = data[14]
-    rgb565 = struct.unpack("<H", data[15:17])[0]
-
-    print(f"[Sensor] Prox:{proximity} Acc:{accel} Mag:{magnetic} Gyro:{gyro} Temp:{temperature:.1f}°C Clear:{clear} RGB565:0x{rgb565:04X}")
+# 1 パケットずつ print すると高レートでは表示が追いつかないので、
+# 溜めてからまとめてデコードし、1 秒ごとに件数と最新の値を出す
+def print_sensor_batch(columns):
+    n = len(columns["prox"])
+    span = columns["t"][-1] - columns["t"][0]
+    rate = f" ({(n - 1) / span:.0f}/s)" if n > 1 and span > 0 else ""
+    invalid = f" invalid={sensor_batcher.invalid}" if sensor_batcher.invalid else ""
+    print(f"[Sensor] {n} packets{rate}{invalid} {format_row(columns)}")
+    if store is not None:
+        store.write(columns)
+
+sensor_batcher = SensorBatcher(print_sensor_batch, batch_size=256, flush_interval=1.0)
 
 # オーディオ通知のコールバック
 def handle_audio_data(_, data: bytearray):
@@ -31,22 +37,26 @@ def handle_audio_data(_, data: bytearray):
 
 # メインループ
 async def main():
-    print("🔍 Scanning for FeatherSensor...")
-    devices = await BleakScanner.discover()
-    target = next((d for d in devices if d.name and "FeatherSensor" in d.name), None)
-
-    if not target:
-        print("❌ FeatherSensor not found.")
-        return
-
-    async with BleakClient(target.address) as client:
-        print(f"✅ Connected to {target.name} ({target.address})")
+    # 前回つないだアドレスがあれば直接つなぐ (なければ / つながらなければスキャン)
+    # スキャンは名前か 0x180C の広告が届いた時点で終わる
+    print("🔍 Connecting to FeatherSensor...")
+    async with open_device("FeatherSensor", service_uuids=[SENSOR_SERVICE_UUID]) as client:
+        print(f"✅ Connected to FeatherSensor ({client.address})")
 
-        await client.start_notify(SENSOR_CHAR_UUID, handle_sensor_data)
+        await client.start_notify(SENSOR_CHAR_UUID, sensor_batcher.handle_notify)
         await client.start_notify(AUDIO_CHAR_UUID, handle_audio_data)
 
         print("📡 Receiving BLE notifications...")
         while True:
             await asyncio.sleep(1)
 
-asyncio.run(main())
\ No newline at end of file
+try:
+    asyncio.run(main())
+except KeyboardInterrupt:
+    print("Stopped by user")
+except (ConnectionError, TimeoutError) as e:
+    print(f"❌ FeatherSensor not found. ({e})")
+finally:
+    sensor_batcher.flush()
+    if store is not None:
+        store.close()
\ No newline at end of file
@@ -0,0 +1,4 @@
+"""nelnel 受信側 (Mac / Linux) の共通モジュール。
+
+ble_central_feather 以下の各受信スクリプトから import して使う。
+"""
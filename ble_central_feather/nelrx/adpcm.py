@@ -0,0 +1,516 @@
+"""IMA-ADPCM (4bit/sample) デコーダ / エンコーダ。
+
+Feather 側の ima_adpcm_encode.c と対になる実装。1 バイトに 2 サンプル、
+下位ニブルが先。
+
+- decode_reference : C 実装をそのまま写した 1 ニブルずつのループ (基準実装)
+- decode           : 表引きと NumPy でパケット全体をまとめて処理する高速版
+- decode_into      : decode と同じ計算を呼び出し側のバッファに書く (定常状態で確保なし)
+
+どちらも ``(pcm, (predictor, step_index))`` を返し、出力はビット単位で一致する。
+- encode_reference : ima_adpcm_encode.c をそのまま写したエンコーダ
+- encode           : 量子化を表と bisect で行う高速版 (ファームとビット単位で一致)
+- AdpcmEncoder     : 分割して渡しても 1 回で渡したときと同じバイト列になるストリーム版
+
+ストリームごとの状態は AdpcmState に持たせる (モジュールグローバルは使わない)。
+"""
+from bisect import bisect_right
+
+import numpy as np
+
+# --------- テーブル ---------
+STEP_TABLE = (
+    7, 8, 9, 10, 11, 12, 13, 14, 16, 17,
+    19, 21, 23, 25, 28, 31, 34, 37, 41, 45,
+    50, 55, 60, 66, 73, 80, 88, 97, 107, 118,
+    130, 143, 157, 173, 190, 209, 230, 253, 279, 307,
+    337, 371, 408, 449, 494, 544, 598, 658, 724, 796,
+    876, 963, 1060, 1166, 1282, 1411, 1552, 1707, 1878, 2066,
+    2272, 2499, 2749, 3024, 3327, 3660, 4026, 4428, 4871, 5358,
+    5894, 6484, 7132, 7845, 8630, 9493, 10442, 11487, 12635, 13899,
+    15289, 16818, 18500, 20350, 22385, 24623, 27086, 29794, 32767,
+)
+
+INDEX_TABLE = (
+    -1, -1, -1, -1, 2, 4, 6, 8,
+    -1, -1, -1, -1, 2, 4, 6, 8,
+)
+
+STEP_INDEX_MAX = len(STEP_TABLE) - 1   # 88
+PCM_MIN, PCM_MAX = -32768, 32767
+
+
+def _diffq(step: int, nibble: int) -> int:
+    diffq = step >> 3
+    if nibble & 4: diffq += step
+    if nibble & 2: diffq += step >> 1
+    if nibble & 1: diffq += step >> 2
+    return -diffq if nibble & 8 else diffq
+
+
+# (step_index, nibble) → 予測値の増分 / 次の step_index
+DELTA_TABLE = np.array(
+    [[_diffq(step, nib) for nib in range(16)] for step in STEP_TABLE],
+    dtype=np.int64,
+)
+NEXT_INDEX_TABLE = np.array(
+    [[max(0, min(STEP_INDEX_MAX, idx + INDEX_TABLE[nib])) for nib in range(16)]
+     for idx in range(len(STEP_TABLE))],
+    dtype=np.int64,
+)
+
+
+# --------- 基準実装 ---------
+def decode_reference(adpcm_bytes, state=None):
+    """ADPCM を 1 ニブルずつデコードする (ima_adpcm_encode.c の逆変換そのまま)。"""
+    predictor, step_index = (0, 0) if state is None else state
+    predictor = int(predictor)
+    step_index = int(step_index)
+
+    output = []
+    for byte in adpcm_bytes:
+        for shift in (0, 4):
+            nibble = (byte >> shift) & 0x0F
+            step = STEP_TABLE[step_index]
+            diffq = step >> 3
+            if nibble & 4: diffq += step
+            if nibble & 2: diffq += step >> 1
+            if nibble & 1: diffq += step >> 2
+            if nibble & 8:
+                predictor -= diffq
+            else:
+                predictor += diffq
+
+            predictor = max(PCM_MIN, min(PCM_MAX, predictor))
+            output.append(predictor)
+
+            step_index += INDEX_TABLE[nibble]
+            step_index = max(0, min(STEP_INDEX_MAX, step_index))
+
+    return np.array(output, dtype=np.int16), (predictor, step_index)
+
+
+def encode_reference(pcm, state=None):
+    """ima_adpcm_encode.c と同じ手順で PCM (int16) を ADPCM にする。
+
+    (adpcm_bytes, (predictor, step_index)) を返す。ファームと同じく、サンプル数が
+    奇数のとき最後のニブルはバイトにならない (状態はそのサンプルまで進む)。
+    """
+    predictor, step_index = (0, 0) if state is None else state
+    predictor = int(predictor)
+    step_index = int(step_index)
+
+    out = bytearray()
+    out_byte = 0
+    for i, sample in enumerate(np.asarray(pcm, dtype=np.int16).tolist()):
+        diff = sample - predictor
+        sign = 8 if diff < 0 else 0
+        if sign:
+            diff = -diff
+
+        step = STEP_TABLE[step_index]
+        delta = 0
+        if diff >= step:
+            delta = 4
+            diff -= step
+        if diff >= step // 2:
+            delta |= 2
+            diff -= step // 2
+        if diff >= step // 4:
+            delta |= 1
+        delta |= sign
+
+        # 予測値の更新 (デコーダと同じ計算)
+        predictor += _diffq(step, delta)
+        predictor = max(PCM_MIN, min(PCM_MAX, predictor))
+        step_index = max(0, min(STEP_INDEX_MAX, step_index + INDEX_TABLE[delta]))
+
+        if i & 1:
+            out.append(out_byte | (delta << 4))
+        else:
+            out_byte = delta
+    return bytes(out), (predictor, step_index)
+
+
+# --------- 高速版 ---------
+# 1 バイト (2 ニブル) 単位の表。キーは (step_index << 8) | byte
+#   _BYTE_DELTA[key]        → (下位ニブルの増分, 上位ニブルの増分)
+#   _NEXT_KEY_BASE[key]     → 2 ニブル処理後の step_index << 8
+def _build_byte_tables():
+    delta = np.empty((len(STEP_TABLE) * 256, 2), dtype=np.int64)
+    next_base = []
+    for idx in range(len(STEP_TABLE)):
+        for byte in range(256):
+            low, high = byte & 0x0F, byte >> 4
+            mid = NEXT_INDEX_TABLE[idx, low]
+            delta[(idx << 8) | byte] = (DELTA_TABLE[idx, low], DELTA_TABLE[mid, high])
+            next_base.append(int(NEXT_INDEX_TABLE[mid, high]) << 8)
+    return delta, tuple(next_base)
+
+
+_BYTE_DELTA, _NEXT_KEY_BASE = _build_byte_tables()
+
+
+def _walk_keys(data, step_index: int, keys) -> int:
+    """各バイトの表キーを keys に書き込み、処理後の step_index を返す。
+
+    step_index の推移は予測値に依存しないので、ここだけ Python で回せば
+    残りは NumPy でまとめて計算できる。step_index も byte も小さい int なので
+    ループ内で新しいオブジェクトはできない。
+    """
+    table = _NEXT_KEY_BASE
+    base = step_index << 8
+    j = 0
+    for byte in data:
+        key = base | byte
+        keys[j] = key
+        base = table[key]
+        j += 1
+    return base >> 8
+
+
+def _as_bytes_view(adpcm_bytes) -> memoryview:
+    mv = memoryview(adpcm_bytes)
+    if mv.format != "B" or mv.ndim != 1:
+        mv = mv.cast("B")
+    return mv
+
+
+def _clamped_scan(delta, lo, hi, x0):
+    """x ← clip(x + delta[i], lo, hi) を順に適用した各時点の値をまとめて求める。
+
+    「足してからクリップ」する関数同士の合成はまた同じ形
+    clip(x + a, L, H) になるので、Hillis–Steele 型のスキャンで
+    log2(n) 回の配列演算に落とせる。
+    """
+    a = delta.astype(np.int64)
+    n = a.size
+    low = np.full(n, lo, dtype=np.int64)
+    high = np.full(n, hi, dtype=np.int64)
+
+    k = 1
+    while k < n:
+        # 要素 i に [i-k] までの区間 (先) を合成する
+        a_cur, low_cur, high_cur = a[k:], low[k:], high[k:]
+        new_low = np.maximum(np.minimum(low[:-k] + a_cur, high_cur), low_cur)
+        new_high = np.maximum(np.minimum(high[:-k] + a_cur, high_cur), low_cur)
+        a[k:] = a[:-k] + a_cur
+        low[k:] = new_low
+        high[k:] = new_high
+        k <<= 1
+
+    return np.maximum(np.minimum(x0 + a, high), low)
+
+
+def decode(adpcm_bytes, state=None):
+    """ADPCM をパケット単位でまとめてデコードする。decode_reference と同じ結果を返す。"""
+    predictor, step_index = (0, 0) if state is None else state
+    predictor = int(predictor)
+    step_index = int(step_index)
+
+    data = _as_bytes_view(adpcm_bytes)
+    n = len(data)
+    if n == 0:
+        return np.empty(0, dtype=np.int16), (predictor, step_index)
+
+    keys = np.empty(n, dtype=np.intp)
+    step_index = _walk_keys(data, step_index, memoryview(keys))
+    delta = _BYTE_DELTA[keys].reshape(-1)
+
+    # 飽和しなければ単純な累積和で済む。飽和したときだけスキャンに切り替える
+    pcm = np.cumsum(delta)
+    pcm += predictor
+    if pcm.min() < PCM_MIN or pcm.max() > PCM_MAX:
+        pcm = _clamped_scan(delta, PCM_MIN, PCM_MAX, predictor)
+    return pcm.astype(np.int16), (int(pcm[-1]), step_index)
+
+
+class DecodeBuffers:
+    """decode_into 用の作業領域。max_bytes バイトまでのパケットを扱える。"""
+    __slots__ = ("max_bytes", "keys", "_keys_mv", "delta", "_delta_flat", "acc")
+
+    def __init__(self, max_bytes: int = 512):
+        self.max_bytes = max_bytes
+        self.keys = np.empty(max_bytes, dtype=np.intp)
+        self._keys_mv = memoryview(self.keys)
+        self.delta = np.empty((max_bytes, 2), dtype=np.int64)
+        self._delta_flat = self.delta.reshape(-1)
+        self.acc = np.empty(max_bytes * 2, dtype=np.int64)
+
+
+def decode_into(adpcm_bytes, out, state=None, buffers=None):
+    """decode と同じ計算を、呼び出し側の int16 配列 out に直接書き込む。
+
+    adpcm_bytes はバッファプロトコル対応なら何でもよい (memoryview(data)[4:] など)。
+    buffers (DecodeBuffers) を使い回せば、飽和しない限りパケットごとの配列確保はない。
+    戻り値は (書き込んだサンプル数, (predictor, step_index))。
+    """
+    predictor, step_index = (0, 0) if state is None else state
+    predictor = int(predictor)
+    step_index = int(step_index)
+
+    data = _as_bytes_view(adpcm_bytes)
+    n = len(data)
+    if n == 0:
+        return 0, (predictor, step_index)
+    if buffers is None or buffers.max_bytes < n:
+        buffers = DecodeBuffers(max(n, 512))
+    if len(out) < 2 * n:
+        raise ValueError(f"output buffer too small: {len(out)} < {2 * n}")
+
+    step_index = _walk_keys(data, step_index, buffers._keys_mv)
+    np.take(_BYTE_DELTA, buffers.keys[:n], axis=0, out=buffers.delta[:n], mode="clip")
+    delta = buffers._delta_flat[:2 * n]
+    acc = buffers.acc[:2 * n]
+    np.cumsum(delta, out=acc)
+    np.add(acc, predictor, out=acc)
+    if acc.min() < PCM_MIN or acc.max() > PCM_MAX:
+        acc = _clamped_scan(delta, PCM_MIN, PCM_MAX, predictor)
+    np.copyto(out[:2 * n], acc, casting="unsafe")
+    return 2 * n, (int(acc[-1]), step_index)
+
+
+# --------- 高速エンコーダ ---------
+# step_index ごとの量子化しきい値。ファームの
+#   if (diff >= step) ...; if (diff >= step/2) ...; if (diff >= step/4) ...
+# は「|diff| 以下で最大のしきい値を持つコード」を選ぶのと同じなので bisect で引ける
+_ENCODE_THRESHOLDS = tuple(
+    tuple((step if c & 4 else 0) + (step // 2 if c & 2 else 0) + (step // 4 if c & 1 else 0)
+          for c in range(1, 8))
+    for step in STEP_TABLE
+)
+_DELTA_FLAT = tuple(DELTA_TABLE.reshape(-1).tolist())        # (step_index << 4) | nibble
+_NEXT_INDEX_FLAT = tuple(NEXT_INDEX_TABLE.reshape(-1).tolist())
+
+
+def _encode_nibbles(pcm, predictor: int, step_index: int):
+    """1 サンプル 1 バイトのニブル列を作る。(nibbles, predictor, step_index) を返す。"""
+    samples = np.asarray(pcm, dtype=np.int16).tolist()
+    nibbles = bytearray(len(samples))
+    thresholds = _ENCODE_THRESHOLDS
+    delta = _DELTA_FLAT
+    next_index = _NEXT_INDEX_FLAT
+    j = 0
+    for x in samples:
+        diff = x - predictor
+        if diff < 0:
+            code = bisect_right(thresholds[step_index], -diff) | 8
+        else:
+            code = bisect_right(thresholds[step_index], diff)
+        key = (step_index << 4) | code
+        predictor += delta[key]
+        if predictor > PCM_MAX:
+            predictor = PCM_MAX
+        elif predictor < PCM_MIN:
+            predictor = PCM_MIN
+        step_index = next_index[key]
+        nibbles[j] = code
+        j += 1
+    return nibbles, predictor, step_index
+
+
+def _pack_nibbles(nibbles) -> bytes:
+    """2 ニブルを 1 バイトに (下位が先)。端数の 1 ニブルは捨てる。"""
+    codes = np.frombuffer(nibbles, dtype=np.uint8)
+    n = len(codes) & ~1
+    return (codes[0:n:2] | (codes[1:n:2] << 4)).tobytes()
+
+
+def encode(pcm, state=None):
+    """encode_reference と同じ結果を返す高速版。"""
+    predictor, step_index = (0, 0) if state is None else state
+    nibbles, predictor, step_index = _encode_nibbles(pcm, int(predictor), int(step_index))
+    return _pack_nibbles(nibbles), (predictor, step_index)
+
+
+# --------- ストリーム状態 ---------
+HEADER_SIZE = 4   # seq(u8) + predictor(int16 LE) + step_index(u8)
+
+
+def parse_header(packet):
+    """ble_mic_ok 形式のパケットヘッダを (seq, predictor, step_index) にする。"""
+    seq = packet[0]
+    predictor = packet[1] | (packet[2] << 8)
+    if predictor & 0x8000:
+        predictor -= 0x10000
+    return seq, predictor, min(packet[3], STEP_INDEX_MAX)
+
+
+class AdpcmState:
+    """1 ストリーム分のデコーダ状態。値は素の int で持つ。
+
+    インスタンス同士は何も共有しないので、ストリームごとに 1 つ作れば
+    同じプロセスで何本でも並行にデコードできる。
+    """
+    __slots__ = ("predictor", "step_index", "_buffers")
+
+    def __init__(self, predictor: int = 0, step_index: int = 0):
+        self.predictor = int(predictor)
+        self.step_index = int(step_index)
+        self._buffers = None
+
+    def __repr__(self):
+        return f"AdpcmState(predictor={self.predictor}, step_index={self.step_index})"
+
+    def reset(self, predictor: int = 0, step_index: int = 0) -> None:
+        self.predictor = int(predictor)
+        self.step_index = int(step_index)
+
+    def reset_from_header(self, packet) -> int:
+        """パケット先頭 4 バイトで状態を上書きし、seq を返す。"""
+        seq, self.predictor, self.step_index = parse_header(packet)
+        return seq
+
+    def decode(self, adpcm_bytes) -> np.ndarray:
+        """ヘッダなしの ADPCM を続きからデコードし、状態を進める。"""
+        pcm, (self.predictor, self.step_index) = decode(
+            adpcm_bytes, (self.predictor, self.step_index))
+        return pcm
+
+    def decode_packet(self, packet):
+        """ヘッダ付きパケットをデコードして (seq, pcm) を返す。"""
+        seq = self.reset_from_header(packet)
+        return seq, self.decode(memoryview(packet)[HEADER_SIZE:])
+
+    def decode_into(self, adpcm_bytes, out) -> int:
+        """decode の確保なし版。out (int16) に書き込んだサンプル数を返す。"""
+        buffers = self._buffers
+        if buffers is None or buffers.max_bytes < len(adpcm_bytes):
+            buffers = self._buffers = DecodeBuffers(max(len(adpcm_bytes), 512))
+        n, (self.predictor, self.step_index) = decode_into(
+            adpcm_bytes, out, (self.predictor, self.step_index), buffers)
+        return n
+
+
+class AdpcmEncoder:
+    """1 ストリーム分のエンコーダ状態。
+
+    encode() は奇数サンプルの端数ニブルを次の呼び出しに持ち越すので、
+    どう分割して渡しても出力は全体を 1 回で encode したものと同じになる。
+    encode_packet() はファームの send_block と同じく 1 パケットで完結させる。
+    """
+    __slots__ = ("predictor", "step_index", "seq", "_pending")
+
+    def __init__(self, predictor: int = 0, step_index: int = 0):
+        self.predictor = int(predictor)
+        self.step_index = int(step_index)
+        self.seq = 0
+        self._pending = None   # 持ち越した下位ニブル
+
+    def __repr__(self):
+        return f"AdpcmEncoder(predictor={self.predictor}, step_index={self.step_index})"
+
+    def encode(self, pcm) -> bytes:
+        nibbles, self.predictor, self.step_index = _encode_nibbles(
+            pcm, self.predictor, self.step_index)
+        if self._pending is not None:
+            nibbles.insert(0, self._pending)
+            self._pending = None
+        if len(nibbles) & 1:
+            self._pending = nibbles.pop()
+        return _pack_nibbles(nibbles)
+
+    def flush(self) -> bytes:
+        """持ち越しのニブルがあれば上位を 0 にした 1 バイトにして返す。"""
+        if self._pending is None:
+            return b""
+        out = bytes((self._pending,))
+        self._pending = None
+        return out
+
+    def encode_packet(self, pcm) -> bytes:
+        """ble_mic_ok 形式のパケット (エンコード前の状態をヘッダに載せる) を作る。"""
+        p = self.predictor & 0xFFFF
+        header = bytes((self.seq, p & 0xFF, p >> 8, self.step_index))
+        payload, (self.predictor, self.step_index) = encode(pcm, (self.predictor, self.step_index))
+        self.seq = (self.seq + 1) & 0xFF
+        return header + payload
+
+
+if __name__ == "__main__":
+    # 基準実装と高速版の一致確認
+    rng = np.random.default_rng(0)
+    for n in (0, 1, 2, 3, 64, 128, 240, 256, 1000):
+        for _ in range(20):
+            data = rng.integers(0, 256, n, dtype=np.uint8).tobytes()
+            state = (int(rng.integers(PCM_MIN, PCM_MAX + 1)), int(rng.integers(0, STEP_INDEX_MAX + 1)))
+            ref, ref_state = decode_reference(data, state)
+            fast, fast_state = decode(data, state)
+            assert np.array_equal(ref, fast) and ref_state == fast_state, (n, state)
+    print("decode == decode_reference: OK")
+
+    # 複数ストリームを交互にデコードしても互いに干渉しないこと
+    streams = [[rng.integers(0, 256, 128, dtype=np.uint8).tobytes() for _ in range(10)] for _ in range(4)]
+    states = [AdpcmState() for _ in streams]
+    mixed = [[] for _ in streams]
+    for i in range(10):
+        for k, packets in enumerate(streams):
+            mixed[k].append(states[k].decode(packets[i]))
+    for k, packets in enumerate(streams):
+        alone, _ = decode(b"".join(packets))
+        assert np.array_equal(np.concatenate(mixed[k]), alone), k
+    print("independent AdpcmState streams: OK")
+
+    # decode_into も同じ結果になること (memoryview のスライスを直接渡す)
+    out = np.zeros(2048, dtype=np.int16)
+    bufs = DecodeBuffers(1000)
+    for n in (0, 1, 3, 128, 1000):
+        for _ in range(20):
+            packet = b"\0\0\0\0" + rng.integers(0, 256, n, dtype=np.uint8).tobytes()
+            state = (int(rng.integers(PCM_MIN, PCM_MAX + 1)), int(rng.integers(0, STEP_INDEX_MAX + 1)))
+            ref, ref_state = decode_reference(packet[HEADER_SIZE:], state)
+            m, st = decode_into(memoryview(packet)[HEADER_SIZE:], out, state, bufs)
+            assert m == len(ref) and np.array_equal(out[:m], ref) and st == ref_state, (n, state)
+    print("decode_into == decode_reference: OK")
+
+    # エンコードしたものをデコードすると、エンコーダ内部の予測値の列に戻ること
+    t = np.arange(4000)
+    pcm = (8000 * np.sin(2 * np.pi * 440 * t / 8000) + rng.normal(0, 500, t.size)).astype(np.int16)
+    enc, enc_state = encode_reference(pcm)
+    dec_pcm, dec_state = decode(enc)
+    assert enc_state == dec_state and np.abs(dec_pcm.astype(int) - pcm).mean() < 400
+    print("encode_reference round trip: OK")
+
+    # 高速版とストリーム版がファームの写し (encode_reference) と一致すること
+    signals = [pcm, rng.integers(PCM_MIN, PCM_MAX + 1, 3001).astype(np.int16),
+               np.full(100, PCM_MAX, dtype=np.int16), np.full(101, PCM_MIN, dtype=np.int16)]
+    for x in signals:
+        for state in ((0, 0), (1234, 30), (PCM_MIN, STEP_INDEX_MAX), (PCM_MAX, 0)):
+            assert encode(x, state) == encode_reference(x, state), state
+        whole, _ = encode(x)
+        enc = AdpcmEncoder()
+        cuts = np.sort(rng.integers(0, len(x), 7))
+        parts = b"".join(enc.encode(part) for part in np.split(x, cuts))
+        assert parts == whole and len(enc.flush()) == len(x) % 2
+        # デコーダの最終状態がエンコーダの最終状態と一致する (往復の基準)
+        assert decode(whole)[1] == decode_reference(whole)[1] == encode(x[:len(whole) * 2])[1]
+    print("encode == encode_reference, streaming AdpcmEncoder: OK")
+
+    # 定常状態の受信経路でパケットごとの確保がないこと (tracemalloc で確認)
+    import tracemalloc
+    from .synth import adpcm_packets
+
+    def measure(payload_bytes, count):
+        packets = adpcm_packets(count + 16, payload_bytes, seed=3)
+        dec = AdpcmState()
+        pcm = np.zeros(payload_bytes * 2, dtype=np.int16)
+        views = [memoryview(p)[HEADER_SIZE:] for p in packets]
+        tracemalloc.start()
+        for i in range(len(packets)):
+            if i == 16:  # ここまでで作業領域の確保などを済ませておく
+                tracemalloc.reset_peak()
+                before = tracemalloc.get_traced_memory()[0]
+            dec.reset_from_header(packets[i])
+            dec.decode_into(views[i], pcm)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return current - before, peak - before
+
+    for payload_bytes, count in ((128, 200), (128, 2000), (1000, 200)):
+        growth, peak = measure(payload_bytes, count)
+        print(f"payload={payload_bytes} B x {count}: growth={growth} B, peak={peak} B")
+        # パケット数に比例して残るものはなく、一時的な小オブジェクト以外
+        # (PCM や作業配列) は確保しない
+        assert growth < 256, growth
+        assert peak < 4096, peak
+    print("decode_into steady state allocates nothing per packet: OK")
@@ -0,0 +1,338 @@
+"""受信経路のベンチマーク (実機なし)。
+
+テスト信号をファームと同じエンコーダで ADPCM にし、ble_mic_ok 形式と
+serial_mic_encode 形式のパケット列を作って、エンコーダ / デコーダ実装ごと、
+パイプラインのモードごとに次を測る。
+
+- samples_per_s   : 1 秒あたりにデコードできたサンプル数
+- latency_us      : 1 パケットあたりの処理時間 (パイプラインは push → 処理完了) の分位点
+- peak_bytes      : 処理中の tracemalloc のピーク (計測は時間計測とは別に行う)
+- retained_bytes  : 処理後に残ったメモリ
+
+センサーパケット (bench=sensor) は 1 つずつの decode_packet と、batch 個まとめた
+decode_batch を比べる。samples はパケット数、latency_us は 1 回の呼び出し
+(batch なら batch 個分) の時間。
+
+結果は JSON で出すので、コミット間で --compare して比べられる。
+
+    python -m nelrx.bench --out bench.json
+    python -m nelrx.bench --out new.json --compare bench.json
+"""
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+
+from . import adpcm, sensor, synth
+from .conceal import ConcealingDecoder
+from .pipeline import DROP_NEWEST, DROP_OLDEST, Pipeline
+from .sinks import NullSink
+
+# 形式ごとの設定 (ファームの設定に合わせる)
+FORMATS = {
+    "ble": {"samplerate": 8000, "samples_per_packet": 256},      # ble_mic_ok
+    "serial": {"samplerate": 16000, "samples_per_packet": 512},  # serial_mic_encode
+}
+DECODERS = ("reference", "numpy", "into")
+ENCODERS = ("reference", "fast")
+PIPELINE_MODES = ("inline", DROP_OLDEST, DROP_NEWEST)
+SENSOR_DECODERS = ("per-packet", "batch")
+SENSOR_RATE = 2000          # センサーパケットは 1 秒分あたりこの数 (何台分かをまとめたレート)
+MEMORY_PACKETS = 100
+
+
+# --------- デコーダ ---------
+def make_decoder(kind: str, fmt: str, samples_per_packet: int):
+    """packet を 1 つ受け取ってデコードする関数を返す。"""
+    has_header = fmt == "ble"
+    if kind == "into":
+        state = adpcm.AdpcmState()
+        out = np.zeros(samples_per_packet, dtype=np.int16)
+
+        def run(packet):
+            if has_header:
+                state.reset_from_header(packet)
+                return state.decode_into(memoryview(packet)[adpcm.HEADER_SIZE:], out)
+            return state.decode_into(packet, out)
+        return run
+
+    decode = adpcm.decode_reference if kind == "reference" else adpcm.decode
+    carry = [(0, 0)]
+
+    def run(packet):
+        if has_header:
+            _, predictor, step_index = adpcm.parse_header(packet)
+            pcm, _ = decode(memoryview(packet)[adpcm.HEADER_SIZE:], (predictor, step_index))
+        else:
+            pcm, carry[0] = decode(packet, carry[0])
+        return len(pcm)
+    return run
+
+
+def measure_memory(run, packets) -> dict:
+    """run を packets に流したときの確保量。最初の 1 パケットで準備を済ませてから測る。"""
+    run(packets[0])
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for packet in packets[1:MEMORY_PACKETS + 1]:
+        run(packet)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"peak_bytes": peak - before, "retained_bytes": current - before}
+
+
+def latency_summary(ns) -> dict:
+    us = np.asarray(ns, dtype=np.float64) / 1000.0
+    if us.size == 0:
+        return {}
+    p50, p90, p99 = np.percentile(us, (50, 90, 99))
+    return {"p50": p50, "p90": p90, "p99": p99, "max": float(us.max())}
+
+
+def bench_decoder(kind: str, fmt: str, packets, samples_per_packet: int) -> dict:
+    run = make_decoder(kind, fmt, samples_per_packet)
+    times = np.empty(len(packets), dtype=np.int64)
+    samples = 0
+    clock = time.perf_counter_ns
+    t0 = clock()
+    for i, packet in enumerate(packets):
+        t = clock()
+        samples += run(packet)
+        times[i] = clock() - t
+    elapsed = (clock() - t0) / 1e9
+
+    result = {
+        "packets": len(packets),
+        "samples": samples,
+        "samples_per_s": samples / elapsed,
+        "latency_us": latency_summary(times),
+    }
+    result.update(measure_memory(make_decoder(kind, fmt, samples_per_packet), packets))
+    return result
+
+
+def bench_encoder(kind: str, pcm, samples_per_packet: int) -> dict:
+    encode = adpcm.encode_reference if kind == "reference" else adpcm.encode
+    blocks = [pcm[i:i + samples_per_packet]
+              for i in range(0, len(pcm) - samples_per_packet + 1, samples_per_packet)]
+    times = np.empty(len(blocks), dtype=np.int64)
+    state = (0, 0)
+    clock = time.perf_counter_ns
+    t0 = clock()
+    for i, block in enumerate(blocks):
+        t = clock()
+        _, state = encode(block, state)
+        times[i] = clock() - t
+    elapsed = (clock() - t0) / 1e9
+    return {
+        "packets": len(blocks),
+        "samples": len(blocks) * samples_per_packet,
+        "samples_per_s": len(blocks) * samples_per_packet / elapsed,
+        "latency_us": latency_summary(times),
+    }
+
+
+def bench_sensor(kind: str, packets, batch: int = 64) -> dict:
+    if kind == "per-packet":
+        calls = packets
+        run = sensor.decode_packet
+    else:
+        calls = [b"".join(packets[i:i + batch]) for i in range(0, len(packets), batch)]
+        run = sensor.decode_batch
+    times = np.empty(len(calls), dtype=np.int64)
+    clock = time.perf_counter_ns
+    t0 = clock()
+    for i, data in enumerate(calls):
+        t = clock()
+        run(data)
+        times[i] = clock() - t
+    elapsed = (clock() - t0) / 1e9
+    result = {
+        "packets": len(packets),
+        "samples": len(packets),
+        "samples_per_s": len(packets) / elapsed,
+        "latency_us": latency_summary(times),
+    }
+    if kind == "batch":
+        result["batch"] = batch
+    result.update(measure_memory(run, calls))
+    return result
+
+
+# --------- パイプライン ---------
+def bench_pipeline(mode: str, packets, samplerate: int, samples_per_packet: int,
+                   speed: float) -> dict:
+    """BLE の Notify を模したスレッドから packets を送り、ConcealingDecoder → NullSink まで通す。
+
+    speed 倍速で送る (0 なら待たずに送る)。遅延は push から処理完了まで。
+    """
+    decoder = ConcealingDecoder()
+    sink = NullSink()
+    pushed_at = [0] * 256      # seq → push 時刻 (リングは 256 より十分小さい)
+    latencies = []
+    clock = time.perf_counter_ns
+
+    def handle(packet):
+        decoder.decode_packet(packet, sink.write)
+        latencies.append(clock() - pushed_at[packet[0]])
+
+    interval = samples_per_packet / samplerate / speed if speed > 0 else 0.0
+    pipeline = None
+    if mode == "inline":
+        def push(packet):
+            handle(packet)
+    else:
+        pipeline = Pipeline(handle, capacity=64, policy=mode, name="bench-pipeline")
+        push = pipeline.push
+
+    def produce():
+        start = time.perf_counter()
+        for i, packet in enumerate(packets):
+            if interval:
+                delay = start + i * interval - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            pushed_at[packet[0]] = clock()
+            push(packet)
+
+    t0 = clock()
+    if pipeline is not None:
+        pipeline.start()
+    producer = threading.Thread(target=produce, name="bench-producer")
+    producer.start()
+    producer.join()
+    if pipeline is not None:
+        pipeline.stop(timeout=30.0)
+    elapsed = (clock() - t0) / 1e9
+
+    result = {
+        "packets": len(packets),
+        "handled": len(latencies),
+        "samples": sink.samples,
+        "samples_per_s": sink.samples / elapsed,
+        "latency_us": latency_summary(latencies),
+    }
+    if pipeline is not None:
+        st = pipeline.stats()
+        result["dropped"] = st["dropped_newest"] + st["dropped_oldest"] + st["oversize"]
+        result["max_depth"] = st["max_depth"]
+        result["ring_bytes"] = pipeline.ring.capacity * pipeline.ring.slot_size
+    result.update(measure_memory(
+        lambda p, d=ConcealingDecoder(), s=NullSink(): d.decode_packet(p, s.write), packets))
+    return result
+
+
+# --------- 全体 ---------
+def git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def run_all(seconds: float = 10.0, signals=synth.SIGNALS, decoders=DECODERS,
+            modes=PIPELINE_MODES, speed: float = 10.0, seed: int = 0) -> dict:
+    results = []
+    for signal in signals:
+        for fmt, cfg in FORMATS.items():
+            fs, spp = cfg["samplerate"], cfg["samples_per_packet"]
+            pcm = synth.make_signal(signal, int(seconds * fs), fs, seed=seed)
+            if fmt == "ble":
+                packets = synth.ble_packets(pcm, spp)
+            else:
+                packets = synth.serial_chunks(pcm, spp)
+
+            for kind in ENCODERS:
+                r = bench_encoder(kind, pcm, spp)
+                results.append({"bench": "encode", "signal": signal, "format": fmt,
+                                "encoder": kind, **r})
+            for kind in decoders:
+                r = bench_decoder(kind, fmt, packets, spp)
+                results.append({"bench": "decode", "signal": signal, "format": fmt,
+                                "decoder": kind, **r})
+            if fmt == "ble":
+                for mode in modes:
+                    r = bench_pipeline(mode, packets, fs, spp, speed)
+                    results.append({"bench": "pipeline", "signal": signal, "format": fmt,
+                                    "mode": mode, "speed": speed, **r})
+    packets = synth.sensor_packets(int(seconds * SENSOR_RATE), seed=seed)
+    for kind in SENSOR_DECODERS:
+        r = bench_sensor(kind, packets)
+        results.append({"bench": "sensor", "signal": "random", "format": "sensor",
+                        "decoder": kind, **r})
+    return {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "git": git_revision(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "seconds": seconds,
+            "seed": seed,
+        },
+        "results": results,
+    }
+
+
+def result_key(r: dict) -> tuple:
+    return (r["bench"], r["signal"], r["format"],
+            r.get("decoder") or r.get("encoder") or r.get("mode"))
+
+
+def compare(new: dict, old: dict) -> None:
+    """samples_per_s と p99 遅延を前回の結果と比べて表示する。"""
+    previous = {result_key(r): r for r in old["results"]}
+    print(f"compare {old['meta'].get('git') or '?'} → {new['meta'].get('git') or '?'}")
+    for r in new["results"]:
+        o = previous.get(result_key(r))
+        if o is None:
+            continue
+        speed = r["samples_per_s"] / o["samples_per_s"] if o["samples_per_s"] else float("nan")
+        p99, p99_old = r["latency_us"].get("p99"), o["latency_us"].get("p99")
+        lat = p99 / p99_old if p99 and p99_old else float("nan")
+        print(f"  {'/'.join(result_key(r)):40s} throughput x{speed:5.2f}  p99 x{lat:5.2f}")
+
+
+def print_table(report: dict) -> None:
+    for r in report["results"]:
+        lat = r["latency_us"]
+        extra = f" drop={r['dropped']}" if "dropped" in r else ""
+        print(f"{'/'.join(result_key(r)):40s} {r['samples_per_s'] / 1e6:8.2f} Msamples/s  "
+              f"p50={lat.get('p50', 0):8.1f} us p99={lat.get('p99', 0):8.1f} us  "
+              f"peak={r.get('peak_bytes', '-')} B{extra}")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="nelrx receive-path benchmark")
+    parser.add_argument("--seconds", type=float, default=10.0, help="length of each test signal")
+    parser.add_argument("--signals", nargs="+", default=list(synth.SIGNALS), choices=synth.SIGNALS)
+    parser.add_argument("--decoders", nargs="+", default=list(DECODERS), choices=DECODERS)
+    parser.add_argument("--modes", nargs="+", default=list(PIPELINE_MODES), choices=PIPELINE_MODES)
+    parser.add_argument("--speed", type=float, default=10.0,
+                        help="pipeline send rate relative to real time (0 = as fast as possible)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="write JSON results here")
+    parser.add_argument("--compare", help="previous JSON results to compare against")
+    args = parser.parse_args(argv)
+
+    report = run_all(args.seconds, args.signals, args.decoders, args.modes, args.speed, args.seed)
+    print_table(report)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
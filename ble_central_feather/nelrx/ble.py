@@ -0,0 +1,12 @@
+"""Feather 側ファームウェアと合わせる BLE の定数。"""
+
+# ble_mic_* (CatVoiceStreamer) : BLE UART (NUS)
+DEVICE_NAME = "CatVoiceStreamer"
+UART_SERVICE_UUID = "6E400001-B5A3-F393-E0A9-E50E24DCCA9E"
+UART_TX_CHAR_UUID = "6E400003-B5A3-F393-E0A9-E50E24DCCA9E"
+
+# ble_sensor_debug (FeatherSensor) : 0x180C
+SENSOR_DEVICE_NAME = "FeatherSensor"
+SENSOR_SERVICE_UUID = "0000180C-0000-1000-8000-00805F9B34FB"
+SENSOR_CHAR_UUID = "00002A58-0000-1000-8000-00805F9B34FB"
+AUDIO_CHAR_UUID = "00002A59-0000-1000-8000-00805F9B34FB"
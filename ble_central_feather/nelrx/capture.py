@@ -0,0 +1,278 @@
+"""受信したままのバイト列 (Notify / シリアルのチャンク) を時刻付きで保存する形式。
+
+実機なしで受信側を試せるように、届いた順・届いた時刻のまま記録しておき、
+あとで同じ間隔 (または N 倍速 / 最大速度) で流し直す。
+
+    ファイル : MAGIC (8) | meta の長さ (u32 LE) | meta (JSON) | レコード...
+    レコード : t_ns (u64 LE) | channel (u16 LE) | size (u32 LE) | data (size バイト)
+
+t_ns は記録開始からの経過時間 (monotonic, ナノ秒)。追記だけなので、途中で
+落ちても最後の flush までのレコードは読める (末尾の書きかけは読み飛ばす)。
+チャンネルは CONTROL_CHANNEL のレコード (JSON: id, name, ...) で途中から
+定義できるので、ハブのように後からデバイスが増えても 1 ファイルに入る。
+
+    python -m nelrx.capture dump.nelcap [--gap 100]   # チャンネルごとの集計と途切れ
+    python -m nelrx.capture                           # 自己チェック
+"""
+import json
+import logging
+import mmap
+import struct
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+
+log = logging.getLogger("nelrx.capture")
+
+MAGIC = b"NELCAP\x00\x01"
+VERSION = 1
+RECORD = struct.Struct("<QHI")
+CONTROL_CHANNEL = 0xFFFF
+_META_LEN = struct.Struct("<I")
+
+
+def is_capture(path) -> bool:
+    try:
+        with open(path, "rb") as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except OSError:
+        return False
+
+
+class CaptureWriter:
+    """レコードを追記していく。複数スレッド (読み取りスレッドとイベントループ) から書いてよい。"""
+
+    def __init__(self, path, meta: dict = None, buffer_bytes: int = 64 * 1024,
+                 flush_interval: float = 1.0):
+        self.path = str(path)
+        self.flush_interval = flush_interval
+        self.channels = {}          # name -> id
+        self.records = 0
+        self.bytes = 0
+        self._lock = threading.Lock()
+        self._f = open(self.path, "wb", buffering=buffer_bytes)
+        meta = dict(meta or {})
+        meta.setdefault("version", VERSION)
+        meta.setdefault("started_at", datetime.now().isoformat(timespec="milliseconds"))
+        body = json.dumps(meta).encode()
+        self._f.write(MAGIC + _META_LEN.pack(len(body)) + body)
+        self._origin = time.monotonic_ns()
+        self._last_flush = time.monotonic()
+        log.info("capturing to %s", self.path)
+
+    def channel(self, name: str, **info) -> int:
+        """name のチャンネル番号を返す。初めての name なら定義レコードを書く。"""
+        with self._lock:
+            ch = self.channels.get(name)
+            if ch is None:
+                ch = len(self.channels)
+                if ch >= CONTROL_CHANNEL:
+                    raise ValueError("too many channels")
+                self.channels[name] = ch
+                body = json.dumps(dict(info, id=ch, name=name)).encode()
+                self._append(CONTROL_CHANNEL, body, time.monotonic_ns() - self._origin)
+            return ch
+
+    def write(self, channel: int, data, t_ns: int = None) -> None:
+        if t_ns is None:
+            t_ns = time.monotonic_ns() - self._origin
+        with self._lock:
+            if self._f is None:
+                return
+            self._append(channel, data, t_ns)
+            self.records += 1
+            self.bytes += len(data)
+            if time.monotonic() - self._last_flush >= self.flush_interval:
+                self._f.flush()
+                self._last_flush = time.monotonic()
+
+    def tap(self, channel: int):
+        """受け取ったバイト列を channel に記録する関数を返す (push の前に挟む用)。"""
+        def record(data):
+            self.write(channel, data)
+        return record
+
+    def _append(self, channel: int, data, t_ns: int) -> None:
+        self._f.write(RECORD.pack(t_ns, channel, len(data)))
+        self._f.write(data)
+
+    def flush(self) -> None:
+        with self._lock:
+            if self._f is not None:
+                self._f.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._f is None:
+                return
+            self._f.close()
+            self._f = None
+        log.info("capture closed: %d records, %d bytes in %d channel(s)",
+                 self.records, self.bytes, len(self.channels))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def stats(self) -> dict:
+        return {"records": self.records, "bytes": self.bytes, "channels": len(self.channels)}
+
+
+class CaptureReader:
+    """mmap で開いて、レコードをコピーせずに順に返す。
+
+    records() が返す data は mmap の view なので、close() の前に手放すこと。
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        self._file = open(self.path, "rb")
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:   # 空のファイル
+            self._map = b""
+        self._view = memoryview(self._map)
+        if bytes(self._view[:len(MAGIC)]) != MAGIC:
+            self.close()
+            raise ValueError(f"{self.path}: not a capture file")
+        (meta_len,) = _META_LEN.unpack_from(self._view, len(MAGIC))
+        start = len(MAGIC) + _META_LEN.size
+        self.meta = json.loads(bytes(self._view[start:start + meta_len]))
+        self._first = start + meta_len
+        self.channels = {}          # id -> 定義 (name と記録時の情報)
+        self.truncated = False      # 末尾に書きかけのレコードがあった
+        self._scan_channels()
+
+    def _scan_channels(self) -> None:
+        for _, ch, data in self._iter(control=True):
+            if ch == CONTROL_CHANNEL:
+                info = json.loads(bytes(data))
+                self.channels[info["id"]] = info
+
+    def _iter(self, control: bool = False):
+        view, end, pos = self._view, len(self._view), self._first
+        unpack = RECORD.unpack_from
+        while pos + RECORD.size <= end:
+            t_ns, ch, size = unpack(view, pos)
+            pos += RECORD.size
+            if pos + size > end:
+                self.truncated = True
+                return
+            if control or ch != CONTROL_CHANNEL:
+                yield t_ns, ch, view[pos:pos + size]
+            pos += size
+        if pos != end:
+            self.truncated = True
+
+    def channel_id(self, name) -> int:
+        """名前 (または番号の文字列) からチャンネル番号を引く。"""
+        for ch, info in self.channels.items():
+            if info["name"] == name or str(ch) == str(name):
+                return ch
+        raise KeyError(f"{self.path}: no channel {name!r}")
+
+    def records(self, channel: int = None):
+        """(t_ns, channel, data) を記録順に返す。channel を指定するとそのチャンネルだけ。"""
+        for rec in self._iter():
+            if channel is None or rec[1] == channel:
+                yield rec
+
+    def index(self) -> np.ndarray:
+        """全レコードの (t_ns, channel, size) を構造化配列で返す (集計用)。"""
+        rows = [(t, ch, len(d)) for t, ch, d in self._iter()]
+        return np.array(rows, dtype=[("t_ns", "<u8"), ("channel", "<u2"), ("size", "<u4")])
+
+    def summary(self, gap_ms: float = 100.0) -> dict:
+        """チャンネルごとの件数 / バイト数 / 長さと、gap_ms 以上あいた箇所。"""
+        idx = self.index()
+        result = {"meta": self.meta, "truncated": self.truncated, "channels": {}}
+        for ch, info in self.channels.items():
+            rows = idx[idx["channel"] == ch]
+            entry = {"name": info["name"], "records": int(len(rows)),
+                     "bytes": int(rows["size"].sum()), "duration_s": 0.0,
+                     "max_gap_ms": 0.0, "gaps": []}
+            if len(rows) > 1:
+                t = rows["t_ns"].astype(np.int64)
+                dt_ms = np.diff(t) / 1e6
+                entry["duration_s"] = float(t[-1] - t[0]) / 1e9
+                entry["max_gap_ms"] = float(dt_ms.max())
+                entry["bytes_per_s"] = entry["bytes"] / max(entry["duration_s"], 1e-9)
+                for i in np.flatnonzero(dt_ms >= gap_ms):
+                    entry["gaps"].append({"at_s": float(t[i] - t[0]) / 1e9,
+                                          "ms": float(dt_ms[i])})
+            result["channels"][ch] = entry
+        return result
+
+    def close(self) -> None:
+        self._view.release()
+        if isinstance(self._map, mmap.mmap):
+            try:
+                self._map.close()
+            except BufferError:   # records() の view がまだ残っている。GC に任せる
+                pass
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def print_summary(path, gap_ms: float = 100.0) -> None:
+    with CaptureReader(path) as reader:
+        s = reader.summary(gap_ms)
+    print(f"{path}: {s['meta']}" + ("  (truncated)" if s["truncated"] else ""))
+    for ch, e in s["channels"].items():
+        print(f"  [{ch}] {e['name']}: {e['records']} records, {e['bytes']} B, "
+              f"{e['duration_s']:.2f} s, {e.get('bytes_per_s', 0):.0f} B/s, "
+              f"max gap {e['max_gap_ms']:.1f} ms")
+        for g in e["gaps"]:
+            print(f"      gap {g['ms']:.1f} ms at {g['at_s']:.3f} s")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="inspect capture files (self-check without args)")
+    parser.add_argument("files", nargs="*")
+    parser.add_argument("--gap", type=float, default=100.0, help="report gaps longer than this [ms]")
+    args = parser.parse_args()
+    if args.files:
+        for path in args.files:
+            print_summary(path, args.gap)
+        raise SystemExit(0)
+
+    # 書いたものがそのまま読めること、書きかけの末尾を読み飛ばすこと
+    import os
+    import tempfile
+
+    from .synth import adpcm_packets
+
+    packets = adpcm_packets(300, payload_bytes=256, seed=6)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "test.nelcap")
+        with CaptureWriter(path, meta={"source": "selfcheck"}) as w:
+            a = w.channel("AA:BB", kind="ble")
+            b = w.channel("CC:DD", kind="ble")
+            assert w.channel("AA:BB") == a
+            for i, p in enumerate(packets):
+                w.write(a if i % 3 else b, p, t_ns=i * 32_000_000 + (500_000_000 if i == 200 else 0))
+        with CaptureReader(path) as r:
+            got = [(t, ch, bytes(d)) for t, ch, d in r.records()]
+            s = r.summary(gap_ms=100)
+        assert [d for _, _, d in got] == [bytes(p) for p in packets]
+        assert r.channels[b]["kind"] == "ble" and not r.truncated
+        assert s["channels"][a]["records"] + s["channels"][b]["records"] == len(packets)
+        assert len(s["channels"][a]["gaps"]) == 1, s["channels"][a]
+
+        with open(path, "ab") as f:
+            f.write(RECORD.pack(0, a, 100) + b"x" * 10)   # 書きかけで落ちた
+        with CaptureReader(path) as r:
+            assert sum(1 for _ in r.records()) == len(packets) and r.truncated
+        print(f"{len(packets)} records in {os.path.getsize(path)} bytes "
+              f"({RECORD.size} B/record overhead): OK")
@@ -0,0 +1,422 @@
+"""受信 CLI: transport → (Pipeline) → codec → sink をフラグで組み合わせる。
+
+    python -m nelrx ble                                     # ble_mic_ok と同じ
+    python -m nelrx ble --codec adpcm --policy drop-newest  # ble_mic_default / butsugire 相当
+    python -m nelrx serial --port /dev/cu.usbmodem11101     # serial_mic_encode (フレーム付き)
+    python -m nelrx serial --port ... --codec pcm16         # serial_mic_default
+    python -m nelrx replay dump.bin --speed 0 --sink null --json result.json
+    python -m nelrx ble --capture cat.nelcap                # 受信したままを記録しておき
+    python -m nelrx replay cat.nelcap --speed 4             # あとで 4 倍速で流し直す
+
+1 秒ごとに受信量 / デコード量 / キュー / 欠落を表示し、終了時に集計
+(samples/s、実時間の何倍か、ドロップ数など) を出すので、構成ごとの比較に使える。
+
+起動を速くするため、numpy / sounddevice を使う codec と sink はここでは import せず、
+BLE ではスキャン / 接続を待っている間に別スレッドで用意する。前回つないだ
+アドレスには直接つなぐ (nelrx.connect)。起動から最初のサンプルがデコードされる
+までの時間は集計の startup_s に入る (python -m nelrx.startup で測る)。
+BLE はリンクが切れてもつなぎ直して受信を続け (--no-reconnect で終了)、sink は
+そのまま使い続ける。切れていた時間は集計の transport_stats.downtime_s に入る。
+接続後に MTU / PHY を要求して --probe 秒スループットを測り、パイプラインの
+大きさをその実測値から決める (値は transport_stats.link)。
+
+--metrics-log / --metrics-json / --metrics-port を付けると、受信量・seq の欠落・
+デコード時間・キューの深さ・underrun・再接続を nelrx.metrics で定期的に出す
+(Prometheus は http://127.0.0.1:PORT/metrics)。
+"""
+import argparse
+import asyncio
+import json
+import logging
+import sys
+import time
+
+from .ble import DEVICE_NAME, UART_SERVICE_UUID, UART_TX_CHAR_UUID
+from .metrics import TIME_EVERY
+from .pipeline import BLOCK, DROP_OLDEST, POLICIES, Pipeline
+
+log = logging.getLogger("nelrx.cli")
+
+# import した時刻 (起動時間の基準。インタプリタ自体の起動は含まない)
+STARTED = time.perf_counter()
+
+SINKS = ("speaker", "wav", "null", "stats")
+CODECS = ("adpcm", "adpcm-hdr", "pcm16")     # codec.CODECS と同じ (--help で numpy を読まないため)
+DEFAULT_FS = {"ble": 8000, "serial": 16000, "replay": 16000}
+
+
+class Receiver:
+    """transport / codec / sink をつなぎ、カウンタを集める。"""
+
+    def __init__(self, transport, codec, sink, queue: int = 64, slot_size: int = 512,
+                 policy: str = DROP_OLDEST, inline: bool = False, samplerate: int = 8000):
+        self.transport = transport
+        self.codec = codec
+        self.sink = sink
+        self.samplerate = samplerate
+        self.bytes = 0
+        self.packets = 0
+        self.samples = 0
+        self.pipeline = None if inline else Pipeline(
+            self._handle, capacity=queue, slot_size=slot_size, policy=policy, name="nelrx-decode")
+        self._push = self._handle if inline else self.pipeline.push
+        self._started = None
+        self._finished = None
+        self.first_sample = None      # 最初のサンプルがデコードされた時刻 (perf_counter)
+        self.first_sample_at = None   # 同じく time.time() (別プロセスから測る用)
+        self.metrics = None
+        self._decode_hist = None
+        self._decoded = 0
+        if hasattr(transport, "on_reconnect"):
+            transport.on_reconnect = self.resync
+
+    def instrument(self, registry):
+        """registry (metrics.MetricsRegistry) に受信 / デコード / キュー / 出力 / 再接続を出す。"""
+        from .metrics import ReceiverMetrics
+        m = self.metrics = ReceiverMetrics(registry, counts=self)
+        if self.pipeline is not None:
+            m.watch_pipeline(self.pipeline)
+        decoder = getattr(self.codec, "decoder", None)
+        if decoder is not None:
+            m.watch_decoder(decoder)
+        m.watch_sink(self.sink)
+        supervisor = getattr(self.transport, "supervisor", None)
+        if supervisor is not None:
+            m.watch_link(supervisor)
+        self._decode_hist = m.decode_seconds
+        return m
+
+    def _handle(self, data) -> None:
+        if not len(data):
+            # resync() の目印。切れる前のパケットをデコードし終えてから codec をやり直す
+            self.codec.resync()
+            return
+        self._decoded += 1
+        if self._decode_hist is None or self._decoded % TIME_EVERY:
+            n = self.codec.decode(data, self.sink.write)
+        else:
+            t0 = time.perf_counter()
+            n = self.codec.decode(data, self.sink.write)
+            self._decode_hist.observe(time.perf_counter() - t0)
+        if n and self.first_sample is None:
+            self.first_sample = time.perf_counter()
+            self.first_sample_at = time.time()
+            log.info("first sample %.0f ms after start", (self.first_sample - STARTED) * 1e3)
+        self.samples += n
+
+    def push(self, data) -> None:
+        self.bytes += len(data)
+        self.packets += 1
+        self._push(data)
+
+    def resync(self) -> None:
+        """受信が途切れた (BLE の再接続)。sink はそのままで、次のパケットからデコードし直す。"""
+        self._push(b"")
+
+    async def run(self, duration: float = None, report_interval: float = 1.0) -> None:
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        if duration:
+            loop.call_later(duration, stop.set)
+        reporter = asyncio.create_task(self._report_loop(report_interval)) if report_interval else None
+        self._started = time.perf_counter()
+        if self.pipeline is not None:
+            self.pipeline.start()
+        try:
+            await self.transport.run(self.push, stop)
+        finally:
+            if self.pipeline is not None:
+                # 溜まっている分を処理し終えてから止める (スレッドで待つ)
+                await asyncio.to_thread(self.pipeline.stop, 30.0)
+            self._finished = time.perf_counter()
+            if reporter is not None:
+                reporter.cancel()
+            self.sink.close()
+
+    async def _report_loop(self, interval: float) -> None:
+        last = (time.perf_counter(), 0, 0, 0)
+        while True:
+            await asyncio.sleep(interval)
+            now = time.perf_counter()
+            t0, b0, p0, s0 = last
+            dt = now - t0
+            line = (f"RX {(self.bytes - b0) / dt:.0f} B/s {(self.packets - p0) / dt:.1f} pkt/s"
+                    f" → {(self.samples - s0) / dt:.0f} samples/s")
+            if self.pipeline is not None:
+                st = self.pipeline.stats()
+                line += (f" | queue {st['depth']} (max {st['max_depth']})"
+                         f" drop {st['dropped_newest'] + st['dropped_oldest']}")
+            cs = self.codec.stats()
+            if "lost" in cs:
+                line += f" | lost {cs['lost']} ({cs['loss_rate']:.1%})"
+            log.info(line)
+            last = (now, self.bytes, self.packets, self.samples)
+
+    def summary(self) -> dict:
+        end = self._finished or time.perf_counter()
+        elapsed = end - self._started if self._started else 0.0
+        sps = self.samples / elapsed if elapsed else 0.0
+        result = {
+            "transport": self.transport.name,
+            "codec": self.codec.name,
+            "pipeline": self.pipeline.ring.policy if self.pipeline is not None else "inline",
+            "samplerate": self.samplerate,
+            "elapsed_s": elapsed,
+            "bytes": self.bytes,
+            "packets": self.packets,
+            "samples": self.samples,
+            "samples_per_s": sps,
+            "realtime_x": sps / self.samplerate,
+            "startup_s": self.first_sample - STARTED if self.first_sample else None,
+            "first_sample_at": self.first_sample_at,
+            "transport_stats": self.transport.stats(),
+            "codec_stats": self.codec.stats(),
+        }
+        if self.pipeline is not None:
+            result["pipeline_stats"] = self.pipeline.stats()
+        sinks = getattr(self.sink, "sinks", (self.sink,))
+        result["sink_stats"] = {type(s).__name__: s.stats() for s in sinks if hasattr(s, "stats")}
+        return result
+
+
+# --------- 組み立て ---------
+def make_sink(names, args):
+    from .sinks import NullSink, StatsSink, TeeSink
+    sinks = []
+    for name in names:
+        if name == "speaker":
+            from .sinks import JitterSpeakerSink
+            sinks.append(JitterSpeakerSink(args.fs))
+        elif name == "wav":
+            from .recorder import WavRecorder
+            sinks.append(WavRecorder(args.out, args.fs, prefix=args.transport,
+                                     max_seconds=args.segment))
+        elif name == "null":
+            sinks.append(NullSink())
+        elif name == "stats":
+            sinks.append(StatsSink())
+    return sinks[0] if len(sinks) == 1 else TeeSink(*sinks)
+
+
+def make_reporter(args, receiver):
+    """--metrics-* が指定されていれば receiver を計測し、MetricsReporter を返す。"""
+    if not (args.metrics_log or args.metrics_json or args.metrics_port):
+        return None
+    from .metrics import (JsonFileExporter, LogExporter, MetricsRegistry, MetricsReporter,
+                          PrometheusExporter)
+    registry = MetricsRegistry()
+    receiver.instrument(registry)
+    exporters = []
+    if args.metrics_log:
+        exporters.append(LogExporter())
+    if args.metrics_json:
+        exporters.append(JsonFileExporter(args.metrics_json))
+    if args.metrics_port:
+        exporters.append(PrometheusExporter(registry, args.metrics_port))
+    return MetricsReporter(registry, exporters, args.metrics_interval)
+
+
+def make_codec(args):
+    from . import codec as codecs
+    return codecs.make_codec(args.codec)
+
+
+def make_transport(args, codec=None):
+    """codec は serial / replay で区切り方を決めるのに使う (ble では不要)。"""
+    if args.transport == "ble":
+        from .connect import DeviceCache
+        from .transports import BleTransport
+        cache = DeviceCache("" if args.no_cache else None)
+        # 既定の名前なら、名前がまだ届いていなくても UART サービスの広告で見つける
+        service_uuids = args.service or ([UART_SERVICE_UUID] if args.name == DEVICE_NAME else [])
+        return BleTransport(args.name, args.address, args.char, args.scan, cache=cache,
+                            connect_timeout=args.connect_timeout, service_uuids=service_uuids,
+                            reconnect=not args.no_reconnect, mtu=args.mtu, phy=args.phy,
+                            probe_s=args.probe)
+    if args.transport == "serial":
+        from .transports import SerialTransport
+        return SerialTransport(args.port, args.baud, framed=codec.framed, align=codec.align,
+                               max_chunk=args.slot_size)
+    from .capture import is_capture
+    if is_capture(args.path):
+        from .transports import CaptureTransport
+        return CaptureTransport(args.path, args.channel, args.speed)
+    from .transports import ReplayTransport
+    return ReplayTransport(args.path, framed=codec.framed, align=codec.align,
+                           chunk=args.slot_size,
+                           bytes_per_second=args.fs * codec.bytes_per_sample, speed=args.speed)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--codec", choices=CODECS,
+                        help="pcm16 / adpcm (headerless) / adpcm-hdr (4-byte state header, default)")
+    common.add_argument("--fs", type=int, help="sample rate (default: 8000 for ble, 16000 otherwise)")
+    common.add_argument("--sink", action="append", choices=SINKS,
+                        help="output; repeat to tee (default: speaker)")
+    common.add_argument("--out", default=".", help="directory for --sink wav")
+    common.add_argument("--segment", type=float, help="split WAV files every N seconds")
+    common.add_argument("--queue", type=int,
+                        help="pipeline capacity in packets (default: sized from the BLE probe, "
+                             "64 otherwise)")
+    common.add_argument("--slot-size", type=int,
+                        help="max bytes per packet/chunk (default: from the BLE MTU / probe, "
+                             "512 otherwise)")
+    common.add_argument("--policy", choices=POLICIES, default=None,
+                        help="when the queue is full (default: drop-oldest, block for replay)")
+    common.add_argument("--inline", action="store_true",
+                        help="decode on the receiving thread (no pipeline)")
+    common.add_argument("--duration", type=float, help="stop after N seconds")
+    common.add_argument("--report", type=float, default=1.0, help="report interval [s] (0 = off)")
+    common.add_argument("--json", help="write the final summary as JSON ('-' for stdout)")
+    common.add_argument("--capture", help="also record the raw received bytes to this capture file")
+    common.add_argument("--metrics-log", action="store_true",
+                        help="log all metrics every --metrics-interval seconds")
+    common.add_argument("--metrics-json", help="rewrite this JSON file with the metrics periodically")
+    common.add_argument("--metrics-port", type=int,
+                        help="serve Prometheus metrics on http://127.0.0.1:PORT/metrics")
+    common.add_argument("--metrics-interval", type=float, default=10.0,
+                        help="metrics export interval [s]")
+    common.add_argument("-v", "--verbose", action="store_true")
+
+    parser = argparse.ArgumentParser(prog="python -m nelrx", description=__doc__.split("\n")[0])
+    sub = parser.add_subparsers(dest="transport", required=True)
+
+    ble = sub.add_parser("ble", parents=[common], help="receive BLE notifications")
+    ble.add_argument("--name", default=DEVICE_NAME, help="device name to look for")
+    ble.add_argument("--address", help="connect to this address instead of scanning by name")
+    ble.add_argument("--char", default=UART_TX_CHAR_UUID, help="notify characteristic UUID")
+    ble.add_argument("--service", action="append",
+                     help="also match devices advertising this service UUID (repeatable)")
+    ble.add_argument("--scan", type=float, default=5.0,
+                     help="give up scanning after N seconds; stops at the first match [s]")
+    ble.add_argument("--connect-timeout", type=float, default=5.0,
+                     help="give up connecting after N seconds [s]")
+    ble.add_argument("--no-cache", action="store_true",
+                     help="always scan instead of trying the last connected address first")
+    ble.add_argument("--no-reconnect", action="store_true",
+                     help="stop when the link drops instead of reconnecting")
+    ble.add_argument("--mtu", type=int, default=247, help="ATT MTU to request where supported")
+    ble.add_argument("--phy", type=int, choices=(1, 2, 3), default=2,
+                     help="PHY to request where supported (1M / 2M / coded)")
+    ble.add_argument("--probe", type=float, default=0.5,
+                     help="measure throughput for N seconds after connecting and size the "
+                          "pipeline from it (0 = off) [s]")
+
+    serial = sub.add_parser("serial", parents=[common], help="read a serial port")
+    serial.add_argument("--port", required=True)
+    serial.add_argument("--baud", type=int, default=115200)
+
+    replay = sub.add_parser("replay", parents=[common],
+                            help="replay a capture file or a recorded byte stream")
+    replay.add_argument("path")
+    replay.add_argument("--speed", type=float, default=1.0,
+                        help="replay speed relative to real time (0 = as fast as possible)")
+    replay.add_argument("--channel", help="capture channel to replay (name or number)")
+    return parser
+
+
+def attach_capture(transport, capture) -> None:
+    if capture is not None:
+        transport.tap = capture.tap(capture.channel(transport.name, framed=transport.framed))
+
+
+async def start(args, capture=None) -> Receiver:
+    """transport / codec / sink を用意して Receiver を返す。
+
+    BLE では接続 (キャッシュのアドレス、だめならスキャン) とスループットの実測を
+    待つ間に、別スレッドで codec と sink を作る (numpy / sounddevice の import と
+    オーディオ出力のオープン)。--queue / --slot-size を省くと実測値から決める。
+    capture (capture.CaptureWriter) を渡すと、接続する前に transport.tap をつなぐ
+    (実測の間に届いた分も記録に残す)。接続できなければ ConnectionError。
+    """
+    if args.transport == "ble":
+        transport = make_transport(args)
+        attach_capture(transport, capture)
+        backends = asyncio.ensure_future(asyncio.to_thread(
+            lambda: (make_codec(args), make_sink(args.sink or ["speaker"], args))))
+        try:
+            await transport.open()
+        except (ConnectionError, asyncio.TimeoutError) as e:
+            _, sink = await backends
+            sink.close()
+            raise ConnectionError(str(e) or f"cannot connect to {args.address or args.name!r}")
+        codec, sink = await backends
+        sizes = transport.buffer_sizes()
+        args.queue = args.queue or sizes["capacity"]
+        args.slot_size = args.slot_size or sizes["slot_size"]
+        log.info("pipeline: %d slots x %d B (mtu %s, %.1f pkt/s measured)", args.queue,
+                 args.slot_size, transport.profile.mtu, transport.profile.packets_per_s or 0)
+    else:
+        codec = make_codec(args)
+        transport = make_transport(args, codec)
+        attach_capture(transport, capture)
+        sink = make_sink(args.sink or ["speaker"], args)
+    return Receiver(transport, codec, sink, queue=args.queue, slot_size=args.slot_size,
+                    policy=args.policy, inline=args.inline, samplerate=args.fs)
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format="%(asctime)s [%(levelname)s] %(message)s", datefmt="%H:%M:%S")
+    if args.transport == "replay":
+        from .capture import CaptureReader, is_capture
+        if is_capture(args.path):
+            # 記録したときの codec / サンプリングレートを既定値にする
+            with CaptureReader(args.path) as reader:
+                args.codec = args.codec or reader.meta.get("codec")
+                args.fs = args.fs or reader.meta.get("samplerate")
+    args.codec = args.codec or "adpcm-hdr"
+    args.fs = args.fs or DEFAULT_FS[args.transport]
+    if args.policy is None:
+        args.policy = BLOCK if args.transport == "replay" else DROP_OLDEST
+    if args.transport != "ble":
+        args.queue = args.queue or 64
+        args.slot_size = args.slot_size or 512
+
+    capture = None
+    if args.capture:
+        from .capture import CaptureWriter
+        capture = CaptureWriter(args.capture, meta={"codec": args.codec, "samplerate": args.fs})
+    receiver = None
+
+    async def run():
+        nonlocal receiver
+        receiver = await start(args, capture)
+        reporter = make_reporter(args, receiver)
+        if reporter is None:
+            await receiver.run(args.duration, args.report)
+            return
+        stop = asyncio.Event()
+        exporting = asyncio.create_task(reporter.run(stop))
+        try:
+            await receiver.run(args.duration, args.report)
+        finally:
+            stop.set()
+            await exporting
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        log.info("stopped by user")
+    except ConnectionError as e:
+        log.warning("%s", e)
+    finally:
+        if capture is not None:
+            capture.close()
+    if receiver is None:
+        return 1
+
+    summary = receiver.summary()
+    log.info("%s/%s/%s: %d packets, %d samples in %.2f s = %.0f samples/s (%.1fx real time)",
+             summary["transport"], summary["codec"], summary["pipeline"], summary["packets"],
+             summary["samples"], summary["elapsed_s"], summary["samples_per_s"],
+             summary["realtime_x"])
+    if args.json == "-":
+        json.dump(summary, sys.stdout, indent=2)
+        print()
+    elif args.json:
+        with open(args.json, "w") as f:
+            json.dump(summary, f, indent=2)
+    return 0
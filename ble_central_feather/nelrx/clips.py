@@ -0,0 +1,501 @@
+"""分割して送られてくる音声クリップ (FeatherSensor の audioChar) の組み立て。
+
+ファームは 1 秒分の ADPCM を [clipID (u8), seq (u8)] + 240 バイトの断片に分けて
+Notify する。ClipAssembler は
+
+- クリップごとに事前確保したバッファと受信ビットマップ (int のビット) を持ち、
+  断片ごとの処理は O(1) (欠けている断片の一覧は出力するときだけ作る)
+- 8bit の clipID を直近のクリップ番号から展開した通し番号 (number) で区別する
+  ので、256 個後に同じ clipID が来ても古い断片と混ざらない
+- timeout 秒なにも届かないクリップや、スロットが足りないときの一番古いクリップを
+  追い出す。partial=True なら min_fraction 以上届いていれば欠けたまま出力する
+
+出力は on_clip(Clip) で、デコード (欠けた断片の補間を含む) は ClipDecoder で行う
+(組み立てとデコードを別スレッドで回せるように分けてある)。ClipWriterPool に
+submit すると、デコードと WAV の書き出しをワーカー (スレッドかプロセス) で行い、
+Notify を受けるループを止めない。
+"""
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+
+import numpy as np
+
+from . import adpcm
+from .conceal import Concealer, FADE
+from .recorder import wav_header
+
+log = logging.getLogger("nelrx.clips")
+
+CLIP_ID_MOD = 256
+FRAG_HEADER_SIZE = 2
+
+# 出力の理由
+COMPLETE = "complete"
+TIMEOUT = "timeout"
+EVICTED = "evicted"
+FLUSHED = "flushed"
+
+
+class Clip:
+    """組み上がった (または途中で打ち切った) クリップ 1 つ。data は自前のコピー。"""
+
+    __slots__ = ("number", "clip_id", "data", "received", "frags", "frag_bytes",
+                 "first_seen", "last_seen", "reason")
+
+    def __init__(self, number, clip_id, data, received, frags, frag_bytes,
+                 first_seen, last_seen, reason):
+        self.number = number
+        self.clip_id = clip_id
+        self.data = data
+        self.received = received
+        self.frags = frags
+        self.frag_bytes = frag_bytes
+        self.first_seen = first_seen
+        self.last_seen = last_seen
+        self.reason = reason
+
+    @property
+    def complete(self) -> bool:
+        return self.received == (1 << self.frags) - 1
+
+    @property
+    def count(self) -> int:
+        return bin(self.received).count("1")
+
+    @property
+    def missing(self) -> list:
+        return [i for i in range(self.frags) if not (self.received >> i) & 1]
+
+    def __repr__(self):
+        return (f"Clip(#{self.number} id={self.clip_id} {self.count}/{self.frags} "
+                f"{self.reason})")
+
+
+class _Slot:
+    __slots__ = ("buf", "number", "clip_id", "received", "count", "first_seen", "last_seen")
+
+    def __init__(self, size: int):
+        self.buf = bytearray(size)
+        self.number = None
+
+
+class ClipAssembler:
+    """断片を受け取ってクリップに組み立て、on_clip(Clip) を呼ぶ。"""
+
+    def __init__(self, on_clip, frags_per_clip: int = 17, frag_bytes: int = 240,
+                 max_clips: int = 4, timeout: float = 3.0, partial: bool = False,
+                 min_fraction: float = 0.5, clock=time.monotonic):
+        self.on_clip = on_clip
+        self.frags = frags_per_clip
+        self.frag_bytes = frag_bytes
+        self.timeout = timeout
+        self.partial = partial
+        self.min_fraction = min_fraction
+        self.clock = clock
+        self._full = (1 << frags_per_clip) - 1
+        self._slots = [_Slot(frags_per_clip * frag_bytes) for _ in range(max_clips)]
+        self._active = {}           # number -> _Slot
+        self._last_number = None    # 直近に見たクリップの通し番号
+        self._finished = deque(maxlen=4 * max_clips)   # 最近出力 / 破棄したクリップの番号
+        self.fragments = 0
+        self.duplicates = 0
+        self.invalid = 0
+        self.stale = 0              # 出力済み / 追い出し済みのクリップに遅れて届いた断片
+        self.complete = 0
+        self.partials = 0
+        self.dropped = 0
+        self.timed_out = 0
+        self.evicted = 0
+
+    # --------- 通し番号 ---------
+    def _number(self, clip_id: int) -> int:
+        """8bit の clipID を、直近の番号に一番近い通し番号に展開する。"""
+        if self._last_number is None:
+            return clip_id
+        diff = (clip_id - self._last_number) % CLIP_ID_MOD
+        if diff >= CLIP_ID_MOD // 2:
+            diff -= CLIP_ID_MOD
+        return self._last_number + diff
+
+    # --------- 受信 ---------
+    def handle_notify(self, _, data) -> None:
+        """bleak の start_notify にそのまま渡せる形。"""
+        self.add(data)
+
+    def add(self, data) -> None:
+        now = self.clock()
+        self.expire(now)
+        if len(data) <= FRAG_HEADER_SIZE or data[1] >= self.frags:
+            self.invalid += 1
+            return
+        clip_id, seq = data[0], data[1]
+        number = self._number(clip_id)
+        slot = self._active.get(number)
+        if slot is None:
+            if number in self._finished or (self._last_number is not None
+                                            and number < self._last_number):
+                self.stale += 1          # 出力済み / 追い出し済みのクリップの断片
+                return
+            slot = self._open(number, clip_id, now)
+        if (slot.received >> seq) & 1:
+            self.duplicates += 1
+            return
+        self.fragments += 1
+        payload = memoryview(data)[FRAG_HEADER_SIZE:FRAG_HEADER_SIZE + self.frag_bytes]
+        start = seq * self.frag_bytes
+        slot.buf[start:start + len(payload)] = payload
+        if len(payload) < self.frag_bytes:   # 短い断片の残りは 0 (無音に近い) で埋める
+            slot.buf[start + len(payload):start + self.frag_bytes] = bytes(self.frag_bytes - len(payload))
+        slot.received |= 1 << seq
+        slot.count += 1
+        slot.last_seen = now
+        if slot.received == self._full:
+            self._finish(slot, COMPLETE)
+
+    def _open(self, number: int, clip_id: int, now: float) -> _Slot:
+        if self._last_number is None or number > self._last_number:
+            self._last_number = number
+        free = next((s for s in self._slots if s.number is None), None)
+        if free is None:
+            # 一番長く何も届いていないクリップを追い出す
+            free = min(self._active.values(), key=lambda s: s.last_seen)
+            self.evicted += 1
+            self._finish(free, EVICTED)
+        free.number = number
+        free.clip_id = clip_id
+        free.received = 0
+        free.count = 0
+        free.first_seen = free.last_seen = now
+        self._active[number] = free
+        return free
+
+    def expire(self, now: float = None) -> None:
+        """timeout 秒なにも届いていないクリップを打ち切る。"""
+        if not self._active:
+            return
+        now = self.clock() if now is None else now
+        for slot in [s for s in self._active.values() if now - s.last_seen > self.timeout]:
+            self.timed_out += 1
+            self._finish(slot, TIMEOUT)
+
+    def flush(self) -> None:
+        """組み立て中のクリップをすべて打ち切る (終了時)。"""
+        for slot in sorted(self._active.values(), key=lambda s: s.number):
+            self._finish(slot, FLUSHED)
+
+    def _finish(self, slot: _Slot, reason: str) -> None:
+        del self._active[slot.number]
+        self._finished.append(slot.number)
+        emit = True
+        if reason == COMPLETE:
+            self.complete += 1
+        elif self.partial and slot.count >= self.min_fraction * self.frags:
+            self.partials += 1
+        else:
+            emit = False
+            self.dropped += 1
+            log.debug("drop clip #%d (id %d): %d/%d fragments, %s", slot.number, slot.clip_id,
+                      slot.count, self.frags, reason)
+        if emit:
+            self.on_clip(Clip(slot.number, slot.clip_id, bytes(slot.buf), slot.received,
+                              self.frags, self.frag_bytes, slot.first_seen, slot.last_seen,
+                              reason))
+        slot.number = None
+
+    def stats(self) -> dict:
+        return {
+            "fragments": self.fragments,
+            "duplicates": self.duplicates,
+            "invalid": self.invalid,
+            "stale": self.stale,
+            "complete": self.complete,
+            "partial": self.partials,
+            "dropped": self.dropped,
+            "timed_out": self.timed_out,
+            "evicted": self.evicted,
+            "pending": len(self._active),
+        }
+
+
+class ClipDecoder:
+    """Clip を PCM (int16) にする。欠けた断片は Concealer で埋め、長さは変えない。
+
+    欠けた断片の後ろは ADPCM の状態が分からないので、直前の状態のまま
+    デコードを続ける (step_index が合ってくるまでの数ミリ秒は音が崩れる)。
+    carry_state=True なら、前のクリップが欠けなく続いていたときにその終わりの
+    状態から始める (エンコーダの状態をクリップをまたいで持ち越すファーム用)。
+    """
+
+    def __init__(self, strategy: str = FADE, carry_state: bool = False):
+        self.strategy = strategy
+        self.carry_state = carry_state
+        self.state = adpcm.AdpcmState()
+        self._out = np.zeros(0, dtype=np.int16)
+        self._prev = None           # (number, 欠けなく終わったか)
+        self.clips = 0
+        self.concealed = 0
+
+    def decode(self, clip: Clip) -> np.ndarray:
+        """clip.frags * clip.frag_bytes * 2 サンプルの配列を返す (呼び出し側のもの)。"""
+        frame = clip.frag_bytes * 2
+        total = clip.frags * frame
+        if self._out.size < total:
+            self._out = np.zeros(total, dtype=np.int16)
+        out = self._out[:total]
+        if not (self.carry_state and self._prev == (clip.number - 1, True)):
+            self.state.reset()
+        data = memoryview(clip.data)
+
+        if clip.complete:
+            self.state.decode_into(data, out)
+        else:
+            concealer = Concealer(self.strategy)
+            pos = 0
+
+            def put(pcm):
+                nonlocal pos
+                out[pos:pos + len(pcm)] = pcm
+                pos += len(pcm)
+
+            for i in range(clip.frags):
+                if (clip.received >> i) & 1:
+                    n = self.state.decode_into(data[i * clip.frag_bytes:(i + 1) * clip.frag_bytes],
+                                               out[pos:pos + frame])
+                    concealer.update(out[pos:pos + n])
+                    pos += n
+                else:
+                    concealer.conceal(1, frame, put)
+            self.concealed += concealer.concealed
+        self._prev = (clip.number, clip.complete)
+        self.clips += 1
+        return out.copy()
+
+    def stats(self) -> dict:
+        return {"clips": self.clips, "concealed_fragments": self.concealed}
+
+
+# --------- 書き出し ---------
+def write_clip_wav(path: str, clip: Clip, samplerate: int, strategy: str = FADE) -> tuple:
+    """clip をデコードして path に WAV で書く (ワーカーで動く)。(サンプル数, デコード秒, 書き込み秒) を返す。"""
+    t0 = time.perf_counter()
+    pcm = ClipDecoder(strategy).decode(clip)
+    t1 = time.perf_counter()
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(wav_header(samplerate, pcm.nbytes))
+        f.write(pcm.tobytes())
+    os.replace(tmp, path)   # 書きかけのファイルは見せない
+    return len(pcm), t1 - t0, time.perf_counter() - t1
+
+
+def _percentiles(ms: list) -> dict:
+    if not ms:
+        return {}
+    p50, p90, p99 = np.percentile(ms, (50, 90, 99))
+    return {"p50": float(p50), "p90": float(p90), "p99": float(p99), "max": float(max(ms))}
+
+
+class ClipWriterPool:
+    """組み上がったクリップのデコードと WAV 書き出しをワーカーに任せる。
+
+    同時に抱えるクリップは max_pending 個まで。あふれたら submit は
+    timeout 秒待ち (0 なら待たない)、それでも空かなければ False を返して捨てる
+    (Notify のコールバックから呼ぶなら待たないこと)。
+    latency は最後の断片が届いてから (Clip.last_seen) ファイルを閉じ終わるまで。
+    on_saved(clip, path, info) は書き終わるたびにワーカー側のスレッドから呼ばれる。
+    processes=True ならプロセスプールを使う (carry_state はできない。クリップごとに独立)。
+    """
+
+    def __init__(self, directory=".", samplerate: int = 16000, workers: int = 2,
+                 max_pending: int = 4, processes: bool = False, prefix: str = "clip",
+                 strategy: str = FADE, on_saved=None, clock=time.monotonic):
+        self.directory = str(directory)
+        os.makedirs(self.directory, exist_ok=True)
+        self.samplerate = samplerate
+        self.prefix = prefix
+        self.strategy = strategy
+        self.on_saved = on_saved
+        self.clock = clock
+        pool = ProcessPoolExecutor if processes else ThreadPoolExecutor
+        self._executor = pool(max_workers=workers)
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self.max_pending = max_pending
+        self.submitted = 0
+        self.saved = 0
+        self.rejected = 0
+        self.failed = 0
+        self.waited = 0          # 空きを待ったクリップ数
+        self.pending = 0
+        self.max_seen_pending = 0
+        self._latency_ms = deque(maxlen=1000)
+        self._decode_ms = deque(maxlen=1000)
+        self._write_ms = deque(maxlen=1000)
+
+    def path_for(self, clip: Clip) -> str:
+        ts = datetime.now().strftime("%Y%m%d_%H%M%S_%f")[:-3]
+        return os.path.join(self.directory, f"{self.prefix}_{clip.clip_id}_{ts}_{clip.number}.wav")
+
+    def submit(self, clip: Clip, timeout: float = 0.0) -> bool:
+        if not self._slots.acquire(blocking=False):
+            if not timeout or not self._slots.acquire(timeout=timeout):
+                with self._lock:
+                    self.rejected += 1
+                log.warning("writer pool full (%d pending): drop clip #%d", self.max_pending,
+                            clip.number)
+                return False
+            with self._lock:
+                self.waited += 1
+        path = self.path_for(clip)
+        with self._lock:
+            self.submitted += 1
+            self.pending += 1
+            self.max_seen_pending = max(self.max_seen_pending, self.pending)
+        future = self._executor.submit(write_clip_wav, path, clip, self.samplerate, self.strategy)
+        future.add_done_callback(lambda f: self._done(f, clip, path))
+        return True
+
+    def _done(self, future, clip: Clip, path: str) -> None:
+        latency_ms = (self.clock() - clip.last_seen) * 1000.0
+        self._slots.release()
+        try:
+            samples, decode_s, write_s = future.result()
+        except Exception as e:
+            with self._lock:
+                self.pending -= 1
+                self.failed += 1
+            log.error("clip #%d: %s", clip.number, e)
+            return
+        with self._lock:
+            self.pending -= 1
+            self.saved += 1
+            self._latency_ms.append(latency_ms)
+            self._decode_ms.append(decode_s * 1000.0)
+            self._write_ms.append(write_s * 1000.0)
+        if self.on_saved is not None:
+            self.on_saved(clip, path, {"samples": samples, "latency_ms": latency_ms,
+                                       "decode_ms": decode_s * 1000.0,
+                                       "write_ms": write_s * 1000.0})
+
+    def close(self, wait: bool = True) -> None:
+        self._executor.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "submitted": self.submitted,
+                "saved": self.saved,
+                "rejected": self.rejected,
+                "failed": self.failed,
+                "waited": self.waited,
+                "pending": self.pending,
+                "max_pending": self.max_seen_pending,
+                "latency_ms": _percentiles(list(self._latency_ms)),
+                "decode_ms": _percentiles(list(self._decode_ms)),
+                "write_ms": _percentiles(list(self._write_ms)),
+            }
+
+
+def fragment(data: bytes, clip_id: int, frag_bytes: int = 240) -> list:
+    """ファームと同じ形に分ける (テスト / リプレイ用)。"""
+    return [bytes((clip_id % CLIP_ID_MOD, seq)) + data[off:off + frag_bytes]
+            for seq, off in enumerate(range(0, len(data), frag_bytes))]
+
+
+if __name__ == "__main__":
+    # clipID の一周、順序の入れ替え、欠落、古いクリップの混入を混ぜて流す
+    import random
+
+    from .synth import make_signal
+
+    FRAGS, FB = 17, 240
+    rng = random.Random(3)
+    n_clips = 600
+    samples = FRAGS * FB * 2
+    pcm = make_signal("speech", n_clips * samples, 16000, seed=3)
+    encoded = [adpcm.encode(pcm[i * samples:(i + 1) * samples])[0] for i in range(n_clips)]
+
+    t = [0.0]
+    out = []
+    asm = ClipAssembler(out.append, FRAGS, FB, max_clips=4, timeout=3.0, partial=True,
+                        clock=lambda: t[0])
+    lost = {}
+    stream = []
+    for number, data in enumerate(encoded):
+        frags = fragment(data, number, FB)
+        if number % 50 == 7:     # 1 断片欠ける
+            k = rng.randrange(FRAGS)
+            lost[number] = k
+            del frags[k]
+        if number % 97 == 5:     # 大半が欠けたクリップ (min_fraction 未満で捨てる)
+            lost[number] = None
+            frags = frags[:3]
+        if number == 400:
+            frags.append(frags[0])   # 組み立て中の重複
+        rng.shuffle(frags)       # クリップ内で順番が入れ替わる
+        stream.append(frags)
+    for number, frags in enumerate(stream):
+        for f in frags:
+            t[0] += 0.055
+            asm.add(f)
+        if number == 300:
+            asm.add(bytes((296 % 256, 3)) + b"\x00" * FB)   # 出力済みの #296 の断片が今ごろ届いた
+            asm.add(bytes((300 % 256, 0)) + b"\x00" * FB)   # 組み上がった後に届いた重複
+    asm.flush()
+
+    by_number = {c.number: c for c in out}
+    assert asm.stale == 2 and asm.duplicates == 1, asm.stats()
+    decoder = ClipDecoder()
+    for number, data in enumerate(encoded):
+        if lost.get(number, 0) is None:
+            assert number not in by_number
+            continue
+        clip = by_number[number]
+        assert clip.clip_id == number % 256
+        got = decoder.decode(clip)
+        ref, _ = adpcm.decode(data, (0, 0))
+        if number in lost:
+            k = lost[number]
+            assert clip.missing == [k] and clip.reason in (TIMEOUT, EVICTED, FLUSHED), clip
+            frame = FB * 2
+            assert np.array_equal(got[:k * frame], ref[:k * frame])
+        else:
+            assert clip.complete and np.array_equal(got, ref), number
+    print(f"{len(out)} clips out of {n_clips}: {asm.stats()} {decoder.stats()}: OK")
+
+    # ワーカーで書いた WAV が同じ PCM になること、あふれたら捨てる / 待つこと
+    import tempfile
+    import wave
+
+    clips = [c for c in out if c.number < 40]
+    log.setLevel(logging.ERROR)   # 捨てたときの警告はここでは想定どおり
+    for processes in (False, True):
+        with tempfile.TemporaryDirectory() as tmp:
+            saved = {}
+            pool = ClipWriterPool(tmp, workers=2, max_pending=4, processes=processes,
+                                  clock=lambda: t[0],
+                                  on_saved=lambda c, path, info: saved.__setitem__(c.number, path))
+            with pool:
+                accepted = [c for c in clips if pool.submit(c)]              # 待たない
+                waited = [c for c in clips if pool.submit(c, timeout=10.0)]  # 空くまで待つ
+            st = pool.stats()
+            assert 4 <= len(accepted) < len(clips) and len(waited) == len(clips), st
+            assert st["rejected"] == len(clips) - len(accepted) and st["max_pending"] <= 4, st
+            for c in clips:
+                with wave.open(saved[c.number], "rb") as wf:
+                    pcm = np.frombuffer(wf.readframes(wf.getnframes()), dtype="<i2")
+                assert np.array_equal(pcm, ClipDecoder().decode(c))
+            print(f"{'process' if processes else 'thread'} pool: {st['saved']} saved, "
+                  f"{st['rejected']} rejected, {st['waited']} waited, "
+                  f"decode p50 {st['decode_ms']['p50']:.2f} ms, write p50 {st['write_ms']['p50']:.2f} ms: OK")
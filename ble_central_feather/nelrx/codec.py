@@ -0,0 +1,113 @@
+"""受信したパケット / チャンクを PCM にする部分 (CLI で差し替える単位)。
+
+どの codec も ``decode(data, write) -> サンプル数`` と ``stats()`` を持つ。
+``resync()`` は受信が途切れたあと (BLE の再接続など) に呼び、続きとしてではなく
+次に届いたデータからデコードし直す。
+write には int16 の配列を渡す (使い回しのバッファなので sink 側でコピーすること)。
+
+- pcm16     : 生の int16 LE (serial_mic_default)
+- adpcm     : ヘッダなし ADPCM。状態をチャンクをまたいで持ち越す (serial_mic_encode の旧形式, ble_mic_default)
+- adpcm-hdr : 4 バイトヘッダ付き ADPCM。欠落を補間する (ble_mic_ok, serialframe)
+"""
+import numpy as np
+
+from . import adpcm
+from .conceal import ConcealingDecoder, FADE
+
+
+class Pcm16Codec:
+    name = "pcm16"
+    framed = False
+    align = 2
+    bytes_per_sample = 2.0
+
+    def __init__(self):
+        self._carry = None   # 奇数バイトで届いたときの端数
+        self.samples = 0
+
+    def decode(self, data, write) -> int:
+        data = memoryview(data).cast("B")
+        if self._carry is not None:
+            data = memoryview(bytes((self._carry,)) + bytes(data))
+            self._carry = None
+        if len(data) & 1:
+            self._carry = data[-1]
+            data = data[:-1]
+        if not data:
+            return 0
+        pcm = np.frombuffer(data, dtype="<i2")
+        write(pcm)
+        self.samples += len(pcm)
+        return len(pcm)
+
+    def resync(self) -> None:
+        self._carry = None
+
+    def stats(self) -> dict:
+        return {"samples": self.samples}
+
+
+class AdpcmCodec:
+    name = "adpcm"
+    framed = False
+    align = 1
+    bytes_per_sample = 0.5
+
+    def __init__(self, max_bytes: int = 4096):
+        self.state = adpcm.AdpcmState()
+        self._out = np.zeros(max_bytes * 2, dtype=np.int16)
+        self.samples = 0
+
+    def decode(self, data, write) -> int:
+        if 2 * len(data) > self._out.size:
+            self._out = np.zeros(2 * len(data), dtype=np.int16)
+        n = self.state.decode_into(data, self._out)
+        if n:
+            write(self._out[:n])
+        self.samples += n
+        return n
+
+    def resync(self) -> None:
+        # ヘッダがないので続きの状態はわからない。初期状態から (しばらく音が崩れる)
+        self.state.reset()
+
+    def stats(self) -> dict:
+        return {"samples": self.samples}
+
+
+class AdpcmHeaderCodec:
+    name = "adpcm-hdr"
+    framed = True     # シリアル / ファイルでは serialframe 形式で届く
+    align = 1
+    bytes_per_sample = 0.5
+
+    def __init__(self, conceal: str = FADE):
+        self.decoder = ConcealingDecoder(conceal)
+        self.samples = 0
+
+    def decode(self, data, write) -> int:
+        n = self.decoder.decode_packet(data, write)
+        self.samples += n
+        return n
+
+    def resync(self) -> None:
+        self.decoder.resync()
+
+    def stats(self) -> dict:
+        st = self.decoder.stats()
+        st["samples"] = self.samples
+        return st
+
+
+CODECS = {
+    Pcm16Codec.name: Pcm16Codec,
+    AdpcmCodec.name: AdpcmCodec,
+    AdpcmHeaderCodec.name: AdpcmHeaderCodec,
+}
+
+
+def make_codec(name: str):
+    try:
+        return CODECS[name]()
+    except KeyError:
+        raise ValueError(f"unknown codec: {name}") from None
@@ -0,0 +1,212 @@
+"""パケットの欠落検出 (seq 8bit) と欠落区間の補間。
+
+ble_mic_ok 形式のパケットはヘッダに seq / predictor / step_index を持つので、
+欠落しても次のパケットからデコードはそのまま再開できる。足りないのは
+欠けた時間分のサンプルだけなので、それを Concealer で埋めて sink に渡す
+サンプル列の長さ (= 時間) を保つ。
+"""
+import numpy as np
+
+from . import adpcm
+
+SEQ_MOD = 256
+
+# 補間方法
+SILENCE = "silence"   # 0 で埋める
+REPEAT = "repeat"     # 直前のフレームを繰り返す
+FADE = "fade"         # 直前のフレームを繰り返しつつ 0 に向けてフェードアウト
+STRATEGIES = (SILENCE, REPEAT, FADE)
+
+
+class SeqTracker:
+    """8bit seq の連番チェック。欠落 / 順序入れ替わり / 重複を数える。"""
+
+    def __init__(self, max_gap: int = 64):
+        self.max_gap = max_gap   # これより大きい飛びは欠落ではなく再同期とみなす
+        self.expected = None
+        self.received = 0
+        self.lost = 0
+        self.reordered = 0
+        self.duplicates = 0
+        self.resyncs = 0
+
+    def observe(self, seq: int) -> int:
+        """seq を 1 つ受け取り、その直前に欠けたパケット数を返す。
+
+        遅れて届いた / 重複したパケットは -1 (捨てる)。遅れて届いたものは
+        その時点で既に補間済みなので、lost と reordered の両方に数えられる。
+        """
+        if self.expected is None:
+            self.expected = (seq + 1) % SEQ_MOD
+            self.received += 1
+            return 0
+
+        diff = (seq - self.expected) % SEQ_MOD
+        if diff >= SEQ_MOD // 2:
+            # expected より後ろ = 既に補間済みの区間に届いたもの
+            if diff == SEQ_MOD - 1:
+                self.duplicates += 1
+            else:
+                self.reordered += 1
+            return -1
+
+        self.received += 1
+        self.expected = (seq + 1) % SEQ_MOD
+        if diff > self.max_gap:
+            self.resyncs += 1
+            return 0
+        self.lost += diff
+        return diff
+
+    def reset(self) -> None:
+        """次の seq を新しい起点にする (再接続のあと。切れていた間は欠落に数えない)。"""
+        if self.expected is not None:
+            self.resyncs += 1
+        self.expected = None
+
+    @property
+    def loss_rate(self) -> float:
+        total = self.received + self.lost
+        return self.lost / total if total else 0.0
+
+    def stats(self) -> dict:
+        return {
+            "received": self.received,
+            "lost": self.lost,
+            "reordered": self.reordered,
+            "duplicates": self.duplicates,
+            "resyncs": self.resyncs,
+            "loss_rate": self.loss_rate,
+        }
+
+
+class Concealer:
+    """欠けたフレームの代わりになる PCM を作る。"""
+
+    def __init__(self, strategy: str = FADE, fade_frames: int = 4):
+        if strategy not in STRATEGIES:
+            raise ValueError(f"unknown concealment strategy: {strategy}")
+        self.strategy = strategy
+        self.fade_frames = fade_frames
+        self.last = None      # 最後に正しく受信したフレーム (自前のバッファにコピーして持つ)
+        self.concealed = 0    # 補間したフレーム数
+        self._last_buf = np.zeros(0, dtype=np.int16)
+        self._work = np.zeros(0, dtype=np.int16)
+
+    def update(self, pcm) -> None:
+        # 呼び出し側の出力バッファは使い回されるのでコピーしておく
+        n = len(pcm)
+        if self._last_buf.size < n:
+            self._last_buf = np.zeros(n, dtype=np.int16)
+            self._work = np.zeros(n, dtype=np.int16)
+        if self.last is None or len(self.last) != n:
+            self.last = self._last_buf[:n]
+        self.last[:] = pcm
+
+    def conceal(self, n_frames: int, frame_len: int, write) -> None:
+        """n_frames 個ぶんのフレームを write に渡す。渡す配列は呼び出し中だけ有効。"""
+        self.concealed += n_frames
+        last = self.last
+        if self.strategy == SILENCE or last is None or len(last) != frame_len:
+            if self._work.size < frame_len:
+                self._work = np.zeros(frame_len, dtype=np.int16)
+            work = self._work[:frame_len]
+            work[:] = 0
+            for _ in range(n_frames):
+                write(work)
+            return
+        if self.strategy == REPEAT:
+            for _ in range(n_frames):
+                write(last)
+            return
+
+        # FADE: fade_frames フレームかけて直線的に 0 へ。その先は無音
+        total = self.fade_frames * frame_len
+        work = self._work[:frame_len]
+        for i in range(n_frames):
+            start = i * frame_len
+            if start >= total:
+                work[:] = 0
+            else:
+                gain = np.clip(1.0 - np.arange(start + 1, start + frame_len + 1) / total, 0.0, 1.0)
+                np.multiply(last, gain, out=work, casting="unsafe")
+            write(work)
+
+
+class ConcealingDecoder:
+    """ヘッダ付きパケットをデコードし、欠落分を補間しながら write に渡す。
+
+    デコード結果は事前確保した出力バッファに書くので、欠落のない定常状態では
+    パケットごとの配列確保はない。write に渡す配列はバッファの view で、
+    次のパケットで上書きされる (sink 側でコピーすること)。
+    gap_hist (metrics.Histogram) を入れておくと、欠落のたびに飛んだパケット数を記録する。
+    """
+
+    def __init__(self, strategy: str = FADE, max_gap: int = 64, max_payload: int = 512):
+        self.state = adpcm.AdpcmState()
+        self.tracker = SeqTracker(max_gap)
+        self.concealer = Concealer(strategy)
+        self.gap_hist = None
+        self._out = np.zeros(max_payload * 2, dtype=np.int16)
+        self._frame = self._out[:0]
+
+    def decode_packet(self, packet, write) -> int:
+        """1 パケット分を [補間フレーム..., 今回のフレーム] の順に write へ渡す。
+
+        write に渡したサンプル数を返す。捨てたパケットなら 0。
+        """
+        if len(packet) < adpcm.HEADER_SIZE:
+            return 0
+        gap = self.tracker.observe(packet[0])
+        if gap < 0:
+            return 0
+        payload = memoryview(packet)[adpcm.HEADER_SIZE:]
+        if self._out.size < 2 * len(payload):
+            self._out = np.zeros(2 * len(payload), dtype=np.int16)
+        self.state.reset_from_header(packet)
+        n = self.state.decode_into(payload, self._out)
+        if len(self._frame) != n:
+            self._frame = self._out[:n]
+        pcm = self._frame
+        if gap:
+            if self.gap_hist is not None:
+                self.gap_hist.observe(gap)
+            self.concealer.conceal(gap, n, write)
+        self.concealer.update(pcm)
+        write(pcm)
+        return n * (gap + 1)
+
+    def resync(self) -> None:
+        """再接続したときに呼ぶ。次に届いたパケットのヘッダから (seq も状態も) やり直す。
+
+        切れていた時間は seq (8bit) から求められないので補間しない。
+        """
+        self.tracker.reset()
+
+    def stats(self) -> dict:
+        st = self.tracker.stats()
+        st["concealed"] = self.concealer.concealed
+        return st
+
+
+if __name__ == "__main__":
+    # 擬似的に欠落させたパケット列で検出精度と出力の連続性を確認する
+    from .synth import adpcm_packets, lossy
+
+    packets = adpcm_packets(5000, payload_bytes=128, seed=1)
+    index = {id(p): i for i, p in enumerate(packets)}
+    frame_len = 128 * 2
+    for loss in (0.0, 0.01, 0.05, 0.2):
+        for strategy in STRATEGIES:
+            dec = ConcealingDecoder(strategy)
+            sent = list(lossy(packets, loss=loss, burst=0.3, reorder=0.01, duplicate=0.005, seed=2))
+            out = []
+            samples = sum(dec.decode_packet(p, lambda f: out.append(f.copy())) for p in sent)
+            assert samples == sum(map(len, out))
+            st = dec.stats()
+            # 最初に届いたものから最後に届いたものまでの時間長が保たれているか
+            span = max(index[id(p)] for p in sent) - index[id(sent[0])] + 1
+            print(f"loss={loss:.2f} {strategy:7s} received={st['received']} lost={st['lost']} "
+                  f"(injected {len(packets) - len(set(map(id, sent)))}) "
+                  f"reordered={st['reordered']} dup={st['duplicates']} "
+                  f"samples={samples} expected={span * frame_len}")
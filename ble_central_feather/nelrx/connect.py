@@ -0,0 +1,204 @@
+"""前回つないだアドレスへ直接接続し、だめならスキャンする。
+
+これまでの受信スクリプトは起動のたびに ``BleakScanner.discover(timeout=5.0)`` で
+5 秒待ってから接続していたので、落ちて再起動するたびに数秒が無駄になる。
+ここでは名前 (name_filter) ごとに最後に接続できたアドレスを DeviceCache に
+覚えておき、次回は
+
+    1. 覚えているアドレスに直接つなぐ (connect_timeout 秒まで)
+    2. だめなら名前でスキャンし、最初に見つかった時点でスキャンをやめてつなぐ
+
+の順に試す。スキャンは nelrx.discovery で、アドバタイズが届いた時点で戻る
+(timeout を待たない)。名前のほかにサービス UUID でも探せる。
+
+    ~/.cache/nelrx/devices.json    (環境変数 NELRX_CACHE で場所を変更、空文字で無効)
+
+    async with open_device("CatVoiceStreamer") as client:
+        await client.start_notify(...)
+"""
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import time
+from pathlib import Path
+
+from .ble import DEVICE_NAME
+
+log = logging.getLogger("nelrx.connect")
+
+DEFAULT_CACHE_PATH = Path.home() / ".cache" / "nelrx" / "devices.json"
+
+
+class DeviceCache:
+    """name_filter → 最後に接続できたアドレス。壊れたファイルは空として扱う。"""
+
+    def __init__(self, path=None):
+        if path is None:
+            path = os.environ.get("NELRX_CACHE", DEFAULT_CACHE_PATH)
+        self.path = Path(path) if path else None
+
+    def _load(self) -> dict:
+        if self.path is None:
+            return {}
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+            return entries if isinstance(entries, dict) else {}
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self, entries: dict) -> None:
+        if self.path is None:
+            return
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_name(self.path.name + ".tmp")
+            with open(tmp, "w") as f:
+                json.dump(entries, f, indent=2)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            log.debug("cannot write %s: %s", self.path, e)
+
+    def get(self, key: str):
+        entry = self._load().get(key)
+        return entry.get("address") if isinstance(entry, dict) else None
+
+    def remember(self, key: str, address: str, name: str = None) -> None:
+        entries = self._load()
+        entries[key] = {"address": address, "name": name, "connected_at": time.time()}
+        self._save(entries)
+
+    def forget(self, key: str) -> None:
+        entries = self._load()
+        if entries.pop(key, None) is not None:
+            self._save(entries)
+
+
+async def scan_by_name(name_filter: str, timeout: float = 5.0, service_uuids=(),
+                       discovery=None):
+    """名前に name_filter を含むか service_uuids を広告している最初のデバイス (なければ None)。"""
+    from .discovery import Discovery
+    return await (discovery or Discovery()).find(name_filter, service_uuids, timeout)
+
+
+def _client_factory():
+    from bleak import BleakClient
+    return BleakClient
+
+
+async def _try_connect(client_factory, target, timeout: float):
+    client = client_factory(target)
+    try:
+        await asyncio.wait_for(client.connect(), timeout)
+    except BaseException:
+        with contextlib.suppress(Exception):
+            await client.disconnect()
+        raise
+    return client
+
+
+async def connect(name_filter: str = DEVICE_NAME, address: str = None, cache=None,
+                  client_factory=None, scan=None, scan_timeout: float = 5.0,
+                  connect_timeout: float = 5.0, service_uuids=(), discovery=None):
+    """接続済みの client と、どの経路でつながったか ("address" / "cache" / "scan") を返す。
+
+    address を渡せばそのアドレスだけを使う (キャッシュもスキャンも使わない)。
+    client_factory は BleakClient 互換 (アドレスの文字列か device を受け取る)、
+    scan は ``async scan(name_filter, timeout) -> device`` (省略時は scan_by_name で、
+    service_uuids と discovery (registry を共有する discovery.Discovery) を使う)。
+    見つからない / つながらないときは ConnectionError。
+    """
+    client_factory = client_factory or _client_factory()
+    if cache is None:
+        cache = DeviceCache()
+    if address:
+        return await _try_connect(client_factory, address, connect_timeout), "address"
+
+    cached = cache.get(name_filter)
+    if cached:
+        t0 = time.perf_counter()
+        try:
+            client = await _try_connect(client_factory, cached, connect_timeout)
+            log.info("connected to cached %s in %.2f s", cached, time.perf_counter() - t0)
+            return client, "cache"
+        except Exception as e:   # 電源が入っていない / アドレスが変わった
+            log.info("cached %s unavailable (%s); scanning", cached, str(e) or type(e).__name__)
+
+    t0 = time.perf_counter()
+    if scan is not None:
+        device = await scan(name_filter, scan_timeout)
+    else:
+        device = await scan_by_name(name_filter, scan_timeout, service_uuids, discovery)
+    if device is None:
+        raise ConnectionError(f"no device matching {name_filter!r}")
+    log.info("found %s (%s) in %.2f s", device.name, device.address, time.perf_counter() - t0)
+    client = await _try_connect(client_factory, device, connect_timeout)
+    cache.remember(name_filter, device.address, device.name)
+    return client, "scan"
+
+
+@contextlib.asynccontextmanager
+async def open_device(name_filter: str = DEVICE_NAME, **options):
+    """connect() してから client を渡し、抜けるときに切断する。"""
+    client, _ = await connect(name_filter, **options)
+    try:
+        yield client
+    finally:
+        with contextlib.suppress(Exception):
+            await client.disconnect()
+
+
+if __name__ == "__main__":
+    # キャッシュがあれば直接、なければ / 古ければスキャンしてつなぐこと
+    import tempfile
+
+    from .fake import FakeBleakClient, FakeDevice
+
+    present = {"AA:01": FakeDevice("CatVoiceStreamer-1", "AA:01")}
+    scans = []
+
+    def factory(target):
+        address = getattr(target, "address", target)
+        client = FakeBleakClient(present.get(address) or FakeDevice(None, address))
+        if address not in present:
+            async def unreachable():
+                await asyncio.sleep(10)
+            client.connect = unreachable
+        return client
+
+    async def scan(name_filter, timeout):
+        scans.append(name_filter)
+        return next((d for d in present.values() if name_filter in d.name), None)
+
+    async def check():
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = DeviceCache(os.path.join(tmp, "devices.json"))
+            opts = dict(cache=cache, client_factory=factory, scan=scan, connect_timeout=0.05)
+
+            client, how = await connect("CatVoiceStreamer", **opts)
+            assert how == "scan" and client.is_connected and cache.get("CatVoiceStreamer") == "AA:01"
+            client, how = await connect("CatVoiceStreamer", **opts)
+            assert how == "cache" and len(scans) == 1
+
+            # デバイスのアドレスが変わった: キャッシュは失敗し、スキャンで見つけ直す
+            present["AA:02"] = FakeDevice("CatVoiceStreamer-1", "AA:02")
+            del present["AA:01"]
+            client, how = await connect("CatVoiceStreamer", **opts)
+            assert how == "scan" and client.address == "AA:02" and cache.get("CatVoiceStreamer") == "AA:02"
+
+            present.clear()
+            try:
+                await connect("CatVoiceStreamer", **opts)
+                raise AssertionError("expected ConnectionError")
+            except ConnectionError:
+                pass
+
+            with open(cache.path, "w") as f:
+                f.write("{broken")
+            assert cache.get("CatVoiceStreamer") is None
+            assert DeviceCache("").get("CatVoiceStreamer") is None
+
+    asyncio.run(check())
+    print("cache hit / miss / stale / not found: OK")
@@ -0,0 +1,265 @@
+"""アドバタイズを受け取った時点で見つけるデバイス探索と、RSSI 順の登録簿。
+
+``BleakScanner.discover(timeout=5.0)`` はスキャン時間を必ず待ってから名前で
+絞り込むので、再接続のたびに数秒かかる。ここでは BleakScanner の
+detection_callback でアドバタイズを 1 つずつ受け取り、名前かサービス UUID が
+一致した時点で (find) または必要な台数がそろった時点で (find_all) スキャンを止める。
+
+見かけたペリフェラルはすべて DeviceRegistry に残る (RSSI は平滑化して保持)。
+同じ registry を Discovery / BleHub / connect に渡せば、直前のスキャン結果を
+使い回したり、電波の強い順に接続したりできる。
+
+    discovery = Discovery()
+    device = await discovery.find("CatVoiceStreamer", [UART_SERVICE_UUID], timeout=5.0)
+    devices = await discovery.find_all("CatVoiceStreamer", count=3, timeout=10.0)
+    discovery.registry.ranked()      # 強い順の Peripheral
+"""
+import asyncio
+import logging
+import time
+
+log = logging.getLogger("nelrx.discovery")
+
+BASE_UUID = "0000{:04x}-0000-1000-8000-00805f9b34fb"
+
+
+def normalize_uuid(uuid) -> str:
+    """"180C" / 0x180C / 大文字の 128bit UUID を bleak と同じ小文字の 128bit 表記にする。"""
+    if isinstance(uuid, int):
+        return BASE_UUID.format(uuid)
+    uuid = str(uuid).lower()
+    if len(uuid) in (4, 6) and not uuid.startswith("0000"):
+        return BASE_UUID.format(int(uuid, 16))
+    return uuid
+
+
+class Peripheral:
+    """registry の 1 件。device は bleak の BLEDevice (接続に使う)。"""
+
+    def __init__(self, device, now: float):
+        self.device = device
+        self.address = device.address
+        self.name = None
+        self.rssi = None              # 平滑化した RSSI [dBm]
+        self.last_rssi = None
+        self.service_uuids = set()
+        self.first_seen = now
+        self.last_seen = now
+        self.seen = 0
+
+    def __repr__(self):
+        return f"Peripheral({self.name!r}, {self.address!r}, rssi={self.rssi})"
+
+
+class DeviceMatch:
+    """名前 (部分一致) かサービス UUID のどちらかが合えば一致。どちらも無指定なら全部。"""
+
+    def __init__(self, name: str = None, service_uuids=()):
+        self.name = name
+        self.service_uuids = {normalize_uuid(u) for u in service_uuids or ()}
+
+    def __call__(self, peripheral) -> bool:
+        if self.name is None and not self.service_uuids:
+            return True
+        if self.name and peripheral.name and self.name in peripheral.name:
+            return True
+        return bool(self.service_uuids & peripheral.service_uuids)
+
+    def __repr__(self):
+        parts = [repr(self.name)] if self.name else []
+        return " or ".join(parts + sorted(self.service_uuids)) or "any"
+
+
+class DeviceRegistry:
+    """アドレスごとに最後に見えた状態を持つ。イベントループのスレッドからだけ触る。
+
+    RSSI はアドバタイズごとのばらつきが大きいので、smoothing の指数移動平均にする。
+    """
+
+    def __init__(self, smoothing: float = 0.3, clock=time.monotonic):
+        self.smoothing = smoothing
+        self.clock = clock
+        self._peripherals = {}
+
+    def update(self, device, adv=None) -> Peripheral:
+        now = self.clock()
+        p = self._peripherals.get(device.address)
+        if p is None:
+            p = self._peripherals[device.address] = Peripheral(device, now)
+        p.device = device
+        p.last_seen = now
+        p.seen += 1
+        name = getattr(adv, "local_name", None) or device.name
+        if name:
+            p.name = name
+        p.service_uuids.update(normalize_uuid(u) for u in getattr(adv, "service_uuids", None) or ())
+        rssi = getattr(adv, "rssi", None)
+        if rssi is None:
+            rssi = getattr(device, "rssi", None)
+        if rssi is not None:
+            p.last_rssi = rssi
+            p.rssi = rssi if p.rssi is None else p.rssi + self.smoothing * (rssi - p.rssi)
+        return p
+
+    def get(self, address: str):
+        return self._peripherals.get(address)
+
+    def ranked(self, match=None, max_age: float = None) -> list:
+        """一致するものを RSSI の強い順に返す (RSSI 不明は最後)。max_age 秒より古いものは除く。"""
+        now = self.clock()
+        found = [p for p in self._peripherals.values()
+                 if (match is None or match(p)) and (max_age is None or now - p.last_seen <= max_age)]
+        found.sort(key=lambda p: -1e9 if p.rssi is None else p.rssi, reverse=True)
+        return found
+
+    def best(self, match=None, max_age: float = None):
+        ranked = self.ranked(match, max_age)
+        return ranked[0] if ranked else None
+
+    def prune(self, max_age: float) -> int:
+        """max_age 秒以上見えていないものを消し、消した数を返す。"""
+        now = self.clock()
+        stale = [a for a, p in self._peripherals.items() if now - p.last_seen > max_age]
+        for address in stale:
+            del self._peripherals[address]
+        return len(stale)
+
+    def __len__(self):
+        return len(self._peripherals)
+
+    def __iter__(self):
+        return iter(list(self._peripherals.values()))
+
+
+class Discovery:
+    """detection_callback で見つけ次第スキャンを止める。
+
+    scanner_factory は BleakScanner 互換 (detection_callback を受け取り、
+    start() / stop() を持つもの)。テストでは nelrx.fake.FakeScanner を使う。
+    """
+
+    def __init__(self, registry: DeviceRegistry = None, scanner_factory=None):
+        self.registry = registry if registry is not None else DeviceRegistry()
+        self.scanner_factory = scanner_factory
+        self.scans = 0
+
+    async def find(self, name: str = None, service_uuids=(), timeout: float = 5.0,
+                   fresh: float = 0.0):
+        """一致する最初のデバイス (BLEDevice) を返す。timeout 秒で見つからなければ None。
+
+        fresh > 0 なら、その秒数以内に見かけたものが registry にあればスキャンしない。
+        """
+        match = DeviceMatch(name, service_uuids)
+        if fresh > 0:
+            p = self.registry.best(match, max_age=fresh)
+            if p is not None:
+                return p.device
+        found = await self._scan(match, count=1, timeout=timeout)
+        return found[0].device if found else None
+
+    async def find_all(self, name: str = None, service_uuids=(), count: int = None,
+                       timeout: float = 5.0, settle: float = None) -> list:
+        """一致するデバイスを RSSI の強い順に返す。
+
+        count 台見つかった時点で止める (None なら timeout まで探す)。settle を
+        指定すると、最初の 1 台から settle 秒たった時点でも止める (近くにいるものは
+        たいてい 1 回目のアドバタイズ間隔のうちに見つかる)。
+        """
+        match = DeviceMatch(name, service_uuids)
+        found = await self._scan(match, count=count, timeout=timeout, settle=settle)
+        return [p.device for p in found]
+
+    async def _scan(self, match, count: int = None, timeout: float = 5.0,
+                    settle: float = None) -> list:
+        scanner_factory = self.scanner_factory
+        if scanner_factory is None:
+            from bleak import BleakScanner
+            scanner_factory = BleakScanner
+        loop = asyncio.get_running_loop()
+        found = {}
+        first = []
+        changed = asyncio.Event()
+
+        def on_advertisement(device, adv):
+            p = self.registry.update(device, adv)
+            if p.address not in found and match(p):
+                found[p.address] = p
+                if not first:
+                    first.append(loop.time())
+                changed.set()
+
+        t0 = loop.time()
+        deadline = t0 + timeout
+        scanner = scanner_factory(detection_callback=on_advertisement)
+        self.scans += 1
+        await scanner.start()
+        try:
+            while count is None or len(found) < count:
+                if settle is not None and first:
+                    deadline = min(deadline, first[0] + settle)
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(changed.wait(), remaining)
+                except asyncio.TimeoutError:
+                    break
+                changed.clear()
+        finally:
+            await scanner.stop()
+        ranked = sorted(found.values(), key=lambda p: -1e9 if p.rssi is None else p.rssi,
+                        reverse=True)
+        log.debug("scan for %r: %d found in %.2f s (%d advertisers seen)",
+                  match, len(ranked), loop.time() - t0, len(self.registry))
+        return ranked
+
+
+if __name__ == "__main__":
+    # 見つかった時点で戻ること、複数台と RSSI 順、registry の使い回し
+    from .ble import SENSOR_SERVICE_UUID, UART_SERVICE_UUID
+    from .fake import FakeAdvertisement, FakeDevice, FakeScanner
+
+    uart = UART_SERVICE_UUID
+    events = [
+        (0.01, FakeDevice(None, "00:01"), FakeAdvertisement(None, -70, ["180c"])),
+        (0.02, FakeDevice(None, "00:02"), FakeAdvertisement("Headphones", -40, [])),
+        (0.03, FakeDevice(None, "AA:01"), FakeAdvertisement("CatVoiceStreamer", -80, [uart])),
+        (0.04, FakeDevice(None, "AA:02"), FakeAdvertisement(None, -50, [uart])),   # 名前は後から
+        (0.05, FakeDevice(None, "AA:01"), FakeAdvertisement("CatVoiceStreamer", -60, [uart])),
+        (0.06, FakeDevice(None, "AA:03"), FakeAdvertisement("CatVoiceStreamer", -90, [])),
+        (3.00, FakeDevice(None, "AA:04"), FakeAdvertisement("CatVoiceStreamer", -30, [])),
+    ]
+
+    async def check():
+        discovery = Discovery(scanner_factory=FakeScanner.factory(events))
+        t0 = time.perf_counter()
+        device = await discovery.find("CatVoiceStreamer", timeout=5.0)
+        elapsed = time.perf_counter() - t0
+        assert device.address == "AA:01" and elapsed < 0.5, (device, elapsed)
+
+        device = await discovery.find(service_uuids=[0x180C], timeout=5.0)
+        assert device.address == "00:01"
+
+        t0 = time.perf_counter()
+        devices = await discovery.find_all("CatVoiceStreamer", [uart], count=3, timeout=5.0)
+        assert [d.address for d in devices] == ["AA:02", "AA:01", "AA:03"], devices
+        assert time.perf_counter() - t0 < 0.5
+
+        # 台数がわからなくても、最初の 1 台から settle 秒で打ち切る (AA:04 は 3 s 後)
+        t0 = time.perf_counter()
+        devices = await discovery.find_all("CatVoiceStreamer", [uart], settle=0.2, timeout=5.0)
+        assert len(devices) == 3 and time.perf_counter() - t0 < 0.5, devices
+
+        assert await discovery.find("Nothing", timeout=0.1) is None
+        scans = discovery.scans
+        p = discovery.registry.get("AA:01")
+        assert p.name == "CatVoiceStreamer" and p.last_rssi == -60 and -80 < p.rssi < -60
+
+        # registry に新しい結果があればスキャンしない
+        assert (await discovery.find("Headphones", fresh=10.0)).address == "00:02"
+        assert discovery.scans == scans
+        assert normalize_uuid(SENSOR_SERVICE_UUID) == normalize_uuid("180C") == normalize_uuid(0x180C)
+        print(f"{len(discovery.registry)} advertisers, ranked: {discovery.registry.ranked()[:3]}")
+
+    asyncio.run(check())
+    print("early exit / service UUID / count / settle / registry: OK")
@@ -0,0 +1,280 @@
+"""実機なしで受信側を動かすための偽物 (BleakScanner / BleakClient 互換、pty のシリアルデバイス)。"""
+import asyncio
+import os
+import threading
+import time
+
+
+class FakeDevice:
+    """BleakScanner が返す BLEDevice の代わり (name と address だけ)。"""
+
+    def __init__(self, name: str, address: str):
+        self.name = name
+        self.address = address
+
+    def __repr__(self):
+        return f"FakeDevice({self.name!r}, {self.address!r})"
+
+
+class FakeAdvertisement:
+    """bleak の AdvertisementData の代わり (local_name / rssi / service_uuids だけ)。"""
+
+    def __init__(self, local_name: str = None, rssi: int = None, service_uuids=()):
+        self.local_name = local_name
+        self.rssi = rssi
+        self.service_uuids = list(service_uuids)
+
+
+class FakeScanner:
+    """start() からの経過時間どおりに (delay, device, adv) のアドバタイズを流す。
+
+    ``FakeScanner.factory(events)`` を Discovery の scanner_factory に渡す。
+    start() のたびに events の最初から流し直す。
+    """
+
+    def __init__(self, events, detection_callback=None):
+        self.events = sorted(events, key=lambda e: e[0])
+        self.detection_callback = detection_callback
+        self._task = None
+
+    @classmethod
+    def factory(cls, events):
+        def make(detection_callback=None, **_):
+            return cls(events, detection_callback)
+        return make
+
+    async def start(self) -> None:
+        self._task = asyncio.create_task(self._advertise())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _advertise(self) -> None:
+        start = time.monotonic()
+        for delay, device, adv in self.events:
+            await asyncio.sleep(max(0.0, start + delay - time.monotonic()))
+            if self.detection_callback is not None:
+                self.detection_callback(device, adv)
+
+
+class FakeBleakClient:
+    """記録済みパケットを Notify として再生する。
+
+    ``FakeBleakClient.factory(packets_by_address)`` を BleHub の
+    client_factory に渡すと、アドレスごとに別のパケット列を流せる。
+    再生し終えると切断扱いになり、disconnected_callback があれば呼ぶ。
+    """
+
+    def __init__(self, device, packets=(), interval: float = 0.0, disconnected_callback=None):
+        self.device = device
+        self.address = device.address
+        self.packets = list(packets)
+        self.interval = interval
+        self.disconnected_callback = disconnected_callback
+        self.is_connected = False
+        self._task = None
+
+    @classmethod
+    def factory(cls, packets_by_address: dict, interval: float = 0.0):
+        def make(device, disconnected_callback=None):
+            return cls(device, packets_by_address.get(device.address, ()), interval,
+                       disconnected_callback)
+        return make
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.disconnect()
+
+    async def connect(self) -> bool:
+        self.is_connected = True
+        return True
+
+    async def disconnect(self) -> bool:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self.is_connected = False
+        return True
+
+    async def start_notify(self, char_uuid, callback) -> None:
+        self._task = asyncio.create_task(self._replay(char_uuid, callback))
+
+    async def stop_notify(self, char_uuid) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _replay(self, char_uuid, callback) -> None:
+        for packet in self.packets:
+            await asyncio.sleep(self.interval)
+            callback(char_uuid, bytearray(packet))
+        await asyncio.sleep(0)
+        self.is_connected = False
+        if self.disconnected_callback is not None:
+            self.disconnected_callback(self)
+
+
+class FlakyDevice:
+    """切れやすいデバイスの代役 (再接続のテスト用)。
+
+    デバイスは接続の有無にかかわらず interval 秒ごとに packets を 1 つずつ進める
+    (切れている間の分は失われる)。1 回の接続で drop_every 個送るとリンクが切れ
+    (disconnected_callback が呼ばれる)、接続は fail_rate の確率で失敗する。
+    ``FlakyDevice.client`` を LinkSupervisor の client_factory に渡す。
+    """
+
+    def __init__(self, packets, interval: float = 0.005, drop_every: int = None,
+                 fail_rate: float = 0.0, seed: int = 0, name: str = "CatVoiceStreamer",
+                 address: str = "FA:KE:00:00:00:01"):
+        import random
+        self.device = FakeDevice(name, address)
+        self.packets = list(packets)
+        self.interval = interval
+        self.drop_every = drop_every
+        self.fail_rate = fail_rate
+        self.rng = random.Random(seed)
+        self.connects = 0
+        self.failed_connects = 0
+        self.drops = 0
+        self.sent = 0
+        self._start = None
+
+    def position(self) -> int:
+        """いまデバイスが送ろうとしているパケットの番号 (最初の接続から数える)。"""
+        if self._start is None:
+            return 0
+        return int((time.monotonic() - self._start) / self.interval)
+
+    def client(self, target=None, disconnected_callback=None):
+        return FlakyBleakClient(self, disconnected_callback)
+
+    def stats(self) -> dict:
+        return {"connects": self.connects, "failed_connects": self.failed_connects,
+                "drops": self.drops, "sent": self.sent, "packets": len(self.packets)}
+
+
+class FlakyBleakClient:
+    """FlakyDevice への 1 回分の接続 (BleakClient 互換)。"""
+
+    def __init__(self, device: FlakyDevice, disconnected_callback=None):
+        self.flaky = device
+        self.address = device.device.address
+        self.disconnected_callback = disconnected_callback
+        self.is_connected = False
+        self._task = None
+
+    async def connect(self) -> bool:
+        await asyncio.sleep(self.flaky.interval)
+        if self.flaky.rng.random() < self.flaky.fail_rate:
+            self.flaky.failed_connects += 1
+            raise OSError("simulated connection failure")
+        if self.flaky._start is None:
+            self.flaky._start = time.monotonic()
+        self.flaky.connects += 1
+        self.is_connected = True
+        return True
+
+    async def disconnect(self) -> bool:
+        self._stop_task()
+        was_connected, self.is_connected = self.is_connected, False
+        if was_connected and self.disconnected_callback is not None:
+            self.disconnected_callback(self)
+        return True
+
+    async def start_notify(self, char_uuid, callback) -> None:
+        if not self.is_connected:
+            raise OSError("not connected")
+        self._task = asyncio.create_task(self._stream(char_uuid, callback))
+
+    async def stop_notify(self, char_uuid) -> None:
+        self._stop_task()
+
+    def _stop_task(self) -> None:
+        if self._task is not None and self._task is not asyncio.current_task():
+            self._task.cancel()
+        self._task = None
+
+    async def _stream(self, char_uuid, callback) -> None:
+        flaky = self.flaky
+        index = flaky.position()
+        sent = 0
+        while self.is_connected:
+            await asyncio.sleep(max(0.0, flaky._start + index * flaky.interval - time.monotonic()))
+            index = max(index, flaky.position())
+            if index >= len(flaky.packets):
+                return
+            callback(char_uuid, bytearray(flaky.packets[index]))
+            flaky.sent += 1
+            sent += 1
+            index += 1
+            if flaky.drop_every and sent >= flaky.drop_every:
+                flaky.drops += 1
+                self._task = None
+                self.is_connected = False
+                if self.disconnected_callback is not None:
+                    self.disconnected_callback(self)
+                return
+
+
+class PtySerialDevice:
+    """pty を使ったシリアルデバイスの代役 (POSIX のみ)。
+
+    port (/dev/pts/N) は pyserial の Serial にそのまま渡せる。
+    play() で別スレッドからバイト列を流す。
+    """
+
+    def __init__(self):
+        import tty
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._readers = []
+        self._thread = None
+        self._stop = threading.Event()
+
+    def write(self, data) -> None:
+        view = memoryview(data)
+        while view:
+            n = os.write(self._master, view)
+            view = view[n:]
+
+    def play(self, data, chunk: int = 256, interval: float = 0.0) -> None:
+        """data を chunk バイトずつ interval 秒おきに書く (バックグラウンド)。"""
+        def run():
+            for i in range(0, len(data), chunk):
+                if self._stop.is_set():
+                    return
+                self.write(data[i:i + chunk])
+                if interval:
+                    time.sleep(interval)
+        self._thread = threading.Thread(target=run, name="pty-serial", daemon=True)
+        self._thread.start()
+
+    def open_reader(self):
+        """受信側として読むためのファイル (read(n) は届いている分だけ返す)。"""
+        f = open(self.port, "rb", buffering=0)
+        self._readers.append(f)
+        return f
+
+    def close(self) -> None:
+        """切断する。先に master を閉じるので、読み取り中の read は EIO で戻る。"""
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        os.close(self._master)
+        for f in self._readers:
+            f.close()
+        os.close(self._slave)
+        if self._thread is not None:
+            self._thread.join(1.0)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,305 @@
+"""複数の CatVoiceStreamer を 1 つの asyncio ループで受信するハブ。
+
+デバイスごとに DeviceSession (デコーダ状態 + sink + 受信カウンタ) を持ち、
+全デバイスの Notify を同じイベントループに集める。Notify のコールバックは
+デバイスごとの Pipeline にコピーするだけで、デコードと sink への書き込みは
+そのワーカースレッドで行う (1 台の sink が遅くても他のデバイスの受信を止めない)。同時接続数は
+max_connections で頭打ちにし、あふれたデバイスは空きが出るまで待つ。
+探索は nelrx.discovery で行い、電波の強い (RSSI の大きい) デバイスから接続する。
+切れたデバイスには nelrx.supervisor でつなぎ直す (sink / recorder は作り直さない)。
+接続ごとに MTU / PHY を要求し (nelrx.linktune)、決まった値を report() に出す。
+"""
+import asyncio
+import logging
+import time
+
+from . import adpcm, linktune, metrics
+from .conceal import ConcealingDecoder
+from .ble import DEVICE_NAME, UART_SERVICE_UUID, UART_TX_CHAR_UUID
+from .discovery import Discovery
+from .pipeline import DROP_OLDEST, Pipeline
+from .supervisor import Backoff, LinkSupervisor
+
+log = logging.getLogger("nelrx.hub")
+
+
+class DeviceSession:
+    """1 デバイス分の受信状態。
+
+    handle_notify (イベントループ側) は数えて pipeline に積むだけ。デコードと
+    sink.write は pipeline のワーカースレッドで行う。start() / close() で
+    ワーカーを動かす / 止める (close は残りをデコードしてから sink を閉じる)。
+    """
+
+    def __init__(self, address: str, name: str, sink, conceal: str = "fade", tap=None,
+                 queue: int = 64, slot_size: int = 512):
+        self.address = address
+        self.name = name
+        self.sink = sink
+        self.tap = tap            # 届いたままの Notify を記録する (capture)
+        self.decoder = ConcealingDecoder(conceal)
+        self.pipeline = Pipeline(self._decode, capacity=queue, slot_size=slot_size,
+                                 policy=DROP_OLDEST, name=f"nelrx-hub-{address}")
+        self.connected = False
+        self.link = None          # supervisor.LinkSupervisor (再接続とダウンタイム)
+        self.profile = None       # linktune.LinkProfile (MTU / PHY)
+        self.decode_hist = None   # metrics.Histogram (instrument() で入る)
+        self.last_seq = None
+        self.bytes = 0
+        self.packets = 0
+        self.samples = 0
+        self._decoded = 0
+        self._mark = (time.monotonic(), 0, 0)
+
+    def start(self) -> None:
+        self.pipeline.start()
+
+    def close(self) -> None:
+        self.pipeline.stop()
+        self.sink.close()
+
+    def handle_notify(self, _, data: bytearray) -> None:
+        """ble_mic_ok 形式 (4 バイトヘッダ + ADPCM) のパケットを 1 つ受け取る。"""
+        if self.tap is not None:
+            self.tap(data)
+        if len(data) < adpcm.HEADER_SIZE:
+            return
+        self.last_seq = data[0]
+        self.bytes += len(data)
+        self.packets += 1
+        self.pipeline.push(data)
+
+    def _decode(self, data) -> None:
+        # pipeline のワーカースレッド
+        if not len(data):
+            # on_connect の目印。切れる前のパケットをデコードし終えてからやり直す
+            self.decoder.resync()
+            return
+        self._decoded += 1
+        if self.decode_hist is None or self._decoded % metrics.TIME_EVERY:
+            self.samples += self.decoder.decode_packet(data, self.sink.write)
+        else:
+            t0 = time.perf_counter()
+            self.samples += self.decoder.decode_packet(data, self.sink.write)
+            self.decode_hist.observe(time.perf_counter() - t0)
+
+    def instrument(self, registry) -> None:
+        """registry にこのデバイスのメトリクスを device ラベル付きで出す。"""
+        m = metrics.ReceiverMetrics(registry, {"device": self.address}, counts=self)
+        m.watch_decoder(self.decoder)
+        m.watch_pipeline(self.pipeline)
+        m.watch_sink(self.sink)
+        if self.link is not None:
+            m.watch_link(self.link)
+        self.decode_hist = m.decode_seconds
+
+    async def on_connect(self, client) -> None:
+        self.connected = True
+        # 切れていた間の seq は数えず、次のパケットのヘッダからデコードし直す
+        # (デコードはワーカー側なので、空のパケットを目印として積む)
+        self.pipeline.push(b"")
+        # 接続ごとに MTU / PHY を要求して、決まった値を report() に出す
+        self.profile = await linktune.negotiate(client, profile=self.profile)
+
+    def on_disconnect(self) -> None:
+        self.connected = False
+
+    def throughput(self) -> dict:
+        """前回呼び出しからの B/s, packets/s を返す。"""
+        now = time.monotonic()
+        t0, bytes0, packets0 = self._mark
+        self._mark = (now, self.bytes, self.packets)
+        dt = max(now - t0, 1e-9)
+        link = self.link.stats() if self.link is not None else {}
+        ring = self.pipeline.ring
+        return {
+            "address": self.address,
+            "name": self.name,
+            "connected": self.connected,
+            "bytes_per_s": (self.bytes - bytes0) / dt,
+            "packets_per_s": (self.packets - packets0) / dt,
+            "last_seq": self.last_seq,
+            "total_bytes": self.bytes,
+            "total_samples": self.samples,
+            "lost": self.decoder.tracker.lost,
+            "loss_rate": self.decoder.tracker.loss_rate,
+            "queue_depth": ring.depth,
+            "queue_dropped": ring.dropped,
+            "reconnects": link.get("reconnects", 0),
+            "downtime_s": link.get("downtime_s", 0.0),
+            "mtu": self.profile.mtu if self.profile is not None else None,
+            "phy": self.profile.phy if self.profile is not None else None,
+        }
+
+
+class BleHub:
+    """名前が一致するペリフェラルすべてに接続して受信する。
+
+    client_factory には BleakClient 互換のクラス (device と disconnected_callback を
+    受け取り、connect / start_notify を持つもの) を渡せる。テストでは
+    nelrx.fake.FakeBleakClient を使う。reconnect なら切れたデバイスにつなぎ直し
+    (supervisor.LinkSupervisor、sink はそのまま)、切れていた時間を report() に出す。capture (capture.CaptureWriter) を渡すと
+    全デバイスの Notify をアドレスごとのチャンネルに記録する。
+
+    discovery (discovery.Discovery) を渡すと、その registry を他と共有できる。
+    expected 台見つかった時点、または最初の 1 台から settle 秒でスキャンを打ち切る
+    (どちらも None なら scan_timeout まで探す)。
+    metrics_registry (metrics.MetricsRegistry) を渡すと、デバイスごとのメトリクスを
+    device ラベル付きでそこに出す。queue / slot_size はデバイスごとの Pipeline の
+    容量 (満杯なら古いものから捨てる、捨てた数は report() の queue_dropped)。
+    """
+
+    def __init__(self, sink_factory, name_filter: str = DEVICE_NAME,
+                 max_connections: int = 4, client_factory=None,
+                 report_interval: float = 1.0, capture=None, discovery=None,
+                 service_uuids=(UART_SERVICE_UUID,), expected: int = None,
+                 settle: float = None, reconnect: bool = True, backoff_factory=None,
+                 metrics_registry=None, queue: int = 64, slot_size: int = 512):
+        self.sink_factory = sink_factory
+        self.capture = capture
+        self.discovery = discovery if discovery is not None else Discovery()
+        self.service_uuids = service_uuids
+        self.expected = expected
+        self.settle = settle
+        self.name_filter = name_filter
+        self.max_connections = max_connections
+        self.client_factory = client_factory
+        self.report_interval = report_interval
+        self.reconnect = reconnect
+        self.metrics_registry = metrics_registry
+        self.queue = queue
+        self.slot_size = slot_size
+        self.backoff_factory = backoff_factory or Backoff
+        self.sessions = {}
+        self._slots = asyncio.Semaphore(max_connections)
+        self._stop = asyncio.Event()
+
+    @property
+    def registry(self):
+        return self.discovery.registry
+
+    async def discover(self, timeout: float = 5.0):
+        """名前に name_filter を含む (か UART サービスを広告している) デバイスを RSSI の強い順に返す。"""
+        return await self.discovery.find_all(self.name_filter, self.service_uuids,
+                                             count=self.expected, timeout=timeout,
+                                             settle=self.settle)
+
+    async def run(self, devices=None, scan_timeout: float = 5.0) -> None:
+        """stop() が呼ばれるまで (reconnect=False なら全デバイスが切れるまで) 受信する。"""
+        if devices is None:
+            devices = await self.discover(scan_timeout)
+        if not devices:
+            log.warning("no device matching %r", self.name_filter)
+            return
+        log.info("found %d device(s), max %d concurrent connections",
+                 len(devices), self.max_connections)
+
+        reporter = asyncio.create_task(self._report_loop())
+        try:
+            await asyncio.gather(*(self._serve(d) for d in devices))
+        finally:
+            reporter.cancel()
+            for session in self.sessions.values():
+                session.close()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def report(self) -> list:
+        return [s.throughput() for s in self.sessions.values()]
+
+    async def _serve(self, device) -> None:
+        session = self.sessions.get(device.address)
+        if session is None:
+            tap = None
+            if self.capture is not None:
+                tap = self.capture.tap(self.capture.channel(device.address, kind="ble",
+                                                            device_name=device.name))
+            session = DeviceSession(device.address, device.name, self.sink_factory(device), tap=tap,
+                                    queue=self.queue, slot_size=self.slot_size)
+            self.sessions[device.address] = session
+            session.start()
+
+        link = LinkSupervisor(device.name or self.name_filter,
+                              {UART_TX_CHAR_UUID: session.handle_notify}, address=device, client_factory=self.client_factory,
+                              backoff=self.backoff_factory(), reconnect=self.reconnect,
+                              on_connect=session.on_connect, on_disconnect=session.on_disconnect)
+        session.link = link
+        if self.metrics_registry is not None:
+            session.instrument(self.metrics_registry)
+        async with self._slots:
+            if self._stop.is_set():
+                return
+            try:
+                await link.run(self._stop)
+            except Exception as e:
+                log.warning("%s: %s", device.address, e)
+            finally:
+                session.connected = False
+                st = link.stats()
+                log.info("disconnected %s (%d reconnects, %.1f s down)", device.address,
+                         st["reconnects"], st["downtime_s"])
+
+    async def _report_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.report_interval)
+            for r in self.report():
+                if not r["connected"]:
+                    continue
+                log.info("%s RX %.0f B/s  %.1f pkt/s  last seq=%s  lost=%d (%.1f%%)  "
+                         "queue %d (dropped %d)  down %.1f s",
+                         r["address"], r["bytes_per_s"], r["packets_per_s"], r["last_seq"],
+                         r["lost"], r["loss_rate"] * 100, r["queue_depth"], r["queue_dropped"],
+                         r["downtime_s"])
+
+
+if __name__ == "__main__":
+    # 偽の BleakClient で、同時接続数の上限とデバイスごとのデコード / 欠落の数を確かめる
+    from .fake import FakeBleakClient, FakeDevice
+    from .sinks import NullSink
+    from .synth import adpcm_packets
+
+    logging.basicConfig(level=logging.WARNING)
+    n_devices, cap = 5, 2
+    devices = [FakeDevice("CatVoiceStreamer", f"AA:00:00:00:00:0{i}") for i in range(n_devices)]
+    streams, expected = {}, {}
+    for i, d in enumerate(devices):
+        packets = adpcm_packets(40 + 20 * i, payload_bytes=64 + 32 * i, seed=i)
+        dropped = set(range(10, 10 + i))          # i 番目のデバイスは i 個続けて欠ける
+        streams[d.address] = [p for k, p in enumerate(packets) if k not in dropped]
+        expected[d.address] = (len(packets) * (64 + 32 * i) * 2, len(dropped))
+
+    class CountingClient(FakeBleakClient):
+        live = peak = 0
+
+        async def connect(self):
+            cls = CountingClient
+            cls.live += 1
+            cls.peak = max(cls.peak, cls.live)
+            return await super().connect()
+
+        async def disconnect(self):
+            if self.is_connected or self._task is not None:
+                CountingClient.live -= 1
+            return await super().disconnect()
+
+    async def check():
+        hub = BleHub(lambda d: NullSink(), max_connections=cap,
+                     client_factory=CountingClient.factory(streams, interval=0.002),
+                     reconnect=False, report_interval=60.0)
+        await hub.run(devices)
+        return hub.report()
+
+    report = asyncio.run(check())
+    peak = CountingClient.peak
+    for r in report:
+        print(r)
+    assert peak == cap, peak
+    assert len(report) == n_devices
+    for r in report:
+        samples, lost = expected[r["address"]]
+        assert r["total_samples"] == samples and r["lost"] == lost, (r, samples, lost)
+        assert r["total_bytes"] == sum(map(len, streams[r["address"]]))
+        assert not r["connected"] and r["queue_dropped"] == 0 and r["queue_depth"] == 0
+        assert r["reconnects"] == 0 and r["name"] == "CatVoiceStreamer"
+    print(f"{n_devices} devices, peak {peak} concurrent connections (max {cap}): OK")
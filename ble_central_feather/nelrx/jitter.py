@@ -0,0 +1,181 @@
+"""BLE の到着タイミングのゆらぎを吸収するジッタバッファ。
+
+デコード済み PCM を事前確保した int16 リングに書き込み、出力側
+(sounddevice のコールバック) が必要な分だけ引き出す。目標の溜め量は
+到着間隔のゆらぎ (RFC 3550 と同じ指数平滑の jitter) から決める。
+
+- underrun : 出力時に足りず 0 で埋めた回数 (その後は目標量まで溜め直す)
+- overrun  : リングがあふれて古いサンプルを捨てた回数
+- trimmed  : 目標より溜まりすぎたので読み飛ばしたサンプル数
+"""
+import threading
+import time
+
+import numpy as np
+
+
+class JitterBuffer:
+    """書き手 (デコード側) と読み手 (出力コールバック) の間に置くリング。"""
+
+    def __init__(self, samplerate: int, capacity_s: float = 2.0,
+                 min_target_ms: float = 20.0, max_target_ms: float = 400.0,
+                 initial_target_ms: float = 80.0, jitter_factor: float = 4.0,
+                 max_chunks: int = 1024):
+        self.samplerate = samplerate
+        self.capacity = int(samplerate * capacity_s)
+        self._ring = np.zeros(self.capacity, dtype=np.int16)
+        self._lock = threading.Lock()
+        self._write = 0       # 書き込んだ総サンプル数
+        self._read = 0        # 読み出した総サンプル数
+        self._primed = False  # 目標量まで溜まって再生中か
+
+        self.min_target = int(samplerate * min_target_ms / 1000)
+        self.max_target = int(samplerate * max_target_ms / 1000)
+        self.target = int(samplerate * initial_target_ms / 1000)
+        self.jitter_factor = jitter_factor
+        self.jitter = 0.0     # 到着間隔のゆらぎ [s]
+        self._last_arrival = None
+        self._last_len = 0
+
+        # 各チャンクの (終端位置, 到着時刻)。遅延計測用
+        self._chunk_end = np.zeros(max_chunks, dtype=np.int64)
+        self._chunk_time = np.zeros(max_chunks, dtype=np.float64)
+        self._chunk_head = 0
+        self._chunk_tail = 0
+
+        self.underruns = 0
+        self.overruns = 0
+        self.trimmed = 0
+        self.latency = 0.0      # 直近の受信 → 再生 [s]
+        self.max_latency = 0.0
+
+    @property
+    def depth(self) -> int:
+        return self._write - self._read
+
+    # ---------- 書き手 ----------
+    def push(self, pcm, arrival: float = None) -> None:
+        n = len(pcm)
+        if n == 0:
+            return
+        if arrival is None:
+            arrival = time.monotonic()
+        with self._lock:
+            self._update_jitter(arrival, n)
+            if n > self.capacity:
+                pcm = pcm[-self.capacity:]
+                n = self.capacity
+            overflow = self._write + n - self._read - self.capacity
+            if overflow > 0:
+                self.overruns += 1
+                self._read += overflow
+            start = self._write % self.capacity
+            first = min(n, self.capacity - start)
+            self._ring[start:start + first] = pcm[:first]
+            if first < n:
+                self._ring[:n - first] = pcm[first:]
+            self._write += n
+
+            size = self._chunk_end.size
+            if self._chunk_head - self._chunk_tail == size:
+                self._chunk_tail += 1
+            i = self._chunk_head % size
+            self._chunk_end[i] = self._write
+            self._chunk_time[i] = arrival
+            self._chunk_head += 1
+
+    def _update_jitter(self, arrival: float, n: int) -> None:
+        if self._last_arrival is None:
+            # 初期目標 (probe で測ったまとまりの間隔など) に見合うゆらぎから始める。
+            # 0 から始めると 2 個目で目標が 1 チャンク分まで落ちてしまう
+            self.jitter = max(0.0, (self.target - n) / (self.jitter_factor * self.samplerate))
+        else:
+            # 前のチャンクの長さぶん後に届くのが理想
+            d = (arrival - self._last_arrival) - self._last_len / self.samplerate
+            self.jitter += (abs(d) - self.jitter) / 16.0
+            # ゆらぎの jitter_factor 倍 + 1 チャンク分を溜めておく
+            target = int(self.jitter_factor * self.jitter * self.samplerate) + n
+            self.target = max(self.min_target, min(self.max_target, target))
+        self._last_arrival = arrival
+        self._last_len = n
+
+    # ---------- 読み手 ----------
+    def pull(self, out, output_delay: float = 0.0) -> int:
+        """out (int16 の 1 次元配列) を埋める。実データで埋めたサンプル数を返す。
+
+        output_delay には出力デバイス側の遅延 (DAC 時刻 - 現在時刻) を渡すと
+        受信から実際に鳴るまでの遅延に含める。
+        """
+        want = len(out)
+        with self._lock:
+            depth = self._write - self._read
+            if not self._primed:
+                if depth < self.target:
+                    out[:] = 0
+                    return 0
+                self._primed = True
+
+            # 溜まりすぎていたら目標まで読み飛ばして遅延を詰める
+            excess = depth - (self.target + want)
+            if excess > self.target:
+                self._read += excess
+                self.trimmed += excess
+                depth -= excess
+
+            n = min(want, depth)
+            start = self._read % self.capacity
+            first = min(n, self.capacity - start)
+            out[:first] = self._ring[start:start + first]
+            if first < n:
+                out[first:n] = self._ring[:n - first]
+            if n < want:
+                out[n:] = 0
+                self.underruns += 1
+                self._primed = False
+            self._read += n
+            self._update_latency(output_delay)
+            return n
+
+    def _update_latency(self, output_delay: float) -> None:
+        # 今読み出した位置を含むチャンクの到着時刻から遅延を出す
+        size = self._chunk_end.size
+        while self._chunk_head - self._chunk_tail > 1 and \
+                self._chunk_end[self._chunk_tail % size] <= self._read:
+            self._chunk_tail += 1
+        if self._chunk_head == self._chunk_tail:
+            return
+        arrival = float(self._chunk_time[self._chunk_tail % size])
+        self.latency = time.monotonic() - arrival + output_delay
+        if self.latency > self.max_latency:
+            self.max_latency = self.latency
+
+    def stats(self) -> dict:
+        fs = self.samplerate
+        return {
+            "depth_ms": 1000.0 * self.depth / fs,
+            "target_ms": 1000.0 * self.target / fs,
+            "jitter_ms": 1000.0 * self.jitter,
+            "latency_ms": 1000.0 * self.latency,
+            "max_latency_ms": 1000.0 * self.max_latency,
+            "underruns": self.underruns,
+            "overruns": self.overruns,
+            "trimmed": self.trimmed,
+        }
+
+
+if __name__ == "__main__":
+    # 初期目標が最初の数個の push で失われず、ゆらぎがなければ徐々に詰まることを確かめる
+    fs = 8000
+    jb = JitterBuffer(fs, initial_target_ms=200.0)
+    pcm = np.zeros(256, dtype=np.int16)
+    t = 0.0
+    for i in range(4):
+        jb.push(pcm, arrival=t)
+        t += len(pcm) / fs
+        assert jb.stats()["target_ms"] >= 150.0, (i, jb.stats())
+    for _ in range(200):
+        jb.push(pcm, arrival=t)
+        t += len(pcm) / fs
+    assert jb.stats()["target_ms"] < 60.0, jb.stats()
+    print(jb.stats())
+    print("initial target / decay: OK")
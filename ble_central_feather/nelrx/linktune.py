@@ -0,0 +1,239 @@
+"""BLE リンクの接続パラメータ (MTU / PHY / 接続間隔) と実効スループットを調べる。
+
+ble_mic_default は ``request_mtu(150)`` / ``request_phy(2)`` を呼んで例外を
+すべて握りつぶしていたが、bleak の BleakClient にはどちらのメソッドもないので
+実際には何も起きていなかった。ここでは
+
+    negotiate : バックエンドができる範囲で MTU / PHY を要求し、決まった値を記録する
+                (BlueZ は _acquire_mtu、CoreBluetooth は自動で決まる mtu_size を読むだけ。
+                PHY と接続間隔は bleak からは読めないので None のまま)
+    probe     : 数秒 Notify を受けて、B/s・packets/s・パケット長と、到着のまとまり
+                (1 回の connection event で届く分) から接続間隔を推定する
+
+を行い、結果を LinkProfile にまとめる。size_buffers() はその実測値から
+Pipeline の容量 / スロット長とジッタバッファの初期目標を決める (決め打ちの
+capacity=64 の代わり)。
+
+    profile = await tune(client, UART_TX_CHAR_UUID, probe_s=1.0)
+    sizes = size_buffers(profile)     # {"capacity", "slot_size", "initial_target_ms"}
+"""
+import asyncio
+import logging
+import math
+import statistics
+import time
+
+log = logging.getLogger("nelrx.linktune")
+
+ATT_HEADER = 3                # Notify 1 つあたりの ATT ヘッダ (payload = MTU - 3)
+BURST_GAP_S = 0.002           # これより詰まって届いたものは同じ connection event とみなす
+
+
+class LinkProfile:
+    """1 回の接続で決まった値と実測値。わからないものは None。"""
+
+    def __init__(self, address: str = None):
+        self.address = address
+        self.mtu = None               # ATT MTU (バックエンドが報告した値)
+        self.phy = None               # "1M" / "2M" / "coded" (要求が通ったときだけ)
+        self.interval_ms = None       # バックエンドが報告した接続間隔
+        self.errors = {}              # 要求できなかったもの → 理由
+        self.probe_s = None
+        self.packets = 0
+        self.bytes = 0
+        self.bytes_per_s = None
+        self.packets_per_s = None
+        self.max_packet = None
+        self.mean_packet = None
+        self.est_interval_ms = None   # 到着のまとまりの間隔から推定した接続間隔
+        self.packets_per_event = None
+        self.gap_p99_ms = None        # まとまり同士の間隔の 99 パーセンタイル
+
+    @property
+    def max_payload(self):
+        return self.mtu - ATT_HEADER if self.mtu else None
+
+    def stats(self) -> dict:
+        st = dict(vars(self))
+        st["max_payload"] = self.max_payload
+        return st
+
+    def __repr__(self):
+        return (f"LinkProfile({self.address!r}, mtu={self.mtu}, phy={self.phy}, "
+                f"{self.bytes_per_s or 0:.0f} B/s, {self.packets_per_s or 0:.1f} pkt/s)")
+
+
+# --------- 接続パラメータ ---------
+async def negotiate(client, mtu: int = 247, phy: int = 2,
+                    profile: LinkProfile = None) -> LinkProfile:
+    """MTU / PHY を要求して、決まった値を profile に書く (失敗は errors に残して続ける)。
+
+    profile を渡すと接続パラメータだけ書き換える (再接続したとき。probe の値は残る)。
+    """
+    profile = profile or LinkProfile()
+    profile.address = getattr(client, "address", profile.address)
+    profile.mtu = profile.phy = profile.interval_ms = None
+    profile.errors = {}
+
+    request_mtu = getattr(client, "request_mtu", None)
+    backend = getattr(client, "_backend", None)
+    try:
+        if request_mtu is not None:
+            result = await request_mtu(mtu)
+            if isinstance(result, int):
+                profile.mtu = result
+        elif hasattr(backend, "_acquire_mtu"):
+            # BlueZ: 交換済みの MTU を取りに行かないと mtu_size が 23 のまま
+            await backend._acquire_mtu()
+    except Exception as e:
+        profile.errors["mtu"] = str(e) or type(e).__name__
+    if profile.mtu is None:
+        profile.mtu = getattr(client, "mtu_size", None)
+
+    request_phy = getattr(client, "request_phy", None)
+    if request_phy is None:
+        profile.errors["phy"] = "not supported by this backend"
+    else:
+        try:
+            await request_phy(phy)
+            profile.phy = {1: "1M", 2: "2M", 3: "coded"}.get(phy, phy)
+        except Exception as e:
+            profile.errors["phy"] = str(e) or type(e).__name__
+
+    interval = getattr(client, "connection_interval", None)
+    if isinstance(interval, (int, float)):
+        profile.interval_ms = float(interval)
+    log.info("%s: mtu=%s phy=%s interval=%s", profile.address, profile.mtu, profile.phy,
+             profile.interval_ms)
+    return profile
+
+
+# --------- スループットの実測 ---------
+def analyze(times, sizes, duration: float, profile: LinkProfile = None,
+            burst_gap: float = BURST_GAP_S) -> LinkProfile:
+    """到着時刻 [s] とパケット長の列から、スループットと接続間隔の推定値を求める。"""
+    profile = profile or LinkProfile()
+    n = len(times)
+    profile.probe_s = duration
+    profile.packets = n
+    profile.bytes = sum(sizes)
+    profile.bytes_per_s = profile.bytes / duration if duration > 0 else None
+    profile.packets_per_s = n / duration if duration > 0 else None
+    if not n:
+        return profile
+    profile.max_packet = max(sizes)
+    profile.mean_packet = profile.bytes / n
+    gaps = [b - a for a, b in zip(times, times[1:]) if b - a > burst_gap]
+    events = len(gaps) + 1
+    profile.packets_per_event = n / events
+    if gaps:
+        gaps.sort()
+        profile.est_interval_ms = statistics.median(gaps) * 1e3
+        profile.gap_p99_ms = gaps[min(len(gaps) - 1, int(0.99 * len(gaps)))] * 1e3
+    return profile
+
+
+async def probe(client, char_uuid: str, duration: float = 1.0, profile: LinkProfile = None,
+                forward=None, clock=time.perf_counter) -> LinkProfile:
+    """duration 秒 Notify を受けて実測する。forward があれば受けたパケットも渡す。
+
+    終わったら stop_notify する (受信を続けるなら呼び出し側で start_notify し直す)。
+    """
+    times, sizes = [], []
+
+    def on_notify(sender, data):
+        times.append(clock())
+        sizes.append(len(data))
+        if forward is not None:
+            forward(sender, data)
+
+    await client.start_notify(char_uuid, on_notify)
+    t0 = clock()
+    try:
+        await asyncio.sleep(duration)
+    finally:
+        await client.stop_notify(char_uuid)
+    profile = analyze(times, sizes, clock() - t0, profile)
+    log.info("%s: %.0f B/s, %.1f pkt/s, max %s B, interval ~%s ms, %.1f pkt/event",
+             profile.address, profile.bytes_per_s or 0, profile.packets_per_s or 0,
+             profile.max_packet,
+             f"{profile.est_interval_ms:.1f}" if profile.est_interval_ms else "?",
+             profile.packets_per_event or 0)
+    return profile
+
+
+async def tune(client, char_uuid: str, mtu: int = 247, phy: int = 2, probe_s: float = 1.0,
+               forward=None) -> LinkProfile:
+    """negotiate してから probe する (probe_s <= 0 なら negotiate だけ)。"""
+    profile = await negotiate(client, mtu, phy)
+    if probe_s > 0:
+        await probe(client, char_uuid, probe_s, profile, forward)
+    return profile
+
+
+# --------- バッファの大きさ ---------
+def size_buffers(profile: LinkProfile = None, headroom_s: float = 0.5, min_capacity: int = 16,
+                 max_capacity: int = 4096, default_slot: int = 512) -> dict:
+    """実測値から Pipeline の capacity / slot_size とジッタバッファの初期目標を決める。
+
+    capacity はデコードが headroom_s 秒止まっても捨てずに済む数 (1 回の connection
+    event 分の 4 倍は必ず確保、2 のべき乗に切り上げ)。slot_size は届いた最大長と
+    MTU から決まる最大長の大きい方 (32 バイト単位)。初期目標はまとまり同士の
+    間隔の 99 パーセンタイルの 2 倍。実測できていない値は従来の既定値を使う。
+    """
+    sizes = {"capacity": 64, "slot_size": default_slot, "initial_target_ms": 80.0}
+    if profile is None:
+        return sizes
+    longest = max(profile.max_packet or 0, profile.max_payload or 0)
+    if longest:
+        sizes["slot_size"] = 32 * math.ceil(longest / 32)
+    if profile.packets_per_s:
+        need = max(profile.packets_per_s * headroom_s, 4 * (profile.packets_per_event or 1),
+                   min_capacity)
+        sizes["capacity"] = min(max_capacity, 1 << math.ceil(math.log2(need)))
+    if profile.gap_p99_ms:
+        sizes["initial_target_ms"] = min(400.0, max(20.0, 2.0 * profile.gap_p99_ms))
+    return sizes
+
+
+if __name__ == "__main__":
+    # 偽の client で negotiate / probe / size_buffers を確かめる
+    from .fake import FakeBleakClient, FakeDevice
+    from .synth import adpcm_packets
+
+    # 15 ms ごとに 3 パケットずつ (connection event ごとにまとめて届く) 132 バイト
+    times = [e * 0.015 + k * 0.0002 for e in range(200) for k in range(3)]
+    p = analyze(times, [132] * len(times), 3.0)
+    assert abs(p.est_interval_ms - 15.0) < 0.5 and abs(p.packets_per_event - 3.0) < 0.01, p.stats()
+    assert p.packets_per_s == 200.0 and p.bytes_per_s == 200.0 * 132
+    sizes = size_buffers(p)
+    assert sizes["capacity"] == 128 and sizes["slot_size"] == 160, sizes
+    assert abs(sizes["initial_target_ms"] - 2 * 14.6) < 0.1, sizes
+    assert size_buffers(None)["capacity"] == 64 and size_buffers(analyze([], [], 1.0))["slot_size"] == 512
+
+    class TunableClient(FakeBleakClient):
+        mtu_size = 185
+
+        async def request_phy(self, phy):
+            if phy != 2:
+                raise ValueError("unsupported PHY")
+
+    async def check():
+        packets = adpcm_packets(400)
+        client = TunableClient(FakeDevice("CatVoiceStreamer", "AA:01"), packets, interval=0.004)
+        await client.connect()
+        forwarded = []
+        profile = await tune(client, "tx", probe_s=0.3, forward=lambda _, d: forwarded.append(d))
+        assert profile.mtu == 185 and profile.max_payload == 182 and profile.phy == "2M"
+        assert "mtu" not in profile.errors and len(forwarded) == profile.packets > 10
+        assert profile.max_packet == len(packets[0]) and 150 < profile.packets_per_s < 260
+        assert size_buffers(profile)["slot_size"] == 192
+
+        # request_mtu / request_phy のない素の client: mtu_size を読むだけ
+        plain = FakeBleakClient(FakeDevice(None, "AA:02"))
+        profile = await negotiate(plain)
+        assert profile.mtu is None and "phy" in profile.errors
+        return profile
+
+    print(asyncio.run(check()).stats())
+    print("negotiate / probe / size_buffers: OK")
@@ -0,0 +1,510 @@
+"""受信側の計測値 (counter / gauge / histogram) をまとめる registry と出力先。
+
+ble_mic_ok は Notify のたびに time.time() と print をしていたが、ここでは
+ホットパスでは整数の加算と固定バケットへの振り分けだけを行い、値を読み出して
+整形するのは exporter が interval 秒ごとに (または HTTP で聞かれたときに) 行う。
+ホットパスの更新はデコード 1 回の 1% 未満 (python -m nelrx.metrics で更新だけを
+切り出して確認する。デコード込みの差は測定のゆれに埋もれるので保証しない)。
+
+    Counter    : 増えるだけの値 (bytes / packets / 欠落数など)
+    Gauge      : その時点の値 (キューの深さ / 切れていた時間など)
+    Histogram  : 固定バケットの度数分布 (デコード時間 / seq の飛び幅)
+
+Counter と Gauge は fn を渡すと、読み出すときに fn() を呼ぶ (既存の stats() が
+持っている値をホットパスに何も足さずに出せる)。各メトリクスを更新するのは
+1 つのスレッドだけにすること (読み出しはどのスレッドからでもよい)。
+
+出力先 (exporter) は export(registry) を持つもの:
+
+    LogExporter         : 1 行のログ (counter は前回からの毎秒の値も)
+    JsonFileExporter    : snapshot() を JSON ファイルに書き換える
+    PrometheusExporter  : http://127.0.0.1:9464/metrics で Prometheus のテキスト形式
+
+    registry = MetricsRegistry()
+    m = ReceiverMetrics(registry)
+    m.watch_pipeline(pipeline); m.watch_decoder(decoder)
+    await MetricsReporter(registry, [LogExporter()], interval=10).run(stop)
+"""
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from pathlib import Path
+
+log = logging.getLogger("nelrx.metrics")
+
+# デコード 1 回 (数十 µs) から Notify の詰まり (数十 ms) まで
+LATENCY_BUCKETS = (10e-6, 25e-6, 50e-6, 100e-6, 250e-6, 500e-6,
+                   1e-3, 2.5e-3, 5e-3, 10e-3, 25e-3, 50e-3, 100e-3)
+# seq の飛び幅 (何パケット続けて欠けたか)。max_gap (64) まで
+GAP_BUCKETS = (1, 2, 3, 4, 6, 8, 12, 16, 24, 32, 48, 64)
+# デコード時間は TIME_EVERY パケットに 1 回だけ測る (perf_counter 2 回分を 1% 未満に)
+TIME_EVERY = 16
+
+
+def _series(name: str, labels: dict) -> str:
+    if not labels:
+        return name
+    return name + "{" + ",".join(f'{k}="{v}"' for k, v in sorted(labels.items())) + "}"
+
+
+class Counter:
+    kind = "counter"
+    __slots__ = ("name", "help", "labels", "value", "fn")
+
+    def __init__(self, name: str, help: str = "", labels: dict = None, fn=None):
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+        self.value = 0
+        self.fn = fn
+
+    def inc(self, n=1) -> None:
+        self.value += n
+
+    def get(self):
+        return self.fn() if self.fn is not None else self.value
+
+
+class Gauge(Counter):
+    kind = "gauge"
+    __slots__ = ()
+
+    def set(self, value) -> None:
+        self.value = value
+
+    def dec(self, n=1) -> None:
+        self.value -= n
+
+
+class Histogram:
+    """bounds は各バケットの上限 (昇順)。最後に +Inf のバケットが付く。
+
+    counts はあらかじめ確保したリストで、observe() は該当バケットを 1 増やすだけ。
+    """
+    kind = "histogram"
+    __slots__ = ("name", "help", "labels", "bounds", "counts", "sum", "count")
+
+    def __init__(self, name: str, help: str = "", labels: dict = None,
+                 buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+        self.bounds = tuple(buckets)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float):
+        """q 分位点が入っているバケットの上限 (+Inf のバケットなら最後の上限)。空なら None。"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.bounds, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return self.bounds[-1]
+
+    def get(self) -> dict:
+        cumulative, seen = {}, 0
+        for bound, n in zip(self.bounds, self.counts):
+            seen += n
+            cumulative[repr(bound)] = seen
+        cumulative["+Inf"] = self.count
+        return {"count": self.count, "sum": self.sum, "buckets": cumulative,
+                "p50": self.quantile(0.5), "p99": self.quantile(0.99)}
+
+
+class MetricsRegistry:
+    """名前 + labels ごとに 1 つのメトリクス。同じものを 2 回作ると最初のものを返す。"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self.created = time.time()
+
+    def _get(self, cls, name, help, labels, **options):
+        key = _series(name, labels)
+        with self._lock:
+            metric = self._metrics.get(key)
+            if metric is None:
+                metric = self._metrics[key] = cls(name, help, labels, **options)
+            elif metric.kind != cls.kind:
+                raise ValueError(f"{key} is already registered as a {metric.kind}")
+            return metric
+
+    def counter(self, name: str, help: str = "", labels: dict = None, fn=None) -> Counter:
+        return self._get(Counter, name, help, labels, fn=fn)
+
+    def gauge(self, name: str, help: str = "", labels: dict = None, fn=None) -> Gauge:
+        return self._get(Gauge, name, help, labels, fn=fn)
+
+    def histogram(self, name: str, help: str = "", labels: dict = None,
+                  buckets=LATENCY_BUCKETS) -> Histogram:
+        return self._get(Histogram, name, help, labels, buckets=buckets)
+
+    def metrics(self) -> list:
+        with self._lock:
+            return list(self._metrics.values())
+
+    def _read(self, metric):
+        try:
+            return metric.get()
+        except Exception as e:     # fn の参照先がもう閉じている など
+            log.debug("%s: %s", metric.name, e)
+            return None
+
+    def snapshot(self) -> dict:
+        """{series: 値} (histogram は count / sum / 累積バケット / p50 / p99 の dict)。"""
+        return {_series(m.name, m.labels): self._read(m) for m in self.metrics()}
+
+    def prometheus(self) -> str:
+        """Prometheus のテキスト形式 (version 0.0.4)。"""
+        lines, described = [], set()
+        for m in sorted(self.metrics(), key=lambda m: m.name):
+            if m.name not in described:
+                described.add(m.name)
+                if m.help:
+                    lines.append(f"# HELP {m.name} {m.help}")
+                lines.append(f"# TYPE {m.name} {m.kind}")
+            value = self._read(m)
+            if value is None:
+                continue
+            if m.kind != "histogram":
+                lines.append(f"{_series(m.name, m.labels)} {value}")
+                continue
+            for le, n in value["buckets"].items():
+                lines.append(f"{_series(m.name + '_bucket', dict(m.labels, le=le))} {n}")
+            lines.append(f"{_series(m.name + '_sum', m.labels)} {value['sum']}")
+            lines.append(f"{_series(m.name + '_count', m.labels)} {value['count']}")
+        return "\n".join(lines) + "\n"
+
+
+# --------- 受信側の共通メトリクス ---------
+class ReceiverMetrics:
+    """受信スクリプト / CLI / ハブで共通の名前のメトリクス。
+
+    ホットパスで更新するのは rx_bytes / rx_packets (Notify を受けたスレッド)、
+    decode_seconds (デコードするスレッド、TIME_EVERY 回に 1 回) と seq_gap
+    (ConcealingDecoder が欠落を見つけたとき) だけ。counts (.bytes / .packets を
+    数えているオブジェクト) を渡せば rx_bytes / rx_packets もそこから読むので、
+    ホットパスで足すものはない。残りは watch_* で登録したオブジェクトの値を
+    読み出し時に取りに行く。labels はハブでデバイスを区別する用。
+    """
+
+    def __init__(self, registry: MetricsRegistry, labels: dict = None, counts=None):
+        self.registry = registry
+        self.labels = labels or {}
+        self.rx_bytes = registry.counter(
+            "nelrx_rx_bytes_total", "received bytes", labels,
+            fn=(lambda: counts.bytes) if counts is not None else None)
+        self.rx_packets = registry.counter(
+            "nelrx_rx_packets_total", "received packets / chunks", labels,
+            fn=(lambda: counts.packets) if counts is not None else None)
+        self.decode_seconds = registry.histogram(
+            "nelrx_decode_seconds", f"decode time per packet (1 in {TIME_EVERY} sampled)", labels)
+        self.seq_gap = registry.histogram("nelrx_seq_gap_packets",
+                                          "consecutive packets lost per gap", labels, GAP_BUCKETS)
+
+    def received(self, nbytes: int) -> None:
+        """Notify 1 つ分 (counts を渡していないとき)。inc() 2 回より呼び出しが 1 回少ない。"""
+        self.rx_packets.value += 1
+        self.rx_bytes.value += nbytes
+
+    def _gauge(self, name, help, fn):
+        self.registry.gauge(name, help, self.labels, fn=fn)
+
+    def _counter(self, name, help, fn):
+        self.registry.counter(name, help, self.labels, fn=fn)
+
+    def watch_decoder(self, decoder) -> None:
+        """ConcealingDecoder (または AdpcmHeaderCodec.decoder)。seq の飛び幅も記録させる。"""
+        decoder.gap_hist = self.seq_gap
+        tracker = decoder.tracker
+        self._counter("nelrx_seq_lost_total", "packets lost (concealed)", lambda: tracker.lost)
+        self._counter("nelrx_seq_reordered_total", "late packets dropped",
+                      lambda: tracker.reordered)
+        self._counter("nelrx_seq_resyncs_total", "decoder resyncs", lambda: tracker.resyncs)
+
+    def watch_pipeline(self, pipeline) -> None:
+        ring = pipeline.ring
+        self._gauge("nelrx_queue_depth", "packets waiting for the decoder", lambda: ring.depth)
+        self._gauge("nelrx_queue_capacity", "pipeline capacity", lambda: ring.capacity)
+        self._counter("nelrx_queue_dropped_total", "packets dropped by the pipeline",
+                      lambda: ring.dropped_newest + ring.dropped_oldest)
+
+    def watch_sink(self, sink) -> None:
+        """JitterSpeakerSink があれば underrun とバッファの深さを出す (TeeSink の中も探す)。"""
+        for s in getattr(sink, "sinks", (sink,)):
+            buffer = getattr(s, "buffer", None)
+            if buffer is None or not hasattr(buffer, "underruns"):
+                continue
+            self._counter("nelrx_audio_underruns_total", "jitter buffer underruns",
+                          lambda: buffer.underruns)
+            self._gauge("nelrx_audio_buffer_seconds", "audio waiting in the jitter buffer",
+                        lambda: buffer.depth / buffer.samplerate)
+            self._gauge("nelrx_audio_latency_seconds", "receive to playback latency",
+                        lambda: buffer.latency)
+
+    def watch_link(self, supervisor) -> None:
+        """supervisor.LinkSupervisor の再接続回数と切れていた時間。"""
+        self._counter("nelrx_reconnects_total", "BLE reconnects",
+                      lambda: max(0, supervisor.connects - 1))
+        self._counter("nelrx_connect_failures_total", "failed BLE connection attempts",
+                      lambda: supervisor.failures)
+        self._gauge("nelrx_link_downtime_seconds", "time spent disconnected",
+                    lambda: supervisor.stats()["downtime_s"])
+        self._gauge("nelrx_link_up", "1 while connected",
+                    lambda: int(supervisor.client is not None))
+
+
+# --------- 出力先 ---------
+class LogExporter:
+    """counter は値と前回からの毎秒の増え方、gauge は値、histogram は p50 / p99 を 1 行に。
+
+    names を渡すとその名前のメトリクスだけ出す。emit (例えば print) で出力先を変えられる。
+    """
+
+    def __init__(self, emit=None, names=None, logger=log, level=logging.INFO):
+        self.emit = emit or (lambda line: logger.log(level, line))
+        self.names = set(names) if names else None
+        self._last = {}
+        self._last_t = None
+
+    def export(self, registry: MetricsRegistry) -> None:
+        now = time.monotonic()
+        dt = now - self._last_t if self._last_t is not None else None
+        parts = []
+        for m in registry.metrics():
+            if self.names is not None and m.name not in self.names:
+                continue
+            key = _series(m.name, m.labels)
+            value = registry._read(m)
+            if value is None:
+                continue
+            if m.kind == "histogram":
+                if value["count"]:
+                    parts.append(f"{key} n={value['count']} p50<={value['p50']:g} "
+                                 f"p99<={value['p99']:g}")
+            elif m.kind == "counter" and dt:
+                parts.append(f"{key}={value:g} ({(value - self._last.get(key, 0)) / dt:.1f}/s)")
+                self._last[key] = value
+            else:
+                parts.append(f"{key}={value:g}")
+                self._last[key] = value
+        self._last_t = now
+        self.emit("  ".join(parts))
+
+    def close(self) -> None:
+        pass
+
+
+class JsonFileExporter:
+    """snapshot() を path に書く (一時ファイル → rename なので読み手は壊れたものを見ない)。"""
+
+    def __init__(self, path):
+        self.path = Path(path)
+
+    def export(self, registry: MetricsRegistry) -> None:
+        doc = {"time": time.time(), "started": registry.created, "metrics": registry.snapshot()}
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        try:
+            with open(tmp, "w") as f:
+                json.dump(doc, f, indent=1)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            log.warning("cannot write %s: %s", self.path, e)
+
+    def close(self) -> None:
+        pass
+
+
+class PrometheusExporter:
+    """GET /metrics に Prometheus のテキスト形式で答える HTTP サーバ (別スレッド)。
+
+    聞かれたときに読み出すので export() は何もしない。port=0 なら空いている番号
+    (実際の番号は self.port)。
+    """
+
+    def __init__(self, registry: MetricsRegistry, port: int = 9464, host: str = "127.0.0.1"):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = registry.prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, fmt, *args):
+                log.debug("%s " + fmt, self.client_address[0], *args)
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self.host, self.port = self._server.server_address[:2]
+        self._thread = threading.Thread(target=self._server.serve_forever, name="nelrx-metrics",
+                                        daemon=True)
+        self._thread.start()
+        log.info("metrics on http://%s:%d/metrics", self.host, self.port)
+
+    def export(self, registry: MetricsRegistry) -> None:
+        pass
+
+    def close(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class MetricsReporter:
+    """interval 秒ごとに全 exporter の export() を呼ぶ。止まるときにもう 1 回出して close する。"""
+
+    def __init__(self, registry: MetricsRegistry, exporters, interval: float = 10.0):
+        self.registry = registry
+        self.exporters = list(exporters)
+        self.interval = interval
+
+    def export(self) -> None:
+        for exporter in self.exporters:
+            try:
+                exporter.export(self.registry)
+            except Exception:
+                log.exception("%s failed", type(exporter).__name__)
+
+    async def run(self, stop: asyncio.Event = None) -> None:
+        stop = stop or asyncio.Event()
+        try:
+            while not stop.is_set():
+                try:
+                    await asyncio.wait_for(stop.wait(), self.interval)
+                except asyncio.TimeoutError:
+                    pass
+                self.export()
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        for exporter in self.exporters:
+            try:
+                exporter.close()
+            except Exception:
+                log.exception("closing %s failed", type(exporter).__name__)
+
+
+if __name__ == "__main__":
+    # ホットパスの更新が確保なしで、デコードの 1% 未満に収まること / 出力の形式
+    # 保証する (assert する) のは更新だけを切り出して測ったコスト。デコード込みで
+    # 比べた値は、同じ関数どうしを比べても ±3% ほどゆれる (1 コアの VM で確認) ので
+    # 目安として表示するだけにしている
+    import tempfile
+    import tracemalloc
+    import urllib.request
+
+    from .conceal import ConcealingDecoder
+    from .sinks import NullSink
+    from .synth import adpcm_packets, lossy
+
+    packets = list(lossy(adpcm_packets(4000, seed=3), loss=0.02, seed=3))
+    registry = MetricsRegistry()
+    m = ReceiverMetrics(registry, {"device": "AA:01"})
+    decoder = ConcealingDecoder()
+    m.watch_decoder(decoder)
+    sink = NullSink()
+    perf_counter = time.perf_counter
+
+    def plain(packet):
+        decoder.decode_packet(packet, sink.write)
+
+    rx_packets, received, decode_seconds = m.rx_packets, m.received, m.decode_seconds
+
+    def instrumented(packet):
+        # ble_mic_ok の play_packet と同じ形 (CLI / ハブは bytes / packets を足さない分さらに軽い)
+        received(len(packet))
+        if rx_packets.value % TIME_EVERY:
+            decoder.decode_packet(packet, sink.write)
+        else:
+            t0 = perf_counter()
+            decoder.decode_packet(packet, sink.write)
+            decode_seconds.observe(perf_counter() - t0)
+
+    def updates_only(packet):
+        received(len(packet))
+        if not rx_packets.value % TIME_EVERY:
+            t0 = perf_counter()
+            decode_seconds.observe(perf_counter() - t0)
+
+    def noop(packet):
+        pass
+
+    def run(fn):
+        t0 = perf_counter()
+        for p in packets:
+            fn(p)
+        return perf_counter() - t0
+
+    for p in packets[:200]:          # numpy とバケットのリストを温めておく
+        instrumented(p)
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for p in packets:
+        updates_only(p)
+    grown = sum(s.size_diff for s in tracemalloc.take_snapshot().compare_to(before, "filename")
+                if s.size_diff > 0 and s.traceback[0].filename == __file__)
+    tracemalloc.stop()
+    assert grown < 512, f"hot-path updates allocated {grown} B"
+
+    # 負荷のゆらぎが大きいので、同じ回の中で測った比の中央値で見る
+    ratios, decodes, boths = [], [], []
+    for _ in range(9):
+        call = run(noop)                 # ループと関数呼び出しの分は差し引く
+        decode = run(plain) - call
+        ratios.append((run(updates_only) - call) / decode)
+        boths.append((run(instrumented) - call) / decode - 1)
+        decodes.append(decode / len(packets))
+    ratios.sort()
+    overhead = ratios[len(ratios) // 2]
+    decode = sorted(decodes)[len(decodes) // 2]
+    print(f"decode {decode * 1e6:.1f} us/packet, metric updates {overhead * decode * 1e6:.3f} us "
+          f"({overhead:.2%}), end to end {sorted(boths)[len(boths) // 2]:+.2%} (not checked)")
+    assert overhead < 0.01, overhead
+
+    snap = registry.snapshot()
+    key = 'nelrx_rx_packets_total{device="AA:01"}'
+    assert snap[key] == rx_packets.value and snap['nelrx_seq_lost_total{device="AA:01"}'] > 0
+    gaps = snap['nelrx_seq_gap_packets{device="AA:01"}']
+    assert gaps["count"] > 0 and gaps["buckets"]["+Inf"] == gaps["count"]
+
+    lines = []
+    LogExporter(emit=lines.append).export(registry)
+    assert "nelrx_decode_seconds" in lines[0]
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "metrics.json")
+        JsonFileExporter(path).export(registry)
+        with open(path) as f:
+            assert json.load(f)["metrics"][key] == rx_packets.value
+
+    prom = PrometheusExporter(registry, port=0)
+    try:
+        with urllib.request.urlopen(f"http://{prom.host}:{prom.port}/metrics", timeout=5) as r:
+            text = r.read().decode()
+    finally:
+        prom.close()
+    assert "# TYPE nelrx_decode_seconds histogram" in text
+    assert 'nelrx_decode_seconds_bucket{device="AA:01",le="+Inf"}' in text
+    assert f"{key} {rx_packets.value}" in text
+    print(lines[0][:200])
+    print("allocation-free updates / overhead / log / json / prometheus: OK")
@@ -0,0 +1,244 @@
+"""受信コールバックとデコード / 再生を切り離すためのリングバッファとワーカー。
+
+BLE の Notify コールバックはパケットを PacketRing にコピーするだけにして、
+デコードと sink への書き込みは別スレッドの Pipeline ワーカーで行う。
+書き手 1 / 読み手 1 を前提にしたロックなしのリングで、書き手は head、
+読み手は tail だけを進める (どちらも単調増加のカウンタ)。各スロットには
+何番目のパケットが入っているかを書き込みの前後で記録し (書いている間は -1)、
+読み手はコピーの前後でそれが tail のままか確かめる (drop-oldest で読んでいる
+スロットを書き手が上書きしても、混ざったパケットを渡さない)。
+
+満杯時のポリシー:
+- "drop-newest" : 新しく来たパケットを捨てる
+- "drop-oldest" : いちばん古い未読パケットを上書きする (読み手が追い越しを検出して数える)
+- "block"       : 空くまで push を待たせる (ファイルの再生など、捨てたくない入力用)
+"""
+import logging
+import threading
+
+log = logging.getLogger("nelrx.pipeline")
+
+DROP_NEWEST = "drop-newest"
+DROP_OLDEST = "drop-oldest"
+BLOCK = "block"
+POLICIES = (DROP_NEWEST, DROP_OLDEST, BLOCK)
+
+
+class PacketRing:
+    """固定長スロットを事前確保した SPSC リング。"""
+
+    def __init__(self, capacity: int = 64, slot_size: int = 512, policy: str = DROP_OLDEST):
+        if policy not in POLICIES:
+            raise ValueError(f"unknown drop policy: {policy}")
+        self.capacity = capacity
+        self.slot_size = slot_size
+        self.policy = policy
+        self._buf = bytearray(capacity * slot_size)
+        self._view = memoryview(self._buf)
+        self._lengths = [0] * capacity
+        self._seqs = [-1] * capacity   # スロットに入っているパケットの番号 (-1: 書き込み中 / 空)
+        self._head = 0            # 書き手だけが進める
+        self._tail = 0            # 読み手だけが進める
+        self.pushed = 0
+        self.popped = 0
+        self.dropped_newest = 0   # 満杯で捨てた新着
+        self.dropped_oldest = 0   # 上書きされて読めなかった古いもの
+        self.oversize = 0         # slot_size を超えて捨てたもの
+        self.max_depth = 0
+
+    @property
+    def depth(self) -> int:
+        return min(self._head - self._tail, self.capacity)
+
+    @property
+    def dropped(self) -> int:
+        return self.dropped_newest + self.dropped_oldest + self.oversize
+
+    def push(self, data) -> bool:
+        """書き手側。パケットをスロットにコピーする。捨てたら False。"""
+        n = len(data)
+        if n > self.slot_size:
+            self.oversize += 1
+            return False
+        head = self._head
+        depth = head - self._tail
+        if depth >= self.capacity and self.policy != DROP_OLDEST:
+            self.dropped_newest += 1
+            return False
+        i = head % self.capacity
+        off = i * self.slot_size
+        self._seqs[i] = -1
+        self._view[off:off + n] = data
+        self._lengths[i] = n
+        self._seqs[i] = head
+        self._head = head + 1
+        self.pushed += 1
+        if depth + 1 > self.max_depth:
+            self.max_depth = min(depth + 1, self.capacity)
+        return True
+
+    def pop_into(self, out) -> int:
+        """読み手側。次のパケットを out (bytearray / memoryview) にコピーしてバイト数を返す。
+
+        空なら -1。drop-oldest で追い越された分は読み飛ばして dropped_oldest に数える。
+        """
+        while True:
+            tail = self._tail
+            head = self._head
+            if tail == head:
+                return -1
+            if head - tail > self.capacity:
+                # 書き手に一周以上追い越された
+                self.dropped_oldest += head - self.capacity - tail
+                self._tail = tail = head - self.capacity
+            i = tail % self.capacity
+            if self._seqs[i] != tail:
+                continue               # 書き手が上書き中 (head が進むのを待って読み飛ばす)
+            n = self._lengths[i]
+            off = i * self.slot_size
+            out[:n] = self._view[off:off + n]
+            # コピー中に上書きされていないか確認 (されていたら読み直す)
+            if self._seqs[i] != tail:
+                continue
+            self._tail = tail + 1
+            self.popped += 1
+            return n
+
+
+class Pipeline:
+    """PacketRing + ワーカースレッド。
+
+    handle(packet: memoryview) はワーカースレッドで 1 パケットずつ呼ばれる。
+    push() はコールバック側 (BLE の Notify など) から呼ぶ。
+    """
+
+    def __init__(self, handle, capacity: int = 64, slot_size: int = 512,
+                 policy: str = DROP_OLDEST, name: str = "nelrx-pipeline"):
+        self.ring = PacketRing(capacity, slot_size, policy)
+        self.handle = handle
+        self.errors = 0
+        self._wake = threading.Event()
+        self._space = threading.Event()   # block のとき、読み手が 1 つ取り出すたびにセット
+        self._running = False
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+
+    def push(self, data) -> bool:
+        ring = self.ring
+        if ring.policy == BLOCK:
+            while True:
+                self._space.clear()
+                if ring.depth < ring.capacity or not self._running:
+                    break
+                self._wake.set()
+                self._space.wait(0.1)
+        ok = ring.push(data)
+        self._wake.set()
+        return ok
+
+    def start(self) -> "Pipeline":
+        self._running = True
+        self._thread.start()
+        return self
+
+    def stop(self, timeout: float = 2.0) -> None:
+        """溜まっている分を処理し終えてからワーカーを止める。"""
+        self._running = False
+        self._wake.set()
+        self._thread.join(timeout)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def stats(self) -> dict:
+        ring = self.ring
+        return {
+            "depth": ring.depth,
+            "max_depth": ring.max_depth,
+            "pushed": ring.pushed,
+            "handled": ring.popped,
+            "dropped_newest": ring.dropped_newest,
+            "dropped_oldest": ring.dropped_oldest,
+            "oversize": ring.oversize,
+            "errors": self.errors,
+        }
+
+    def _run(self) -> None:
+        scratch = bytearray(self.ring.slot_size)
+        view = memoryview(scratch)
+        ring = self.ring
+        block = ring.policy == BLOCK
+        while True:
+            n = ring.pop_into(scratch)
+            if n < 0:
+                if not self._running:
+                    return
+                self._wake.wait(0.1)
+                self._wake.clear()
+                continue
+            if block:
+                self._space.set()
+            try:
+                self.handle(view[:n])
+            except Exception:
+                self.errors += 1
+                log.exception("pipeline handler failed")
+
+
+if __name__ == "__main__":
+    # drop-oldest で、読んでいるスロットが上書きされても混ざったパケットを返さないこと
+    import struct
+    import sys
+    import time
+
+    def packet(k):
+        return struct.pack("<I", k) + bytes([k & 0xFF]) * (4 + k % 40)
+
+    # 読み手のコピー中に書き手が割り込んで同じスロットを上書きする
+    ring = PacketRing(capacity=4, slot_size=64, policy=DROP_OLDEST)
+    for k in range(4):
+        ring.push(packet(k))
+
+    class Interrupted:
+        def __init__(self):
+            self.buf = bytearray(64)
+            self.fired = False
+
+        def __setitem__(self, key, value):
+            if not self.fired:
+                self.fired = True
+                ring.push(packet(4))       # tail のスロットに 4 番が入る
+            self.buf[key] = value
+
+    out = Interrupted()
+    n = ring.pop_into(out)
+    k = struct.unpack_from("<I", out.buf)[0]
+    assert k == 1 and bytes(out.buf[:n]) == packet(1) and ring.dropped_oldest == 1, (k, n)
+
+    # スレッドを細かく切り替えながら、書き手が読み手を追い越し続ける
+    sys.setswitchinterval(1e-6)
+    ring = PacketRing(capacity=4, slot_size=64, policy=DROP_OLDEST)
+    total = 100000
+
+    def write():
+        for k in range(total):
+            ring.push(packet(k))
+            if k % 3 == 0:
+                time.sleep(0)
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    buf, last, got = bytearray(64), -1, 0
+    while writer.is_alive() or ring._tail < ring._head:
+        n = ring.pop_into(buf)
+        if n < 0:
+            continue
+        k = struct.unpack_from("<I", buf)[0]
+        assert bytes(buf[:n]) == packet(k) and k > last, (k, last, n)
+        last, got = k, got + 1
+    writer.join()
+    assert got + ring.dropped_oldest == total, (got, ring.dropped_oldest)
+    print(f"{got} read, {ring.dropped_oldest} overwritten, none torn")
+    print("drop-oldest overwrite during read: OK")
@@ -0,0 +1,201 @@
+"""保存済みの PCM WAV を IMA-ADPCM WAV (WAVE_FORMAT_IMA_ADPCM) に詰め直す。
+
+16bit PCM の 1/4 弱の大きさになり、sox / ffmpeg などでもそのまま再生できる。
+エンコードはファームと同じ量子化 (adpcm.encode) を使う。
+
+ブロック構成 (モノラル):
+    int16 先頭サンプル, u8 step_index, u8 0, 以降 (block_align - 4) バイトの
+    ADPCM (下位ニブルが先)。1 ブロック = (block_align - 4) * 2 + 1 サンプル。
+
+    python -m nelrx.recompress session.wav            # → session.ima.wav
+    python -m nelrx.recompress *.wav -o archive --verify
+"""
+import argparse
+import logging
+import struct
+import sys
+import wave
+from pathlib import Path
+
+import numpy as np
+
+from . import adpcm
+
+log = logging.getLogger("nelrx.recompress")
+
+WAVE_FORMAT_IMA_ADPCM = 0x0011
+SUFFIX = ".ima.wav"
+
+
+def default_block_align(samplerate: int) -> int:
+    """Windows の ACM と同じ決め方 (8/11 kHz → 256, 22 kHz → 512, それ以上 → 1024)。"""
+    if samplerate <= 11025:
+        return 256
+    if samplerate <= 22050:
+        return 512
+    return 1024
+
+
+class ImaWavWriter:
+    """PCM (int16 モノラル) を受け取って IMA-ADPCM WAV に書く。
+
+    write() は sink と同じ形なので、受信スクリプトの出力先にも使える。
+    close() で端数ブロックを 0 埋めして RIFF / fact のサイズを書き戻す。
+    """
+
+    def __init__(self, path, samplerate: int, block_align: int = None):
+        self.path = str(path)
+        self.samplerate = samplerate
+        self.block_align = block_align or default_block_align(samplerate)
+        self.samples_per_block = (self.block_align - 4) * 2 + 1
+        self.samples = 0
+        self._pending = np.zeros(self.samples_per_block, dtype=np.int16)
+        self._pending_len = 0
+        self._step_index = 0
+        self._f = open(self.path, "wb")
+        self._write_header(0, 0)
+
+    def _write_header(self, data_bytes: int, samples: int) -> None:
+        fs, align, spb = self.samplerate, self.block_align, self.samples_per_block
+        fmt = struct.pack("<HHIIHHHH", WAVE_FORMAT_IMA_ADPCM, 1, fs,
+                          fs * align // spb, align, 4, 2, spb)
+        self._f.write(b"RIFF" + struct.pack("<I", 4 + 8 + len(fmt) + 12 + 8 + data_bytes)
+                      + b"WAVE"
+                      + b"fmt " + struct.pack("<I", len(fmt)) + fmt
+                      + b"fact" + struct.pack("<II", 4, samples)
+                      + b"data" + struct.pack("<I", data_bytes))
+        self._header_size = self._f.tell()
+
+    def _flush_block(self) -> None:
+        # 各ブロックは先頭サンプルそのものを予測値にして始める (step_index は引き継ぐ)
+        block = self._pending
+        predictor, step_index = int(block[0]), self._step_index
+        payload, (_, self._step_index) = adpcm.encode(block[1:], (predictor, step_index))
+        self._f.write(struct.pack("<hBB", predictor, step_index, 0) + payload)
+        self._pending_len = 0
+
+    def write(self, pcm) -> None:
+        pcm = np.asarray(pcm, dtype=np.int16)
+        self.samples += len(pcm)
+        spb = self.samples_per_block
+        pos = 0
+        while pos < len(pcm):
+            n = min(spb - self._pending_len, len(pcm) - pos)
+            self._pending[self._pending_len:self._pending_len + n] = pcm[pos:pos + n]
+            self._pending_len += n
+            pos += n
+            if self._pending_len == spb:
+                self._flush_block()
+
+    def close(self) -> None:
+        if self._f.closed:
+            return
+        if self._pending_len:
+            self._pending[self._pending_len:] = 0
+            self._flush_block()
+        data_bytes = self._f.tell() - self._header_size
+        self._f.seek(0)
+        self._write_header(data_bytes, self.samples)
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_ima_wav(path):
+    """IMA-ADPCM WAV (モノラル) を読んで (pcm int16, samplerate) を返す。"""
+    with open(path, "rb") as f:
+        data = f.read()
+    if data[:4] != b"RIFF" or data[8:12] != b"WAVE":
+        raise ValueError(f"{path}: not a RIFF/WAVE file")
+
+    fmt = samples = body = None
+    pos = 12
+    while pos + 8 <= len(data):
+        cid, size = data[pos:pos + 4], struct.unpack_from("<I", data, pos + 4)[0]
+        chunk = data[pos + 8:pos + 8 + size]
+        if cid == b"fmt ":
+            fmt = struct.unpack_from("<HHIIHH", chunk)
+        elif cid == b"fact":
+            samples = struct.unpack_from("<I", chunk)[0]
+        elif cid == b"data":
+            body = memoryview(data)[pos + 8:pos + 8 + size]
+        pos += 8 + size + (size & 1)
+    if fmt is None or body is None:
+        raise ValueError(f"{path}: missing fmt or data chunk")
+    tag, channels, samplerate, _, block_align, bits = fmt
+    if tag != WAVE_FORMAT_IMA_ADPCM or channels != 1 or bits != 4:
+        raise ValueError(f"{path}: only mono 4-bit IMA-ADPCM is supported "
+                         f"(format=0x{tag:04x}, channels={channels}, bits={bits})")
+
+    blocks = []
+    for off in range(0, len(body) - 3, block_align):
+        block = body[off:off + block_align]
+        predictor, step_index, _ = struct.unpack_from("<hBB", block)
+        pcm, _ = adpcm.decode(block[4:], (predictor, min(step_index, adpcm.STEP_INDEX_MAX)))
+        blocks.append(np.int16(predictor).reshape(1))
+        blocks.append(pcm)
+    pcm = np.concatenate(blocks) if blocks else np.zeros(0, dtype=np.int16)
+    if samples is not None:
+        pcm = pcm[:samples]
+    return pcm, samplerate
+
+
+def recompress(src, dst, block_align: int = None, chunk_frames: int = 65536):
+    """16bit モノラル PCM の WAV を dst に IMA-ADPCM WAV として書く。(サンプル数, fs) を返す。"""
+    with wave.open(str(src), "rb") as wf:
+        if wf.getnchannels() != 1 or wf.getsampwidth() != 2:
+            raise ValueError(f"{src}: only 16-bit mono PCM WAV is supported "
+                             f"(channels={wf.getnchannels()}, width={wf.getsampwidth()})")
+        fs = wf.getframerate()
+        with ImaWavWriter(dst, fs, block_align) as writer:
+            while True:
+                frames = wf.readframes(chunk_frames)
+                if not frames:
+                    break
+                writer.write(np.frombuffer(frames, dtype="<i2"))
+    return writer.samples, fs
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Re-compress 16-bit PCM WAV files to IMA-ADPCM WAV")
+    parser.add_argument("inputs", nargs="+", help="16-bit mono PCM WAV files")
+    parser.add_argument("-o", "--outdir", help="output directory (default: next to each input)")
+    parser.add_argument("--block-align", type=int, help="bytes per ADPCM block")
+    parser.add_argument("--verify", action="store_true",
+                        help="decode the result and report the SNR against the input")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    failed = 0
+    for name in args.inputs:
+        src = Path(name)
+        outdir = Path(args.outdir) if args.outdir else src.parent
+        outdir.mkdir(parents=True, exist_ok=True)
+        dst = outdir / (src.name[:-len(".wav")] + SUFFIX if src.name.endswith(".wav")
+                        else src.name + SUFFIX)
+        try:
+            samples, fs = recompress(src, dst, args.block_align)
+        except (OSError, ValueError, wave.Error) as e:
+            log.error("%s: %s", src, e)
+            failed += 1
+            continue
+        before, after = src.stat().st_size, dst.stat().st_size
+        msg = f"{src} → {dst}: {before} → {after} B ({after / before:.1%}), {samples / fs:.1f} s"
+        if args.verify:
+            with wave.open(str(src), "rb") as wf:
+                original = np.frombuffer(wf.readframes(wf.getnframes()), dtype="<i2")
+            decoded, _ = read_ima_wav(dst)
+            noise = np.mean((decoded.astype(np.float64) - original) ** 2)
+            power = np.mean(original.astype(np.float64) ** 2)
+            snr = 10 * np.log10(power / noise) if noise else float("inf")
+            msg += f", SNR {snr:.1f} dB"
+        log.info(msg)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,175 @@
+"""長時間の受信をそのままディスクに書いていく WAV レコーダ。
+
+セッション全体をメモリに溜めずに、一定量 / 一定時間ごとにファイルへ書き出し、
+そのたびに RIFF ヘッダのサイズを書き直す。プロセスが落ちても、最後の
+flush までの音はそのまま再生できる WAV として残る (失うのは最大 flush_interval 分)。
+
+max_seconds / max_bytes を指定すると、その長さでファイルを切り替える
+(session_20250101_120000_000.wav, ..._001.wav, ...)。
+"""
+import logging
+import os
+import struct
+import time
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+
+log = logging.getLogger("nelrx.recorder")
+
+WAV_HEADER_SIZE = 44
+
+
+def wav_header(samplerate: int, data_bytes: int) -> bytes:
+    """16bit モノラル PCM の 44 バイトヘッダ。"""
+    return struct.pack("<4sI4s4sIHHIIHH4sI",
+                       b"RIFF", 36 + data_bytes, b"WAVE",
+                       b"fmt ", 16, 1, 1, samplerate, samplerate * 2, 2, 16,
+                       b"data", data_bytes)
+
+
+class WavRecorder:
+    """PCM (int16 モノラル、ndarray でも bytes でも可) を WAV セグメントに書く sink。"""
+
+    def __init__(self, directory, samplerate: int, prefix: str = "session",
+                 max_seconds: float = None, max_bytes: int = None,
+                 flush_interval: float = 1.0, buffer_bytes: int = 64 * 1024,
+                 fsync: bool = False):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.samplerate = samplerate
+        self.prefix = prefix
+        self.flush_interval = flush_interval
+        self.fsync = fsync   # OS ごと落ちる場合にも備えるなら True
+
+        # 1 セグメントあたりのデータ部のバイト数の上限 (サンプル境界に揃える)
+        limits = []
+        if max_seconds:
+            limits.append(int(max_seconds * samplerate) * 2)
+        if max_bytes:
+            limits.append(max(2, (max_bytes - WAV_HEADER_SIZE) & ~1))
+        self.segment_limit = min(limits) if limits else None
+
+        self._buf = bytearray(buffer_bytes)
+        self._view = memoryview(self._buf)
+        self._buffered = 0
+        self._last_flush = time.monotonic()
+        self._f = None
+        self._data_bytes = 0      # 今のセグメントでファイルに書いた + バッファ中のバイト数
+        self._written = 0         # 今のセグメントでファイルに書いたバイト数
+        self._started = datetime.now().strftime("%Y%m%d_%H%M%S")
+        self.path = None
+        self.segments = []        # 書き終えたセグメントのパス
+        self.total_bytes = 0
+        self.flushes = 0
+
+    # ---------- セグメント ----------
+    def _open_segment(self) -> None:
+        index = len(self.segments)
+        self.path = self.directory / f"{self.prefix}_{self._started}_{index:03d}.wav"
+        self._f = open(self.path, "wb")
+        self._f.write(wav_header(self.samplerate, 0))
+        self._data_bytes = 0
+        self._written = 0
+        log.info("recording to %s", self.path)
+
+    def _close_segment(self) -> None:
+        self._flush_buffer()
+        self._f.close()
+        self._f = None
+        self.segments.append(self.path)
+
+    # ---------- 書き込み ----------
+    def write(self, pcm) -> None:
+        if isinstance(pcm, np.ndarray):
+            pcm = np.ascontiguousarray(pcm, dtype="<i2")
+        data = memoryview(pcm).cast("B")
+        pos = 0
+        while pos < len(data):
+            if self._f is None:
+                self._open_segment()
+            n = len(data) - pos
+            if self.segment_limit is not None:
+                n = min(n, self.segment_limit - self._data_bytes)
+            self._append(data[pos:pos + n])
+            pos += n
+            if self.segment_limit is not None and self._data_bytes >= self.segment_limit:
+                self._close_segment()
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def _append(self, data) -> None:
+        n = len(data)
+        self._data_bytes += n
+        self.total_bytes += n
+        if self._buffered + n > len(self._buf):
+            self._flush_buffer()
+            if n > len(self._buf):
+                self._f.write(data)
+                self._written += n
+                return
+        self._view[self._buffered:self._buffered + n] = data
+        self._buffered += n
+
+    def _flush_buffer(self) -> None:
+        if self._buffered:
+            self._f.write(self._view[:self._buffered])
+            self._written += self._buffered
+            self._buffered = 0
+        # ヘッダのサイズを今書いた分に合わせる (途中で落ちても読める WAV にしておく)
+        self._f.seek(4)
+        self._f.write(struct.pack("<I", 36 + self._written))
+        self._f.seek(40)
+        self._f.write(struct.pack("<I", self._written))
+        self._f.seek(0, os.SEEK_END)
+        self._f.flush()
+        if self.fsync:
+            os.fsync(self._f.fileno())
+        self.flushes += 1
+
+    def flush(self) -> None:
+        self._last_flush = time.monotonic()
+        if self._f is not None:
+            self._flush_buffer()
+
+    def close(self) -> None:
+        if self._f is not None:
+            self._close_segment()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def stats(self) -> dict:
+        return {
+            "segment": str(self.path) if self.path else None,
+            "segments": len(self.segments) + (self._f is not None),
+            "seconds": self.total_bytes / 2 / self.samplerate,
+            "flushes": self.flushes,
+        }
+
+
+if __name__ == "__main__":
+    # 途中で書き込みを止めても (= プロセスが落ちても) flush 済みの分は WAV として読めること
+    import tempfile
+    import wave
+
+    fs = 8000
+    with tempfile.TemporaryDirectory() as d:
+        rec = WavRecorder(d, fs, max_seconds=2.0, flush_interval=0.0, buffer_bytes=4096)
+        chunk = (np.arange(256) % 100).astype(np.int16)
+        for _ in range(fs * 5 // 256):
+            rec.write(chunk)
+        # close せずに現在のセグメントを読む (flush_interval=0 なので毎回書かれている)
+        with wave.open(str(rec.path)) as wf:
+            assert wf.getnframes() == rec._written // 2 > 0
+        rec.close()
+        frames = []
+        for path in rec.segments:
+            with wave.open(str(path)) as wf:
+                frames.append(wf.getnframes())
+        assert sum(frames) == (fs * 5 // 256) * 256 and frames[0] == 2 * fs, frames
+        print(f"segments={len(rec.segments)} frames={frames} flushes={rec.flushes}: OK")
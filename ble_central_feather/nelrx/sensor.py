@@ -0,0 +1,173 @@
+"""FeatherSensor の 17 バイトのセンサーパケット。
+
+    0      : proximity (u8)
+    1-3    : 加速度 x/y/z  (u8, (v - 128) / 8        m/s²)
+    4-6    : 磁気   x/y/z  (u8, (v - 128) / 1.25     µT)
+    7-12   : ジャイロ x/y/z (u16 LE, v * 4000 / 65535 - 2000  dps)
+    13     : 温度 (u8, v * 125 / 255 - 40  °C)
+    14     : clear (u8)
+    15-16  : 色 (RGB565, u16 LE)
+
+decode_packet は 1 パケットずつ (これまでの ble_sensor_debug / feather_ble_rx と同じ計算)、
+decode_batch は N パケット分のバイト列を np.frombuffer 1 回で構造化配列として読み、
+列ごとの配列にまとめて変換する。高いレートで何台分も記録するときは
+SensorBatcher で溜めてから decode_batch する。
+"""
+import struct
+import time
+
+import numpy as np
+
+PACKET_SIZE = 17
+
+PACKET_DTYPE = np.dtype([
+    ("prox", "u1"),
+    ("accel", "u1", (3,)),
+    ("mag", "u1", (3,)),
+    ("gyro", "<u2", (3,)),
+    ("temp", "u1"),
+    ("clear", "u1"),
+    ("rgb565", "<u2"),
+])
+assert PACKET_DTYPE.itemsize == PACKET_SIZE
+
+# u8 の項目は 256 通りしかないので表引きにする (計算結果は 1 パケットずつの場合と同じ)
+_U8 = np.arange(256, dtype=np.float64)
+ACCEL_TABLE = (_U8 - 128) / 8.0
+MAG_TABLE = (_U8 - 128) / 1.25
+TEMP_TABLE = (_U8 * 125.0 / 255.0) - 40.0
+
+_GYRO = struct.Struct("<3H")
+
+
+def rgb565_to_rgb(v):
+    """RGB565 を 8bit の (r, g, b) にする (下位ビットは 0)。int でも配列でもよい。"""
+    return (((v >> 11) & 0x1F) << 3, ((v >> 5) & 0x3F) << 2, (v & 0x1F) << 3)
+
+
+def decode_packet(packet) -> dict:
+    """1 パケットを dict にする。"""
+    if len(packet) != PACKET_SIZE:
+        raise ValueError(f"期待 {PACKET_SIZE} byte, 取得 {len(packet)} byte")
+    rgb565 = packet[15] | (packet[16] << 8)
+    return {
+        "prox": packet[0],
+        "accel": tuple((packet[i] - 128) / 8.0 for i in range(1, 4)),
+        "mag": tuple((packet[i] - 128) / 1.25 for i in range(4, 7)),
+        "gyro": tuple(raw * 4000.0 / 65535.0 - 2000.0 for raw in _GYRO.unpack_from(packet, 7)),
+        "temp": packet[13] * 125.0 / 255.0 - 40.0,
+        "clear": packet[14],
+        "rgb565": rgb565,
+        "rgb": rgb565_to_rgb(rgb565),
+    }
+
+
+def decode_batch(data) -> dict:
+    """PACKET_SIZE の倍数のバイト列を列ごとの配列 (長さ N) にする。
+
+    accel / mag / gyro / rgb は (N, 3)。値は decode_packet と同じになる。
+    """
+    if len(data) % PACKET_SIZE:
+        raise ValueError(f"{len(data)} byte is not a multiple of {PACKET_SIZE}")
+    raw = np.frombuffer(data, dtype=PACKET_DTYPE)
+    rgb565 = raw["rgb565"]
+    rgb = np.empty((len(raw), 3), dtype=np.uint8)
+    rgb[:, 0] = (rgb565 >> 11) << 3
+    rgb[:, 1] = ((rgb565 >> 5) & 0x3F) << 2
+    rgb[:, 2] = (rgb565 & 0x1F) << 3
+    return {
+        "prox": raw["prox"].copy(),
+        "accel": ACCEL_TABLE[raw["accel"]],
+        "mag": MAG_TABLE[raw["mag"]],
+        "gyro": raw["gyro"].astype(np.float64) * 4000.0 / 65535.0 - 2000.0,
+        "temp": TEMP_TABLE[raw["temp"]],
+        "clear": raw["clear"].copy(),
+        "rgb565": rgb565.copy(),
+        "rgb": rgb,
+    }
+
+
+def format_row(columns: dict, i: int = -1) -> str:
+    """decode_batch の結果の i 行目を 1 行の文字列にする (表示用)。"""
+    acc = ", ".join(f"{v:.2f}" for v in columns["accel"][i])
+    mag = ", ".join(f"{v:.1f}" for v in columns["mag"][i])
+    gyro = ", ".join(f"{v:.1f}" for v in columns["gyro"][i])
+    r, g, b = columns["rgb"][i]
+    return (f"Prox:{columns['prox'][i]} Acc:[{acc}] Mag:[{mag}] Gyro:[{gyro}] "
+            f"Temp:{columns['temp'][i]:.1f}°C Clear:{columns['clear'][i]} "
+            f"RGB565:0x{columns['rgb565'][i]:04X} ({r},{g},{b})")
+
+
+class SensorBatcher:
+    """Notify ごとの 17 バイトを溜めて、batch_size 個 (または flush_interval 秒) ごとに
+    decode_batch し、on_batch(columns) を呼ぶ。columns["t"] は受信時刻 (time.time())。
+
+    バッファは使い回すので、Notify ごとのメモリ確保はない。
+    """
+
+    def __init__(self, on_batch, batch_size: int = 64, flush_interval: float = 1.0):
+        self.on_batch = on_batch
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._buf = bytearray(batch_size * PACKET_SIZE)
+        self._t = np.empty(batch_size, dtype=np.float64)
+        self._n = 0
+        self._last_flush = time.monotonic()
+        self.packets = 0
+        self.invalid = 0
+        self.batches = 0
+
+    def add(self, data, t: float = None) -> None:
+        if len(data) != PACKET_SIZE:
+            self.invalid += 1
+            return
+        i = self._n
+        self._buf[i * PACKET_SIZE:(i + 1) * PACKET_SIZE] = data
+        self._t[i] = time.time() if t is None else t
+        self._n = i + 1
+        self.packets += 1
+        if self._n == self.batch_size or time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def handle_notify(self, _, data) -> None:
+        """bleak の start_notify にそのまま渡せる形。"""
+        self.add(data)
+
+    def flush(self) -> None:
+        self._last_flush = time.monotonic()
+        n = self._n
+        if not n:
+            return
+        columns = decode_batch(memoryview(self._buf)[:n * PACKET_SIZE])
+        columns["t"] = self._t[:n].copy()
+        self._n = 0
+        self.batches += 1
+        self.on_batch(columns)
+
+    def stats(self) -> dict:
+        return {"packets": self.packets, "invalid": self.invalid, "batches": self.batches,
+                "pending": self._n}
+
+
+if __name__ == "__main__":
+    # decode_batch が 1 パケットずつの結果と一致すること
+    from .synth import sensor_packets
+
+    packets = sensor_packets(5000, seed=1)
+    cols = decode_batch(b"".join(packets))
+    for i, p in enumerate(packets):
+        d = decode_packet(p)
+        assert d["prox"] == cols["prox"][i] and d["clear"] == cols["clear"][i]
+        assert d["accel"] == tuple(cols["accel"][i]) and d["mag"] == tuple(cols["mag"][i])
+        assert d["gyro"] == tuple(cols["gyro"][i]) and d["temp"] == cols["temp"][i]
+        assert d["rgb565"] == cols["rgb565"][i] and d["rgb"] == tuple(cols["rgb"][i])
+
+    got = []
+    batcher = SensorBatcher(got.append, batch_size=64, flush_interval=3600)
+    for p in packets:
+        batcher.add(p)
+    batcher.add(b"short")
+    batcher.flush()
+    assert sum(len(c["prox"]) for c in got) == len(packets) and batcher.invalid == 1
+    assert np.array_equal(np.concatenate([c["gyro"] for c in got]), cols["gyro"])
+    print(f"{len(packets)} packets, batch == per-packet: OK  {batcher.stats()}")
@@ -0,0 +1,226 @@
+"""シリアル (USB CDC) 用のフレーム形式とパーサ。
+
+ヘッダなしの ADPCM を ser.read(256) で区切るやり方だと、1 バイト欠けただけで
+以降ずっとずれたままになる。ファーム側 (SERIAL_MIC_ENCODE / SERIAL_MIC_onLOUD) は
+次の形で送る:
+
+    0xA5 0x5A | len (u16 LE) | packet (len バイト) | CRC16 (u16 LE)
+
+packet は ble_mic_ok と同じ [seq, predictor(int16 LE), step_index] + ADPCM なので、
+そのまま ConcealingDecoder に渡せる。CRC は CRC-16/CCITT-FALSE
+(多項式 0x1021, 初期値 0xFFFF) で、len から packet の末尾までにかける。
+
+FrameParser は受け取ったバイト列を固定長バッファに溜め、同期語を探して
+フレームを切り出す。長さや CRC がおかしければ 1 バイト進めて同期語を探し直す。
+"""
+import binascii
+import logging
+import struct
+
+from . import adpcm
+
+log = logging.getLogger("nelrx.serialframe")
+
+SYNC = b"\xA5\x5A"
+LENGTH_SIZE = 2
+CRC_SIZE = 2
+PREFIX_SIZE = len(SYNC) + LENGTH_SIZE
+FRAME_OVERHEAD = PREFIX_SIZE + CRC_SIZE
+
+
+def crc16(data, crc: int = 0xFFFF) -> int:
+    """CRC-16/CCITT-FALSE (ファームの crc16_ccitt と同じ)。"""
+    return binascii.crc_hqx(data, crc)
+
+
+def build_frame(packet) -> bytes:
+    """packet (ble_mic_ok 形式) をフレームに包む。"""
+    body = struct.pack("<H", len(packet)) + bytes(packet)
+    return SYNC + body + struct.pack("<H", crc16(body))
+
+
+class FrameParser:
+    """バイト列からフレームを切り出す。
+
+    feed(data, handle) で handle(packet: memoryview) がフレームごとに呼ばれる。
+    packet は内部バッファの view なので、呼び出し中だけ有効。
+    """
+
+    def __init__(self, max_packet: int = 1024, buffer_size: int = 64 * 1024):
+        if buffer_size < 2 * (max_packet + FRAME_OVERHEAD):
+            raise ValueError("buffer_size must hold at least two maximum-size frames")
+        self.max_packet = max_packet
+        self._buf = bytearray(buffer_size)
+        self._view = memoryview(self._buf)
+        self._start = 0           # 未処理データの先頭
+        self._end = 0             # 未処理データの末尾
+        self._synced = False
+        self.bytes = 0            # 受け取った総バイト数
+        self.frames = 0           # 正しく取り出せたフレーム数
+        self.crc_errors = 0
+        self.length_errors = 0
+        self.skipped = 0          # 同期語を探すために読み捨てたバイト数
+        self.resyncs = 0          # 同期を失って探し直した回数
+
+    @property
+    def errors(self) -> int:
+        return self.crc_errors + self.length_errors
+
+    def feed(self, data, handle) -> int:
+        """data を取り込んで、完成したフレームを handle に渡す。渡したフレーム数を返す。"""
+        data = memoryview(data).cast("B")
+        self.bytes += len(data)
+        frames = 0
+        pos = 0
+        while pos < len(data):
+            # 後ろに空きがなければ未処理分を先頭に詰める
+            room = len(self._buf) - self._end
+            if room < len(data) - pos and self._start > 0:
+                pending = self._end - self._start
+                self._buf[:pending] = self._view[self._start:self._end]
+                self._start, self._end = 0, pending
+                room = len(self._buf) - self._end
+            n = min(room, len(data) - pos)
+            self._view[self._end:self._end + n] = data[pos:pos + n]
+            self._end += n
+            pos += n
+            frames += self._parse(handle)
+        return frames
+
+    def _lost_sync(self, skip: int) -> None:
+        if self._synced:
+            self._synced = False
+            self.resyncs += 1
+        self.skipped += skip
+        self._start += skip
+
+    def _parse(self, handle) -> int:
+        buf, view = self._buf, self._view
+        frames = 0
+        while True:
+            start, end = self._start, self._end
+            i = buf.find(SYNC, start, end)
+            if i < 0:
+                # 最後の 1 バイトは同期語の前半かもしれないので残す
+                keep = 1 if end > start and buf[end - 1] == SYNC[0] else 0
+                if end - keep > start:
+                    self._lost_sync(end - keep - start)
+                break
+            if i > start:
+                self._lost_sync(i - start)
+                start = i
+            if end - start < PREFIX_SIZE:
+                break
+            length = buf[start + 2] | (buf[start + 3] << 8)
+            if length < adpcm.HEADER_SIZE or length > self.max_packet:
+                self.length_errors += 1
+                self._lost_sync(1)
+                continue
+            total = PREFIX_SIZE + length + CRC_SIZE
+            if end - start < total:
+                break
+            crc_at = start + PREFIX_SIZE + length
+            if crc16(view[start + len(SYNC):crc_at]) != buf[crc_at] | (buf[crc_at + 1] << 8):
+                self.crc_errors += 1
+                self._lost_sync(1)
+                continue
+
+            self._synced = True
+            self._start = start + total
+            self.frames += 1
+            frames += 1
+            handle(view[start + PREFIX_SIZE:crc_at])
+        if self._start == self._end:
+            self._start = self._end = 0
+        return frames
+
+    def stats(self) -> dict:
+        return {
+            "bytes": self.bytes,
+            "frames": self.frames,
+            "crc_errors": self.crc_errors,
+            "length_errors": self.length_errors,
+            "skipped": self.skipped,
+            "resyncs": self.resyncs,
+        }
+
+
+class SerialFrameReader:
+    """シリアルポートから溜まっている分をまとめて読み、FrameParser に流す。
+
+    port は pyserial の Serial など read(n) を持つもの。in_waiting があれば
+    それを全部読み、なければ chunk_size ずつ読む。tap を渡すと、読んだままの
+    バイト列を (フレームに切る前に) tap(data) にも渡す (capture 用)。
+    """
+
+    def __init__(self, port, parser: FrameParser = None, chunk_size: int = 4096, tap=None):
+        self.port = port
+        self.parser = parser or FrameParser()
+        self.chunk_size = chunk_size
+        self.tap = tap
+        self.reads = 0
+
+    def poll(self, handle) -> int:
+        """1 回読んで、取り出せたフレームを handle に渡す。フレーム数を返す。"""
+        if hasattr(self.port, "in_waiting"):
+            # 何も溜まっていなければ 1 バイト待つ (read のタイムアウトまでブロック)
+            size = self.port.in_waiting or 1
+        else:
+            size = self.chunk_size
+        data = self.port.read(size)
+        if not data:
+            return 0
+        self.reads += 1
+        if self.tap is not None:
+            self.tap(data)
+        return self.parser.feed(data, handle)
+
+    def stats(self) -> dict:
+        st = self.parser.stats()
+        st["reads"] = self.reads
+        return st
+
+
+if __name__ == "__main__":
+    # pty の疑似デバイスに壊れたフレームを混ぜて流し、同期が戻ることを確認する
+    import random
+
+    from .fake import PtySerialDevice
+    from .synth import adpcm_packets
+
+    # ファームの crc16_ccitt (ビットごとの計算) と一致すること
+    def crc16_bitwise(data, crc=0xFFFF):
+        for b in data:
+            crc ^= b << 8
+            for _ in range(8):
+                crc = ((crc << 1) ^ 0x1021) if crc & 0x8000 else (crc << 1)
+                crc &= 0xFFFF
+        return crc
+    assert crc16(b"123456789") == crc16_bitwise(b"123456789") == 0x29B1
+
+    rng = random.Random(0)
+    packets = adpcm_packets(500, payload_bytes=256, seed=4)
+    stream = bytearray()
+    damaged = set()
+    for i, packet in enumerate(packets):
+        frame = bytearray(build_frame(packet))
+        r = rng.random()
+        if r < 0.02:
+            del frame[rng.randrange(len(frame))]          # 1 バイト欠落
+            damaged.add(i)
+        elif r < 0.04:
+            frame[rng.randrange(len(frame))] ^= 1 << rng.randrange(8)   # ビット化け
+            damaged.add(i)
+        elif r < 0.06:
+            stream += bytes(rng.randrange(256) for _ in range(rng.randrange(1, 40)))  # ゴミ
+        stream += frame
+
+    got = []
+    with PtySerialDevice() as device:
+        device.play(stream, chunk=97)
+        reader = SerialFrameReader(device.open_reader())
+        while reader.parser.bytes < len(stream):
+            reader.poll(lambda p: got.append(bytes(p)))
+    expected = [bytes(p) for i, p in enumerate(packets) if i not in damaged]
+    assert got == expected, (len(got), len(expected))
+    print(f"frames={len(got)} damaged={len(damaged)} {reader.stats()}: OK")
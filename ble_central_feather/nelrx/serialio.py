@@ -0,0 +1,139 @@
+"""シリアル受信を読み取りスレッドとデコード / 再生スレッドに分ける。
+
+ser.read → stream.write を 1 つのループでやると、再生が詰まった間は
+シリアルを読めず、921600 baud では OS のバッファがあふれる。SerialReader は
+読んだバイトを push (ふつうは Pipeline.push。BLE 受信と同じリング + ワーカー) に
+渡すだけのスレッドで、デコードと再生は Pipeline のワーカー側で行う。
+
+- framed=True  : serialframe 形式。読み取りスレッドでフレームを切り出し、
+                 パケット単位で push する (リングがあふれても捨てるのはパケット単位)
+- framed=False : ヘッダなしのバイト列。align バイトの倍数に揃えて max_chunk ずつ push する
+"""
+import logging
+import threading
+
+from .serialframe import FrameParser, SerialFrameReader
+
+log = logging.getLogger("nelrx.serialio")
+
+
+class SerialReader:
+    """port (pyserial の Serial など) から読み続けて push(data) に渡すスレッド。
+
+    port には read のタイムアウトを設定しておくこと (stop() が待てるように)。
+    max_chunk は Pipeline の slot_size 以下にする。tap を渡すと読んだままの
+    バイト列も渡す (capture 用)。
+    """
+
+    def __init__(self, port, push, framed: bool = True, align: int = 2,
+                 max_chunk: int = 512, chunk_size: int = 4096, parser: FrameParser = None,
+                 tap=None, name: str = "nelrx-serial"):
+        self.port = port
+        self.push = push
+        self.framed = framed
+        self.align = align
+        self.max_chunk = max_chunk - max_chunk % align
+        self.chunk_size = chunk_size
+        self.tap = tap
+        self.frames = SerialFrameReader(port, parser, chunk_size, tap) if framed else None
+        self.reads = 0
+        self.bytes = 0
+        self.errors = 0
+        self._carry = bytearray()      # framed=False で align に満たなかった端数
+        self._running = False
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+
+    def start(self) -> "SerialReader":
+        self._running = True
+        self._thread.start()
+        return self
+
+    def stop(self, timeout: float = 2.0) -> None:
+        self._running = False
+        cancel = getattr(self.port, "cancel_read", None)
+        if cancel is not None:
+            cancel()
+        self._thread.join(timeout)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    @property
+    def alive(self) -> bool:
+        return self._thread.is_alive()
+
+    def stats(self) -> dict:
+        st = self.frames.stats() if self.frames is not None else {
+            "reads": self.reads, "bytes": self.bytes}
+        st["errors"] = self.errors
+        return st
+
+    def _run(self) -> None:
+        while self._running:
+            try:
+                if self.frames is not None:
+                    self.frames.poll(self.push)
+                else:
+                    self._read_raw()
+            except OSError as e:   # pyserial の SerialException も OSError
+                if self._running:
+                    self.errors += 1
+                    log.error("serial read failed: %s", e)
+                return
+
+    def _read_raw(self) -> None:
+        waiting = getattr(self.port, "in_waiting", None)
+        size = (waiting or 1) if waiting is not None else self.chunk_size
+        data = self.port.read(size)
+        if not data:
+            return
+        self.reads += 1
+        self.bytes += len(data)
+        if self.tap is not None:
+            self.tap(data)
+        if self._carry:
+            data = bytes(self._carry) + data
+            self._carry.clear()
+        usable = len(data) - len(data) % self.align
+        if usable < len(data):
+            self._carry += data[usable:]
+        view = memoryview(data)
+        for i in range(0, usable, self.max_chunk):
+            self.push(view[i:min(i + self.max_chunk, usable)])
+
+
+if __name__ == "__main__":
+    # 再生側がときどき止まっても、読み取りは止まらずに最後まで読めること
+    import time
+
+    from .fake import PtySerialDevice
+    from .pipeline import Pipeline, DROP_OLDEST
+    from .serialframe import build_frame
+    from .synth import adpcm_packets
+
+    packets = adpcm_packets(400, payload_bytes=256, seed=5)
+    stream = b"".join(build_frame(p) for p in packets)
+    handled = []
+
+    def slow_playback(packet):
+        handled.append(packet[0])
+        if len(handled) % 50 == 0:
+            time.sleep(0.2)   # 出力デバイスが詰まった
+
+    with PtySerialDevice() as device:
+        pipeline = Pipeline(slow_playback, capacity=32, policy=DROP_OLDEST)
+        reader = SerialReader(device.open_reader(), pipeline.push)
+        with pipeline, reader:
+            device.play(stream, chunk=512, interval=0.002)
+            deadline = time.monotonic() + 10.0
+            while reader.frames.parser.frames < len(packets) and time.monotonic() < deadline:
+                time.sleep(0.05)
+            device.close()   # 抜かれたのと同じ。読み取りスレッドはエラーで抜ける
+    st = pipeline.stats()
+    assert reader.frames.parser.frames == len(packets), reader.stats()
+    assert st["handled"] + st["dropped_oldest"] == len(packets), st
+    print(f"read {reader.frames.parser.frames} frames while playback stalled; "
+          f"handled={st['handled']} dropped={st['dropped_oldest']}: OK")
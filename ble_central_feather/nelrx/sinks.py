@@ -0,0 +1,130 @@
+"""デコード済み PCM (int16 モノラル) の出力先。
+
+どの sink も ``write(pcm)`` と ``close()`` だけを持つ。
+"""
+import wave
+
+import numpy as np
+
+from .jitter import JitterBuffer
+
+
+class NullSink:
+    """捨てるだけ (受信・デコード性能の計測用)。"""
+
+    def __init__(self):
+        self.samples = 0
+
+    def write(self, pcm) -> None:
+        self.samples += len(pcm)
+
+    def close(self) -> None:
+        pass
+
+
+class StatsSink:
+    """捨てる代わりに音量 (ピーク / RMS) とクリップ数を数える。"""
+
+    def __init__(self):
+        self.samples = 0
+        self.peak = 0
+        self.clipped = 0
+        self._energy = 0.0
+
+    def write(self, pcm) -> None:
+        if len(pcm) == 0:
+            return
+        pcm = np.asarray(pcm)
+        self.samples += len(pcm)
+        self.peak = max(self.peak, int(pcm.max()), -int(pcm.min()))
+        self.clipped += int(np.count_nonzero((pcm == 32767) | (pcm == -32768)))
+        self._energy += float(np.dot(pcm.astype(np.float64), pcm))
+
+    def stats(self) -> dict:
+        rms = (self._energy / self.samples) ** 0.5 if self.samples else 0.0
+        return {"samples": self.samples, "peak": self.peak, "rms": rms, "clipped": self.clipped}
+
+    def close(self) -> None:
+        pass
+
+
+class TeeSink:
+    """同じ PCM を複数の sink に書く (再生しながら保存するなど)。"""
+
+    def __init__(self, *sinks):
+        self.sinks = sinks
+
+    def write(self, pcm) -> None:
+        for sink in self.sinks:
+            sink.write(pcm)
+
+    def close(self) -> None:
+        for sink in self.sinks:
+            sink.close()
+
+
+class WaveFileSink:
+    """wave モジュールでそのまま WAV に書き出す。"""
+
+    def __init__(self, path, samplerate: int):
+        self.path = str(path)
+        self._wf = wave.open(self.path, "wb")
+        self._wf.setnchannels(1)
+        self._wf.setsampwidth(2)
+        self._wf.setframerate(samplerate)
+
+    def write(self, pcm) -> None:
+        self._wf.writeframes(pcm)
+
+    def close(self) -> None:
+        self._wf.close()
+
+
+class SpeakerSink:
+    """sounddevice の OutputStream に書き込む (write はブロックする)。"""
+
+    def __init__(self, samplerate: int):
+        import sounddevice as sd
+        self._stream = sd.OutputStream(samplerate=samplerate, channels=1, dtype="int16")
+        self._stream.start()
+
+    def write(self, pcm) -> None:
+        self._stream.write(pcm)
+
+    def close(self) -> None:
+        self._stream.stop()
+        self._stream.close()
+
+
+class JitterSpeakerSink:
+    """ジッタバッファを挟んでコールバック型の OutputStream で鳴らす。
+
+    write() はバッファに積むだけでブロックしない。再生はオーディオ側の
+    コールバックが一定間隔で buffer から引き出す。
+    """
+
+    def __init__(self, samplerate: int, blocksize: int = 256, **jitter_options):
+        import sounddevice as sd
+        self.buffer = JitterBuffer(samplerate, **jitter_options)
+        self.device_underflows = 0
+
+        def callback(outdata, frames, t, status):
+            if status.output_underflow:
+                self.device_underflows += 1
+            self.buffer.pull(outdata[:, 0], max(0.0, t.outputBufferDacTime - t.currentTime))
+
+        self._stream = sd.OutputStream(samplerate=samplerate, channels=1, dtype="int16",
+                                       blocksize=blocksize, callback=callback)
+        self._stream.start()
+
+    def write(self, pcm) -> None:
+        self.buffer.push(pcm)
+
+    def stats(self) -> dict:
+        st = self.buffer.stats()
+        st["device_underflows"] = self.device_underflows
+        return st
+
+    def close(self) -> None:
+        self._stream.stop()
+        self._stream.close()
@@ -0,0 +1,129 @@
+"""起動時間のベンチマーク: プロセスを起動してから最初のサンプルがデコードされるまで。
+
+受信 CLI (python -m nelrx ...) を別プロセスで runs 回起動し、起動直前の時刻と
+集計 JSON の first_sample_at (最初のサンプルをデコードした time.time()) の差を測る。
+CLI の引数を省略すると、合成した capture ファイルを等速で流し直す
+(replay --sink null)。実機では引数に受信の設定を渡す (--duration を必ず付ける)。
+
+あわせて、起動時に読み込まれうるモジュールの import 時間を
+新しいインタプリタで 1 つずつ測る (-X importtime、入っていないものは missing)。
+
+    python -m nelrx.startup --runs 5 --out startup.json
+    python -m nelrx.startup -- ble --sink wav --duration 3 --report 0
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+PACKAGE_DIR = Path(__file__).resolve().parent.parent   # python -m nelrx を実行できる場所
+IMPORTS = ("numpy", "sounddevice", "bleak", "serial", "nelrx.cli", "nelrx.transports",
+           "nelrx.codec", "nelrx.sinks")
+
+
+def import_time_ms(module: str):
+    """新しいインタプリタで module を import したときの累積時間 [ms]。入っていなければ None。"""
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                          cwd=PACKAGE_DIR, capture_output=True, text=True)
+    if proc.returncode != 0:
+        return None
+    for line in reversed(proc.stderr.splitlines()):
+        parts = line.split("|")
+        if len(parts) == 3 and parts[2].strip() == module:
+            return int(parts[1]) / 1e3
+    return None
+
+
+def make_capture(path, seconds: float = 2.0) -> None:
+    """ble_mic_ok 形式のパケットを 32 ms 間隔で記録した capture ファイルを作る。"""
+    from . import synth
+    from .capture import CaptureWriter
+
+    fs, spp = 8000, 256
+    packets = synth.ble_packets(synth.make_signal("speech", int(seconds * fs), fs), spp)
+    with CaptureWriter(path, meta={"codec": "adpcm-hdr", "samplerate": fs}) as w:
+        ch = w.channel("synth", kind="ble", framed=False)
+        for i, p in enumerate(packets):
+            w.write(ch, p, t_ns=int(i * spp / fs * 1e9))
+
+
+def time_to_first_sample(cli_args, runs: int = 5) -> dict:
+    """CLI を runs 回起動し、起動から最初のサンプルまで / 終了までの時間 [ms] を集める。"""
+    first, inside, total = [], [], []
+    with tempfile.TemporaryDirectory() as tmp:
+        out = os.path.join(tmp, "summary.json")
+        for _ in range(runs):
+            t0 = time.time()
+            start = time.perf_counter()
+            proc = subprocess.run([sys.executable, "-m", "nelrx", *cli_args, "--json", out],
+                                  cwd=PACKAGE_DIR, capture_output=True, text=True)
+            total.append((time.perf_counter() - start) * 1e3)
+            if proc.returncode != 0:
+                raise RuntimeError(proc.stderr.strip().splitlines()[-1] if proc.stderr else
+                                   f"exit {proc.returncode}")
+            with open(out) as f:
+                summary = json.load(f)
+            if summary.get("first_sample_at") is None:
+                raise RuntimeError("no samples were decoded")
+            first.append((summary["first_sample_at"] - t0) * 1e3)
+            inside.append(summary["startup_s"] * 1e3)
+    return {
+        "args": list(cli_args),
+        "runs": runs,
+        "first_sample_ms": {"min": min(first), "median": statistics.median(first)},
+        "in_process_ms": {"min": min(inside), "median": statistics.median(inside)},
+        "process_ms": {"min": min(total), "median": statistics.median(total)},
+        "connect": summary.get("transport_stats", {}).get("connected_via"),
+    }
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="nelrx startup-time benchmark",
+                                     usage="python -m nelrx.startup [options] [-- CLI args]")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--imports", nargs="*", default=list(IMPORTS),
+                        help="modules whose import time is measured")
+    parser.add_argument("--out", help="write JSON results here")
+    args, cli_args = parser.parse_known_args(argv)
+    if cli_args[:1] == ["--"]:
+        cli_args = cli_args[1:]
+
+    from .bench import git_revision
+    report = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "git": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+        },
+        "imports_ms": {m: import_time_ms(m) for m in args.imports},
+    }
+    for module, ms in report["imports_ms"].items():
+        print(f"import {module:20s} " + (f"{ms:7.1f} ms" if ms is not None else "missing"))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if not cli_args:
+            path = os.path.join(tmp, "startup.nelcap")
+            make_capture(path)
+            cli_args = ["replay", path, "--sink", "null", "--duration", "0.5", "--report", "0"]
+        r = time_to_first_sample(cli_args, args.runs)
+    report["first_sample"] = r
+    print(f"first sample {r['first_sample_ms']['median']:7.1f} ms after process start "
+          f"(min {r['first_sample_ms']['min']:.1f}; {r['in_process_ms']['median']:.1f} ms "
+          f"after nelrx.cli import)  process {r['process_ms']['median']:.0f} ms"
+          + (f"  connect={r['connect']}" if r["connect"] else ""))
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
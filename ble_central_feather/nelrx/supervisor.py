@@ -0,0 +1,367 @@
+"""1 台との BLE 接続を保ち、切れたらつなぎ直す。
+
+``async with BleakClient(target)`` だけだと、リンクが切れた時点で例外になって
+スクリプトごと終わる。LinkSupervisor は
+
+    - client の disconnected_callback で切断に気づき (is_connected の見回りも併用)
+    - ジッタ付きの指数バックオフで接続し直し
+    - 接続のたびに Notify を登録し直す
+
+を stop がセットされるまで繰り返す。sink やレコーダーは呼び出し側で持ち続けるので
+作り直さない。on_connect で decoder.resync() などを呼べば、次に届いたパケットの
+ヘッダからデコードを再開できる。切れていた時間 (downtime) はデバイスごとに stats() に出る。
+
+    supervisor = LinkSupervisor("CatVoiceStreamer", {UART_TX_CHAR_UUID: handle_notify},
+                                on_connect=lambda client: decoder.resync())
+    await supervisor.run(stop)
+"""
+import asyncio
+import contextlib
+import inspect
+import logging
+import random
+import time
+from collections import deque
+
+from .ble import DEVICE_NAME
+from .connect import connect
+
+log = logging.getLogger("nelrx.supervisor")
+
+IDLE = "idle"
+CONNECTING = "connecting"
+CONNECTED = "connected"
+BACKOFF = "backoff"
+STOPPED = "stopped"
+
+
+class Backoff:
+    """ジッタ付きの指数バックオフ。
+
+    n 回目の待ち時間は initial * factor**n (maximum で頭打ち) に、
+    [1 - jitter, 1] の乱数を掛けたもの。何台も同時に切れても、つなぎ直しが
+    同じ瞬間に集中しないようにばらす。
+    """
+
+    def __init__(self, initial: float = 0.25, maximum: float = 30.0, factor: float = 2.0,
+                 jitter: float = 0.5, rng=None):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+        self.rng = rng or random.Random()
+        self.attempt = 0
+
+    def next(self) -> float:
+        base = min(self.maximum, self.initial * self.factor ** self.attempt)
+        self.attempt += 1
+        return base * (1.0 - self.jitter * self.rng.random())
+
+    def reset(self) -> None:
+        self.attempt = 0
+
+
+class LinkSupervisor:
+    """接続 → Notify 登録 → 切断待ち → バックオフ、を繰り返す。
+
+    subscriptions は {char_uuid: callback}。address は文字列か BLEDevice
+    (探索済みならそのまま渡す)。接続の探し方 (address / cache /
+    discovery / service_uuids) は connect.connect と同じ。2 回目以降は最後に
+    つながったアドレスに直接つなぐ (だめならスキャン)。client_factory は
+    ``client_factory(target, disconnected_callback=...)`` で BleakClient 互換の
+    client を返すもの。reconnect=False なら最初の接続が切れた時点で戻る。
+    on_connect(client) / on_disconnect() はコルーチン関数でもよい。
+    """
+
+    def __init__(self, name_filter: str = DEVICE_NAME, subscriptions: dict = None,
+                 address: str = None, cache=None, discovery=None, service_uuids=(),
+                 client_factory=None, backoff: Backoff = None, reconnect: bool = True,
+                 scan_timeout: float = 5.0, connect_timeout: float = 5.0,
+                 on_connect=None, on_disconnect=None, poll_interval: float = 0.5,
+                 clock=time.monotonic):
+        self.name_filter = name_filter
+        self.subscriptions = dict(subscriptions or {})
+        self.address = address
+        self.cache = cache
+        self.discovery = discovery
+        self.service_uuids = service_uuids
+        self.client_factory = client_factory
+        self.backoff = backoff or Backoff()
+        self.reconnect = reconnect
+        self.scan_timeout = scan_timeout
+        self.connect_timeout = connect_timeout
+        self.on_connect = on_connect
+        self.on_disconnect = on_disconnect
+        self.poll_interval = poll_interval
+        self.clock = clock
+
+        self.state = IDLE
+        self.client = None
+        self.connected_address = None
+        self.connected_via = None     # "address" / "cache" / "scan"
+        self.connects = 0
+        self.disconnects = 0
+        self.failures = 0
+        self.last_error = None
+        self.downtime = 0.0           # 切れてからつながり直すまでの合計 [s]
+        self.outages = deque(maxlen=256)
+        self._down_since = None
+        self._pending = None          # open() でつないだ (client, how, lost)
+
+    # --------- 接続 ---------
+    async def _connect(self):
+        factory = self.client_factory
+        if factory is None:
+            from bleak import BleakClient
+            factory = BleakClient
+        loop = asyncio.get_running_loop()
+        lost = asyncio.Event()
+
+        def on_disconnected(_client):
+            loop.call_soon_threadsafe(lost.set)
+
+        make_client = lambda target: factory(target, disconnected_callback=on_disconnected)
+        options = dict(scan_timeout=self.scan_timeout, connect_timeout=self.connect_timeout,
+                       service_uuids=self.service_uuids, discovery=self.discovery)
+        if not self.address and self.connected_address:
+            # つなぎ直しはまず最後につながったアドレスへ。だめならキャッシュ / スキャン
+            try:
+                client, _ = await connect(self.name_filter, self.connected_address, self.cache,
+                                          make_client, **options)
+                return client, "address", lost
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.debug("%s: %s", self.connected_address, str(e) or type(e).__name__)
+        client, how = await connect(self.name_filter, self.address, self.cache, make_client,
+                                    **options)
+        return client, how, lost
+
+    async def open(self):
+        """最初の接続だけ行い client を返す (失敗したら例外)。run() はこの接続から始める。"""
+        self.state = CONNECTING
+        client, how, lost = await self._connect()
+        self._pending = (client, how, lost)
+        return client
+
+    async def _call(self, hook, *args) -> None:
+        if hook is None:
+            return
+        try:
+            result = hook(*args)
+            if inspect.isawaitable(result):
+                await result
+        except Exception:
+            log.exception("%s: %s hook failed", self._label(), getattr(hook, "__name__", "hook"))
+
+    def _label(self) -> str:
+        return self.connected_address or getattr(self.address, "address", self.address) \
+            or self.name_filter
+
+    # --------- 監視ループ ---------
+    async def run(self, stop: asyncio.Event) -> None:
+        try:
+            while not stop.is_set():
+                if self._pending is not None:
+                    (client, how, lost), self._pending = self._pending, None
+                else:
+                    self.state = CONNECTING
+                    try:
+                        client, how, lost = await self._connect()
+                    except asyncio.CancelledError:
+                        raise
+                    except Exception as e:
+                        if not await self._failed(e, stop):
+                            break
+                        continue
+                # on_connect (decoder.resync() など) は Notify が届き始める前に呼ぶが、
+                # 接続数 / バックオフ / 切れていた時間は Notify の登録まで済んでから確定する
+                await self._connected(client, how)
+                try:
+                    for char_uuid, callback in self.subscriptions.items():
+                        await client.start_notify(char_uuid, callback)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    with contextlib.suppress(Exception):
+                        await client.disconnect()
+                    self.client = None
+                    self.connects -= 1         # つながったことにしない (切れていた時間も続く)
+                    self.state = CONNECTING
+                    await self._call(self.on_disconnect)
+                    if not await self._failed(e, stop):
+                        break
+                    continue
+                self._up(how)
+
+                await self._wait_lost(client, lost, stop)
+                self.client = None
+                if stop.is_set():
+                    with contextlib.suppress(Exception):
+                        await client.disconnect()
+                    break
+                self.disconnects += 1
+                self._down_since = self.clock()
+                log.warning("%s: link lost", self._label())
+                with contextlib.suppress(Exception):
+                    await client.disconnect()
+                await self._call(self.on_disconnect)
+                if not self.reconnect:
+                    break
+                self.state = BACKOFF
+                await self._sleep(self.backoff.next(), stop)
+        finally:
+            if self._down_since is not None:     # 止めた時点で切れていた分
+                self.downtime += self.clock() - self._down_since
+                self._down_since = None
+            self.state = STOPPED
+
+    async def _connected(self, client, how: str) -> None:
+        self.client = client
+        self.connected_address = getattr(client, "address", None) or self.connected_address
+        self.connected_via = how
+        self.connects += 1
+        await self._call(self.on_connect, client)
+
+    def _up(self, how: str) -> None:
+        """Notify の登録まで済んだ。バックオフを戻し、切れていた時間を締める。"""
+        self.backoff.reset()
+        if self._down_since is not None:
+            outage = self.clock() - self._down_since
+            self.downtime += outage
+            self.outages.append(outage)
+            self._down_since = None
+            log.info("%s: reconnected via %s after %.2f s down", self._label(), how, outage)
+        else:
+            log.info("%s: connected via %s", self._label(), how)
+        self.state = CONNECTED
+
+    async def _failed(self, error, stop) -> bool:
+        """接続に失敗した。待ってから続けるなら True。"""
+        self.failures += 1
+        self.last_error = str(error) or type(error).__name__
+        if not self.reconnect and self.connects == 0:
+            raise error
+        if not self.reconnect:
+            return False
+        delay = self.backoff.next()
+        log.info("%s: connect failed (%s); retrying in %.2f s", self._label(), self.last_error, delay)
+        self.state = BACKOFF
+        await self._sleep(delay, stop)
+        return not stop.is_set()
+
+    async def _wait_lost(self, client, lost: asyncio.Event, stop: asyncio.Event) -> None:
+        # disconnected_callback を待つ。呼ばれない実装もあるので is_connected も見回る
+        while not stop.is_set() and not lost.is_set() and client.is_connected:
+            waiters = [asyncio.ensure_future(lost.wait()), asyncio.ensure_future(stop.wait())]
+            try:
+                await asyncio.wait(waiters, timeout=self.poll_interval,
+                                   return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                for w in waiters:
+                    w.cancel()
+
+    @staticmethod
+    async def _sleep(delay: float, stop: asyncio.Event) -> None:
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(stop.wait(), delay)
+
+    # --------- 集計 ---------
+    def stats(self) -> dict:
+        downtime = self.downtime
+        if self._down_since is not None:
+            downtime += self.clock() - self._down_since
+        return {
+            "address": self.connected_address or getattr(self.address, "address", self.address),
+            "state": self.state,
+            "connected_via": self.connected_via,
+            "connects": self.connects,
+            "reconnects": max(0, self.connects - 1),
+            "disconnects": self.disconnects,
+            "failures": self.failures,
+            "downtime_s": downtime,
+            "max_outage_s": max(self.outages, default=0.0),
+            "last_error": self.last_error,
+        }
+
+
+if __name__ == "__main__":
+    # 切れやすい偽デバイスで、つなぎ直し / Notify の再登録 / デコードの再開を確認する
+    from .ble import UART_TX_CHAR_UUID
+    from .conceal import ConcealingDecoder
+    from .fake import FlakyDevice
+    from .sinks import NullSink
+    from .synth import adpcm_packets
+
+    logging.basicConfig(level=logging.ERROR)
+    packets = adpcm_packets(600, payload_bytes=128, seed=4)
+    device = FlakyDevice(packets, interval=0.002, drop_every=60, fail_rate=0.3, seed=1)
+    decoder = ConcealingDecoder()
+    sink = NullSink()
+    received = []
+
+    def handle_notify(_, data):
+        received.append(data[0])
+        decoder.decode_packet(data, sink.write)
+
+    async def check():
+        stop = asyncio.Event()
+        supervisor = LinkSupervisor(
+            subscriptions={UART_TX_CHAR_UUID: handle_notify}, address=device.device.address,
+            client_factory=device.client, backoff=Backoff(0.01, 0.1, rng=random.Random(2)),
+            on_connect=lambda client: decoder.resync())
+        task = asyncio.create_task(supervisor.run(stop))
+        while device.position() < len(packets):
+            await asyncio.sleep(0.05)
+        stop.set()
+        await task
+        return supervisor.stats()
+
+    st = asyncio.run(check())
+    ds = decoder.stats()
+    print(f"{st}\ndecoder: {ds}\ndevice: {device.stats()}")
+    assert st["state"] == STOPPED and st["reconnects"] >= 5 and st["failures"] >= 1, st
+    assert st["disconnects"] == device.drops and st["downtime_s"] > 0
+    assert len(received) > len(packets) // 2
+    # つなぎ直した後も捨てずにデコードできている (古い seq と比べて遅着扱いにしない)
+    assert ds["reordered"] == 0 and ds["duplicates"] == 0 and ds["resyncs"] == st["reconnects"]
+    assert sink.samples >= len(received) * 256
+
+    # Notify の登録で失敗した接続は、つながったことにしない
+    # (接続数 / バックオフを戻さず、on_disconnect を呼ぶ。reconnect=False なら例外)
+    from .fake import FakeBleakClient, FakeDevice
+
+    class RefusingClient(FakeBleakClient):
+        async def start_notify(self, char_uuid, callback):
+            await asyncio.sleep(0.02)
+            raise RuntimeError("subscribe failed")
+
+    def refusing(target, **_):
+        return RefusingClient(FakeDevice(None, "AA:01"))
+
+    async def never_up(reconnect):
+        hooks = []
+        supervisor = LinkSupervisor(
+            subscriptions={UART_TX_CHAR_UUID: handle_notify}, address="AA:01",
+            reconnect=reconnect, client_factory=refusing, backoff=Backoff(0.01, 1.0, jitter=0.0),
+            on_connect=lambda client: hooks.append("connect"),
+            on_disconnect=lambda: hooks.append("disconnect"))
+        stop = asyncio.Event()
+        if reconnect:
+            asyncio.get_running_loop().call_later(0.3, stop.set)
+        try:
+            await supervisor.run(stop)
+        except RuntimeError:
+            hooks.append("raised")
+        return supervisor, hooks
+
+    supervisor, hooks = asyncio.run(never_up(False))
+    st = supervisor.stats()
+    assert hooks == ["connect", "disconnect", "raised"], hooks
+    assert st["connects"] == 0 and st["failures"] == 1 and st["downtime_s"] == 0.0, st
+    supervisor, hooks = asyncio.run(never_up(True))
+    st = supervisor.stats()
+    assert st["connects"] == 0 and st["failures"] >= 3, st
+    assert supervisor.backoff.attempt == st["failures"], (supervisor.backoff.attempt, st)
+    assert hooks.count("connect") == hooks.count("disconnect") == st["failures"], hooks
+    print("reconnect / backoff / resubscribe / resume / failed subscribe: OK")
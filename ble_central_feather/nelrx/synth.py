@@ -0,0 +1,135 @@
+"""実機なしで受信側を試すための合成パケット。"""
+import numpy as np
+
+from . import adpcm
+
+
+def make_header(seq: int, predictor: int, step_index: int) -> bytes:
+    """ble_mic_ok 形式の 4 バイトヘッダ (ファーム側 send_block と同じ並び)。"""
+    p = predictor & 0xFFFF
+    return bytes((seq & 0xFF, p & 0xFF, p >> 8, step_index))
+
+
+def adpcm_packets(n: int, payload_bytes: int = 128, seed: int = 0) -> list:
+    """ヘッダ付き ADPCM パケットを n 個作る。
+
+    振幅の小さいニブルだけを使うので飽和しにくい。ヘッダの状態は
+    実際にデコードして進めた値なので、欠落させても次のパケットから正しく戻る。
+    """
+    rng = np.random.default_rng(seed)
+    small = np.array([0, 1, 2, 3, 8, 9, 10, 11], dtype=np.uint8)
+    state = adpcm.AdpcmState()
+    packets = []
+    for seq in range(n):
+        nib = small[rng.integers(0, small.size, payload_bytes * 2)]
+        payload = (nib[0::2] | (nib[1::2] << 4)).astype(np.uint8).tobytes()
+        packets.append(make_header(seq, state.predictor, state.step_index) + payload)
+        state.decode(payload)
+    return packets
+
+
+def lossy(packets, loss: float = 0.05, burst: float = 0.0, reorder: float = 0.0,
+          duplicate: float = 0.0, seed: int = 0):
+    """パケット列に欠落・入れ替わり・重複を入れて流すジェネレータ。
+
+    loss は平均の欠落率、burst は「直前が欠落なら次も欠落する確率」
+    (2 状態マルコフ。0 なら独立な欠落)。reorder の確率で 1 つ後ろと入れ替え、
+    duplicate の確率で同じパケットを 2 回流す。
+    """
+    rng = np.random.default_rng(seed)
+    if loss >= 1.0:
+        return
+    p_start = loss * (1.0 - burst) / (1.0 - loss) if burst < 1.0 else loss
+    lost = False
+    held = None
+    for packet in packets:
+        lost = rng.random() < (burst if lost else p_start)
+        if lost:
+            continue
+        if held is None and rng.random() < reorder:
+            held = packet
+            continue
+        yield packet
+        if rng.random() < duplicate:
+            yield packet
+        if held is not None:
+            yield held
+            held = None
+    if held is not None:
+        yield held
+
+
+# --------- テスト信号 (すべて seed で決まる int16 モノラル) ---------
+def sine(n: int, samplerate: int, freq: float = 440.0, amplitude: float = 0.3) -> np.ndarray:
+    t = np.arange(n) / samplerate
+    return (amplitude * 32767 * np.sin(2 * np.pi * freq * t)).astype(np.int16)
+
+
+def noise(n: int, amplitude: float = 0.1, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    x = rng.normal(0.0, amplitude * 32767, n)
+    return np.clip(x, adpcm.PCM_MIN, adpcm.PCM_MAX).astype(np.int16)
+
+
+def speech_like(n: int, samplerate: int, seed: int = 0) -> np.ndarray:
+    """有声音っぽいバースト (倍音 + 揺れる基本周波数) と無音区間の繰り返し。
+
+    猫の鳴き声の本物とは違うが、振幅が急に立ち上がる / 途切れるところで
+    ADPCM の step_index が大きく動くので、デコーダの負荷はそれらしくなる。
+    """
+    rng = np.random.default_rng(seed)
+    out = rng.normal(0.0, 30.0, n)   # 無音区間のマイクノイズ
+    pos = int(rng.integers(0, samplerate // 10))
+    while pos < n:
+        length = min(int(rng.uniform(0.15, 0.6) * samplerate), n - pos)
+        t = np.arange(length) / samplerate
+        f0 = rng.uniform(250.0, 700.0) * (1.0 + 0.15 * np.sin(2 * np.pi * rng.uniform(2, 6) * t))
+        phase = 2 * np.pi * np.cumsum(f0) / samplerate
+        voiced = sum(np.sin(k * phase) / k for k in range(1, 6))
+        envelope = np.hanning(length) * rng.uniform(0.1, 0.6) * 32767 / 2.3
+        out[pos:pos + length] += voiced * envelope
+        pos += length + int(rng.uniform(0.1, 0.4) * samplerate)
+    return np.clip(out, adpcm.PCM_MIN, adpcm.PCM_MAX).astype(np.int16)
+
+
+SIGNALS = ("sine", "noise", "speech")
+
+
+def make_signal(kind: str, n: int, samplerate: int, seed: int = 0) -> np.ndarray:
+    if kind == "sine":
+        return sine(n, samplerate)
+    if kind == "noise":
+        return noise(n, seed=seed)
+    if kind == "speech":
+        return speech_like(n, samplerate, seed=seed)
+    raise ValueError(f"unknown signal: {kind}")
+
+
+# --------- パケット化 (ファームと同じエンコーダを通す) ---------
+def ble_packets(pcm, samples_per_packet: int = 256) -> list:
+    """ble_mic_ok 形式 (send_block と同じく、エンコード前の状態をヘッダに載せる)。"""
+    encoder = adpcm.AdpcmEncoder()
+    return [encoder.encode_packet(pcm[start:start + samples_per_packet])
+            for start in range(0, len(pcm) - samples_per_packet + 1, samples_per_packet)]
+
+
+def serial_chunks(pcm, samples_per_read: int = 512) -> list:
+    """serial_mic_encode 形式 (ヘッダなし、状態は送信を通して持ち越し)。
+
+    PC 側は ser.read(samples_per_read // 2) 単位で読むので、その大きさに分ける。
+    """
+    data, _ = adpcm.encode(pcm)
+    step = samples_per_read // 2
+    return [data[i:i + step] for i in range(0, len(data) - step + 1, step)]
+
+
+# --------- センサー ---------
+def sensor_packets(n: int, seed: int = 0) -> list:
+    """FeatherSensor 形式 (17 バイト) のパケットを n 個。値はゆっくり動く乱数。"""
+    rng = np.random.default_rng(seed)
+    u8 = np.clip(128 + np.cumsum(rng.integers(-3, 4, size=(n, 9)), axis=0), 0, 255).astype(np.uint8)
+    gyro = np.clip(32768 + np.cumsum(rng.integers(-200, 201, size=(n, 3)), axis=0),
+                   0, 65535).astype("<u2")
+    rgb = rng.integers(0, 65536, size=n).astype("<u2")
+    return [bytes(u8[i, :7]) + gyro[i].tobytes() + bytes(u8[i, 7:]) + rgb[i:i + 1].tobytes()
+            for i in range(n)]
@@ -0,0 +1,334 @@
+"""センサーの値を列ごとにディスクへ溜めていく時系列ストア。
+
+SensorBatcher の on_batch (decode_batch の結果 + 受信時刻 "t") をそのまま
+write() に渡すと、列ごとに用意したバッファにコピーし、chunk_rows 行ごと
+(と flush_interval 秒ごと) に .npy として書き出す。あわせて、解像度
+(rollups 秒) ごとに min / max / mean / count を計算して同じ形で書いておくので、
+何時間分でも生データを読まずに粗い解像度で引ける。
+
+    directory/
+      meta.json
+      raw/<列>/000000.npy, 000001.npy, ...
+      rollup_10s/t/000000.npy             (区間の開始時刻)
+      rollup_10s/count/000000.npy
+      rollup_10s/<列>_min|_max|_mean/000000.npy
+
+書きかけのチャンクは flush のたびに一時ファイル → rename で置き換えるので、
+途中で落ちても最後の flush までは読める。読むときは TelemetryReader を使う。
+"""
+import json
+import logging
+import os
+import time
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+
+log = logging.getLogger("nelrx.telemetry")
+
+# decode_batch の列 → 保存する 1 次元の列
+COLUMNS = {
+    "t": "<f8",
+    "prox": "u1",
+    "accel_x": "<f4", "accel_y": "<f4", "accel_z": "<f4",
+    "mag_x": "<f4", "mag_y": "<f4", "mag_z": "<f4",
+    "gyro_x": "<f4", "gyro_y": "<f4", "gyro_z": "<f4",
+    "temp": "<f4",
+    "clear": "u1",
+    "rgb565": "<u2",
+}
+# 集計する列 (時刻と、平均に意味のない RGB565 以外)
+VALUE_COLUMNS = tuple(c for c in COLUMNS if c not in ("t", "rgb565"))
+DEFAULT_ROLLUPS = (1.0, 10.0, 60.0, 600.0)
+
+
+def flatten(columns: dict) -> dict:
+    """decode_batch の結果 ((N, 3) の列を含む) を 1 次元の列にする。"""
+    flat = {}
+    for name, values in columns.items():
+        values = np.asarray(values)
+        if values.ndim == 2:
+            for axis, suffix in enumerate("xyz"):
+                flat[f"{name}_{suffix}"] = values[:, axis]
+        else:
+            flat[name] = values
+    return flat
+
+
+def _save(path: Path, array: np.ndarray) -> None:
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "wb") as f:
+        np.save(f, array)
+    os.replace(tmp, path)
+
+
+class ColumnChunks:
+    """同じ長さの列をまとめて追記し、chunk_rows 行ごとに列ごとの .npy に書く。"""
+
+    def __init__(self, directory, dtypes: dict, chunk_rows: int = 4096):
+        self.directory = Path(directory)
+        self.dtypes = dtypes
+        self.chunk_rows = chunk_rows
+        self._buf = {name: np.empty(chunk_rows, dtype=dt) for name, dt in dtypes.items()}
+        for name in dtypes:
+            (self.directory / name).mkdir(parents=True, exist_ok=True)
+        self.chunk = self._existing_chunks()   # 追記なら続きの番号から
+        self._n = 0
+        self._dirty = False
+        self.rows = 0
+
+    def _existing_chunks(self) -> int:
+        first = next(iter(self.dtypes))
+        return len(list((self.directory / first).glob("*.npy")))
+
+    def append(self, columns: dict) -> None:
+        n = len(columns[next(iter(self.dtypes))])
+        pos = 0
+        while pos < n:
+            k = min(n - pos, self.chunk_rows - self._n)
+            for name, buf in self._buf.items():
+                buf[self._n:self._n + k] = columns[name][pos:pos + k]
+            self._n += k
+            pos += k
+            self._dirty = True
+            if self._n == self.chunk_rows:
+                self.flush()
+                self.chunk += 1
+                self._n = 0
+        self.rows += n
+
+    def flush(self) -> None:
+        if not self._dirty:
+            return
+        for name, buf in self._buf.items():
+            _save(self.directory / name / f"{self.chunk:06d}.npy", buf[:self._n])
+        self._dirty = False
+
+
+class _Rollup:
+    """1 つの解像度の min / max / mean / count。区間が閉じたら chunks に書く。"""
+
+    def __init__(self, directory, resolution: float, chunk_rows: int):
+        self.resolution = resolution
+        dtypes = {"t": "<f8", "count": "<u4"}
+        for c in VALUE_COLUMNS:
+            dtypes.update({f"{c}_min": "<f4", f"{c}_max": "<f4", f"{c}_mean": "<f4"})
+        self.chunks = ColumnChunks(directory, dtypes, chunk_rows)
+        self._bucket = None       # 集計中の区間の番号
+        self._count = 0
+        self._min = self._max = self._sum = None
+
+    def add(self, t: np.ndarray, values: np.ndarray) -> None:
+        """t (N,) と values (N, 列数) を区間ごとにまとめる。"""
+        buckets = np.floor(t / self.resolution).astype(np.int64)
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(buckets)) + 1))
+        counts = np.diff(np.append(starts, len(t)))
+        mins = np.minimum.reduceat(values, starts, axis=0)
+        maxs = np.maximum.reduceat(values, starts, axis=0)
+        sums = np.add.reduceat(values, starts, axis=0)
+        ids = buckets[starts]
+
+        if self._bucket is not None and ids[0] == self._bucket:
+            # 前回から続いている区間に足し込む
+            counts[0] += self._count
+            mins[0] = np.minimum(mins[0], self._min)
+            maxs[0] = np.maximum(maxs[0], self._max)
+            sums[0] += self._sum
+        elif self._bucket is not None:
+            self._emit(np.array([self._bucket]), np.array([self._count]), self._min[None],
+                       self._max[None], self._sum[None])
+        # 最後の区間はまだ続くかもしれないので持ち越す
+        if len(ids) > 1:
+            self._emit(ids[:-1], counts[:-1], mins[:-1], maxs[:-1], sums[:-1])
+        self._bucket, self._count = ids[-1], counts[-1]
+        self._min, self._max, self._sum = mins[-1], maxs[-1], sums[-1]
+
+    def _emit(self, ids, counts, mins, maxs, sums) -> None:
+        rows = {"t": ids * self.resolution, "count": counts}
+        means = sums / counts[:, None]
+        for i, c in enumerate(VALUE_COLUMNS):
+            rows[f"{c}_min"] = mins[:, i]
+            rows[f"{c}_max"] = maxs[:, i]
+            rows[f"{c}_mean"] = means[:, i]
+        self.chunks.append(rows)
+
+    def close(self) -> None:
+        if self._bucket is not None:
+            self._emit(np.array([self._bucket]), np.array([self._count]), self._min[None],
+                       self._max[None], self._sum[None])
+            self._bucket = None
+        self.chunks.flush()
+
+
+class TelemetryStore:
+    """SensorBatcher の on_batch に渡す sink。"""
+
+    def __init__(self, directory, chunk_rows: int = 4096, rollups=DEFAULT_ROLLUPS,
+                 flush_interval: float = 5.0):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.flush_interval = flush_interval
+        meta_path = self.directory / "meta.json"
+        if meta_path.exists():
+            meta = json.loads(meta_path.read_text())
+            chunk_rows, rollups = meta["chunk_rows"], meta["rollups"]
+        else:
+            meta = {"columns": COLUMNS, "chunk_rows": chunk_rows, "rollups": list(rollups),
+                    "created": datetime.now().isoformat(timespec="seconds")}
+            meta_path.write_text(json.dumps(meta, indent=2))
+        self.raw = ColumnChunks(self.directory / "raw", COLUMNS, chunk_rows)
+        self.rollups = [_Rollup(self.directory / f"rollup_{r:g}s", r, chunk_rows)
+                        for r in rollups]
+        self._last_flush = time.monotonic()
+
+    def write(self, columns: dict) -> None:
+        flat = flatten(columns)
+        if not len(flat["t"]):
+            return
+        self.raw.append(flat)
+        values = np.column_stack([flat[c] for c in VALUE_COLUMNS]).astype(np.float64)
+        for rollup in self.rollups:
+            rollup.add(flat["t"], values)
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    __call__ = write   # SensorBatcher(store, ...) と書けるように
+
+    def flush(self) -> None:
+        self.raw.flush()
+        for rollup in self.rollups:
+            rollup.chunks.flush()
+        self._last_flush = time.monotonic()
+
+    def close(self) -> None:
+        self.raw.flush()
+        for rollup in self.rollups:
+            rollup.close()
+        log.info("telemetry: %d rows in %s", self.raw.rows, self.directory)
+
+    def stats(self) -> dict:
+        return {"rows": self.raw.rows, "chunks": self.raw.chunk + (1 if self.raw._n else 0),
+                "rollup_rows": {f"{r.resolution:g}s": r.chunks.rows for r in self.rollups}}
+
+
+class TelemetryReader:
+    """TelemetryStore が書いたディレクトリを読む。チャンクは mmap で開く。"""
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.meta = json.loads((self.directory / "meta.json").read_text())
+        self.resolutions = sorted(self.meta["rollups"])
+
+    def _level_dir(self, resolution) -> Path:
+        return self.directory / ("raw" if resolution is None else f"rollup_{resolution:g}s")
+
+    def _chunks(self, level: Path, name: str) -> list:
+        return sorted((level / name).glob("*.npy"))
+
+    def read(self, fields, resolution: float = None, start: float = None,
+             end: float = None) -> dict:
+        """fields (列名のリスト) を start <= t < end の範囲で読む。
+
+        resolution=None なら生データ、指定すればその解像度の集計
+        (fields は "temp_mean" や "count" のように指定する)。
+        """
+        level = self._level_dir(resolution)
+        t_chunks = self._chunks(level, "t")
+        out = {name: [] for name in ["t", *fields]}
+        for path in t_chunks:
+            t = np.load(path, mmap_mode="r")
+            if not len(t) or (start is not None and t[-1] < start) or (end is not None and t[0] >= end):
+                continue
+            mask = np.ones(len(t), dtype=bool)
+            if start is not None:
+                mask &= t >= start
+            if end is not None:
+                mask &= t < end
+            out["t"].append(np.asarray(t[mask]))
+            for name in fields:
+                out[name].append(np.asarray(np.load(level / name / path.name, mmap_mode="r")[mask]))
+        return {name: (np.concatenate(parts) if parts else
+                       np.empty(0, dtype=self._dtype(name)))
+                for name, parts in out.items()}
+
+    def _dtype(self, name: str):
+        if name in COLUMNS:
+            return COLUMNS[name]
+        return "<u4" if name == "count" else "<f4"
+
+    def span(self) -> tuple:
+        """生データの最初と最後の時刻。"""
+        chunks = self._chunks(self._level_dir(None), "t")
+        ts = [np.load(p, mmap_mode="r") for p in chunks]
+        ts = [t for t in ts if len(t)]
+        if not ts:
+            return (None, None)
+        return (float(ts[0][0]), float(ts[-1][-1]))
+
+    def count(self, start: float = None, end: float = None) -> int:
+        """start <= t < end の生データの行数 (t は chunk 内で増えていく前提)。"""
+        n = 0
+        for path in self._chunks(self._level_dir(None), "t"):
+            t = np.load(path, mmap_mode="r")
+            lo = 0 if start is None else int(np.searchsorted(t, start, "left"))
+            hi = len(t) if end is None else int(np.searchsorted(t, end, "left"))
+            n += max(hi - lo, 0)
+        return n
+
+    def query(self, column: str, start: float = None, end: float = None,
+              max_points: int = 2000) -> dict:
+        """グラフ用: 点数が max_points 以下になる一番細かい解像度で column を返す。
+
+        生データなら {"t", column, "resolution": None}、集計なら
+        {"t", "min", "max", "mean", "count", "resolution"}。
+        """
+        if column in COLUMNS and self.count(start, end) <= max_points:
+            raw = self.read([column], None, start, end)
+            return {"t": raw["t"], column: raw[column], "resolution": None}
+        first, last = self.span()
+        lo = first if start is None else max(start, first)
+        hi = last if end is None else min(end, last)
+        resolution = next((r for r in self.resolutions if (hi - lo) / r <= max_points),
+                          self.resolutions[-1])
+        fields = [f"{column}_min", f"{column}_max", f"{column}_mean", "count"]
+        r = self.read(fields, resolution, start, end)
+        return {"t": r["t"], "min": r[fields[0]], "max": r[fields[1]],
+                "mean": r[fields[2]], "count": r["count"], "resolution": resolution}
+
+
+if __name__ == "__main__":
+    # 1 時間分 (200 Hz) を書いて、集計が生データから計算したものと一致すること
+    import tempfile
+
+    from . import sensor, synth
+
+    fs, seconds = 200, 3600
+    packets = synth.sensor_packets(fs * seconds, seed=2)
+    t0 = 1_700_000_000.0
+    with tempfile.TemporaryDirectory() as tmp:
+        store = TelemetryStore(tmp, chunk_rows=65536)
+        started = time.perf_counter()
+        batch = 256
+        for i in range(0, len(packets), batch):
+            cols = sensor.decode_batch(b"".join(packets[i:i + batch]))
+            cols["t"] = t0 + np.arange(i, i + len(cols["prox"])) / fs
+            store.write(cols)
+        store.close()
+        elapsed = time.perf_counter() - started
+        size = sum(f.stat().st_size for f in Path(tmp).rglob("*.npy"))
+
+        reader = TelemetryReader(tmp)
+        raw = reader.read(["temp"])
+        assert len(raw["t"]) == len(packets)
+        r10 = reader.read(["temp_min", "temp_max", "temp_mean", "count"], 10.0)
+        assert len(r10["t"]) == seconds // 10 and r10["count"].sum() == len(packets)
+        ref = raw["temp"].astype(np.float64).reshape(-1, 10 * fs)
+        assert np.allclose(r10["temp_mean"], ref.mean(axis=1), atol=1e-4)
+        assert np.array_equal(r10["temp_min"], ref.min(axis=1).astype(np.float32))
+        q = reader.query("gyro_x", max_points=1000)
+        assert q["resolution"] == 10.0 and len(q["t"]) == 360, (q["resolution"], len(q["t"]))
+        q = reader.query("gyro_x", t0 + 100, t0 + 102)
+        assert q["resolution"] is None and len(q["t"]) == 2 * fs
+    print(f"{len(packets)} rows in {elapsed:.2f} s ({len(packets) / elapsed / 1e3:.0f}k rows/s), "
+          f"{size / 1e6:.1f} MB on disk, {store.stats()['rollup_rows']}: OK")
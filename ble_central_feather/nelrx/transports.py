@@ -0,0 +1,256 @@
+"""受信元 (CLI で差し替える単位)。
+
+どの transport も ``async run(push, stop)`` を持ち、届いたパケット / チャンクを
+push(data) に渡す。stop (asyncio.Event) がセットされるか、受信元が終わったら戻る。
+tap に関数を入れておくと、届いたままのバイト列 (フレームに切る前) も渡す
+(capture.CaptureWriter.tap で記録する用)。framed はそのバイト列が
+serialframe 形式かどうか。
+
+- BleTransport     : 1 台に接続して Notify を受ける (前回のアドレスがあれば直接つなぐ、
+                     切れたらつなぎ直す。MTU / PHY の要求とスループットの実測も行う)
+- SerialTransport  : pyserial で読む (読み取りは専用スレッド、serialio.SerialReader)
+- ReplayTransport  : 保存したバイト列を読み直す (速度指定あり)
+- CaptureTransport : capture ファイルを記録したときの間隔で流し直す (速度指定あり)
+
+BLE の接続を numpy などの import より先に始められるように、このモジュール自体は
+軽くしておき、capture / serialframe / pyserial は使う transport の中で import する。
+"""
+import asyncio
+import logging
+import time
+
+from . import linktune
+from .ble import DEVICE_NAME, UART_TX_CHAR_UUID
+from .supervisor import LinkSupervisor
+
+log = logging.getLogger("nelrx.transports")
+
+
+class BleTransport:
+    """1 台に接続して Notify を受ける。
+
+    前回つないだアドレスに直接つなぎ、だめならスキャンする (connect.connect)。
+    open() を run() の前に呼んでおけば、接続を待つ間に codec / sink を用意できる。
+    reconnect なら切れてもつなぎ直して受信を続け (supervisor.LinkSupervisor)、
+    つなぎ直すたびに on_reconnect() を呼ぶ (codec の resync 用)。
+
+    接続のたびに MTU / PHY を要求し (linktune.negotiate)、最初の接続では
+    probe_s 秒だけスループットを測る。結果は profile (linktune.LinkProfile) に入り、
+    buffer_sizes() で受信側のバッファの大きさに使える。測っている間に届いた
+    パケットは捨てずに、run() の最初にまとめて push する。
+    """
+    name = "ble"
+    framed = False
+    tap = None
+    on_reconnect = None
+
+    def __init__(self, name_filter: str = DEVICE_NAME, address: str = None,
+                 char_uuid: str = UART_TX_CHAR_UUID, scan_timeout: float = 5.0,
+                 client_factory=None, cache=None, connect_timeout: float = 5.0,
+                 service_uuids=(), discovery=None, reconnect: bool = True, backoff=None,
+                 mtu: int = 247, phy: int = 2, probe_s: float = 0.0):
+        self.char_uuid = char_uuid
+        self.supervisor = LinkSupervisor(
+            name_filter, {char_uuid: self._on_notify}, address, cache, discovery, service_uuids,
+            client_factory, backoff, reconnect, scan_timeout, connect_timeout,
+            on_connect=self._on_connect)
+        self.mtu = mtu
+        self.phy = phy
+        self.probe_s = probe_s
+        self.profile = None
+        self.connect_s = None
+        self._push = None
+        self._early = []
+
+    async def open(self) -> None:
+        """最初の接続と probe まで済ませる。見つからない / つながらないときは ConnectionError。"""
+        if self.connect_s is not None:
+            return
+        t0 = time.perf_counter()
+        client = await self.supervisor.open()
+        self.connect_s = time.perf_counter() - t0
+        self.profile = await linktune.tune(client, self.char_uuid, self.mtu, self.phy,
+                                           self.probe_s, forward=self._on_probe)
+
+    def buffer_sizes(self, **options) -> dict:
+        """probe の結果から決めた {"capacity", "slot_size", "initial_target_ms"}。"""
+        return linktune.size_buffers(self.profile, **options)
+
+    def _on_probe(self, _, data) -> None:
+        if self.tap is not None:
+            self.tap(data)
+        self._early.append(bytes(data))
+
+    def _on_notify(self, _, data) -> None:
+        if self.tap is not None:
+            self.tap(data)
+        self._push(data)
+
+    async def _on_connect(self, client) -> None:
+        if self.supervisor.connects == 1:
+            return                     # open() で negotiate 済み
+        self.profile = await linktune.negotiate(client, self.mtu, self.phy, self.profile)
+        if self.on_reconnect is not None:
+            self.on_reconnect()
+
+    async def run(self, push, stop: asyncio.Event) -> None:
+        self._push = push
+        try:
+            await self.open()
+        except (ConnectionError, asyncio.TimeoutError) as e:
+            log.warning("%s", str(e) or "cannot connect to "
+                        f"{self.supervisor.address or self.supervisor.name_filter!r}")
+            return
+        early, self._early = self._early, []
+        for data in early:
+            push(data)
+        await self.supervisor.run(stop)
+        log.info("disconnected %s", self.supervisor.connected_address)
+
+    def stats(self) -> dict:
+        st = self.supervisor.stats()
+        st["connect_s"] = self.connect_s
+        st["link"] = self.profile.stats() if self.profile is not None else None
+        return st
+
+
+class SerialTransport:
+    name = "serial"
+    tap = None
+
+    def __init__(self, port: str, baudrate: int = 115200, framed: bool = False,
+                 align: int = 2, max_chunk: int = 512):
+        self.port = port
+        self.baudrate = baudrate
+        self.framed = framed
+        self.align = align
+        self.max_chunk = max_chunk
+        self.reader = None
+
+    async def run(self, push, stop: asyncio.Event) -> None:
+        import serial
+        from .serialio import SerialReader
+        with serial.Serial(self.port, self.baudrate, timeout=0.1) as ser:
+            self.reader = SerialReader(ser, push, framed=self.framed, align=self.align,
+                                       max_chunk=self.max_chunk, tap=self.tap)
+            with self.reader:
+                while not stop.is_set() and self.reader.alive:
+                    try:
+                        await asyncio.wait_for(stop.wait(), timeout=0.2)
+                    except asyncio.TimeoutError:
+                        pass
+
+    def stats(self) -> dict:
+        return self.reader.stats() if self.reader is not None else {}
+
+
+class ReplayTransport:
+    """保存したバイト列を chunk バイトずつ流し直す。
+
+    bytes_per_second × speed の速さで流す (speed=0 なら待たずに流す)。
+    framed=True ならファイルは serialframe 形式とみなし、フレーム単位で push する。
+    """
+    name = "replay"
+    tap = None
+
+    def __init__(self, path, framed: bool = False, align: int = 2, chunk: int = 512,
+                 bytes_per_second: float = 16000.0, speed: float = 1.0):
+        self.path = str(path)
+        self.framed = framed
+        self.chunk = chunk - chunk % align
+        self.bytes_per_second = bytes_per_second
+        self.speed = speed
+        self.parser = None
+        if framed:
+            from .serialframe import FrameParser
+            self.parser = FrameParser()
+
+    async def run(self, push, stop: asyncio.Event) -> None:
+        interval = self.chunk / self.bytes_per_second / self.speed if self.speed > 0 else 0.0
+        start = time.perf_counter()
+        with open(self.path, "rb") as f:
+            buf = bytearray(self.chunk)
+            view = memoryview(buf)
+            i = 0
+            while not stop.is_set():
+                n = f.readinto(buf)
+                if not n:
+                    break
+                if self.tap is not None:
+                    self.tap(view[:n])
+                if self.parser is not None:
+                    self.parser.feed(view[:n], push)
+                else:
+                    push(view[:n])
+                i += 1
+                if interval:
+                    delay = start + i * interval - time.perf_counter()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                elif i % 64 == 0:
+                    await asyncio.sleep(0)   # 最大速度でも他のタスク (レポートなど) を回す
+
+    def stats(self) -> dict:
+        return self.parser.stats() if self.parser is not None else {}
+
+
+class CaptureTransport:
+    """capture ファイルの 1 チャンネルを、記録したときの間隔 / speed で流し直す。
+
+    speed=0 なら待たずに流す。記録が serialframe 形式のシリアルのチャンクなら
+    (チャンネル定義の framed) フレームに切ってから push する。
+    channel を省略すると最初のチャンネルを使う。
+    """
+    name = "capture"
+    tap = None
+
+    def __init__(self, path, channel=None, speed: float = 1.0):
+        self.path = str(path)
+        self.speed = speed
+        self.records = 0
+        from .capture import CaptureReader
+        with CaptureReader(self.path) as reader:
+            if not reader.channels:
+                raise ValueError(f"{self.path}: no channels")
+            self.channel = reader.channel_id(channel) if channel is not None else min(reader.channels)
+            self.info = reader.channels[self.channel]
+            if channel is None and len(reader.channels) > 1:
+                names = [c["name"] for c in reader.channels.values()]
+                log.info("%s has %d channels %s; replaying %r", self.path, len(names), names,
+                         self.info["name"])
+        self.framed = bool(self.info.get("framed", False))
+        self.parser = None
+        if self.framed:
+            from .serialframe import FrameParser
+            self.parser = FrameParser()
+
+    async def run(self, push, stop: asyncio.Event) -> None:
+        handle = push
+        if self.parser is not None:
+            parser = self.parser
+            handle = lambda data: parser.feed(data, push)
+        from .capture import CaptureReader
+        with CaptureReader(self.path) as reader:
+            start = time.perf_counter()
+            t0 = data = None
+            for t_ns, _, data in reader.records(self.channel):
+                if stop.is_set():
+                    break
+                if t0 is None:
+                    t0 = t_ns
+                if self.speed > 0:
+                    delay = start + (t_ns - t0) / 1e9 / self.speed - time.perf_counter()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                elif self.records % 64 == 0:
+                    await asyncio.sleep(0)
+                if self.tap is not None:
+                    self.tap(data)
+                handle(data)
+                self.records += 1
+            data = None   # mmap を閉じる前に view を手放す
+
+    def stats(self) -> dict:
+        st = self.parser.stats() if self.parser is not None else {}
+        st["records"] = self.records
+        return st
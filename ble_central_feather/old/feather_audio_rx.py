@@ -1,14 +1,18 @@
-import asyncio, audioop, datetime, wave, sys, logging
-from collections import defaultdict
+import asyncio, sys, logging
 from pathlib import Path
 from bleak import BleakClient, BleakScanner
 
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))  # nelrx を import するため
+from nelrx.clips import ClipAssembler, ClipWriterPool
+
 # ---------- 基本設定 ----------
 DEVICE_NAME          = "FeatherTest"
 AUDIO_CHAR_UUID      = "00002a59-0000-1000-8000-00805f9b34fb"
 FRAGS_PER_CLIP       = 17
 FRAG_PAYLOAD_BYTES   = 240
 SAMPLE_RATE          = 16_000
+CLIP_TIMEOUT_S       = 3.0      # これだけ断片が来なければ、そのクリップは打ち切る
+PARTIAL_CLIPS        = True     # 欠けたクリップも (欠けた所を補間して) 保存する
 
 # ---------- ログ設定 ----------
 logging.basicConfig(
@@ -18,56 +22,43 @@ logging.basicConfig(
 )
 log = logging.getLogger("feather_rx")
 
-# -- clipID : {seq:int -> bytes} を格納
-clips = defaultdict(dict)
+# ---------- 保存 (ワーカー側) ----------
+# デコードと WAV の書き込みは Notify のハンドラの外 (ワーカースレッド) で行う。
+# ファームの ima_adpcm_encode は下位ニブルが先 (audioop.adpcm2lin は上位ニブルが先なので使わない)
+def on_saved(clip, path, info) -> None:
+    log.info(f"[CLIP {clip.clip_id:02d}] WAV 保存完了 → {path}  "
+             f"({info['samples']} samples, 最後の断片から {info['latency_ms']:.0f} ms)")
 
 
-# ---------- ユーティリティ ----------
-def save_wav(clip_id: int, adpcm: bytes) -> None:
-    pcm, _state = audioop.adpcm2lin(adpcm, 2, None)
-    ts   = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-    name = f"clip_{clip_id}_{ts}.wav"
-    with wave.open(name, "wb") as wf:
-        wf.setnchannels(1)
-        wf.setsampwidth(2)
-        wf.setframerate(SAMPLE_RATE)
-        wf.writeframes(pcm)
-    log.info(f"[CLIP {clip_id:02d}] WAV 保存完了 → {name}  "
-             f"({len(pcm)//2} samples)")
+writer = ClipWriterPool(".", SAMPLE_RATE, workers=2, max_pending=4, on_saved=on_saved)
 
 
-# ---------- 通知ハンドラ ----------
-def handle_audio(_: int, data: bytearray) -> None:
-    clip_id, seq = data[0], data[1]
-    frag         = bytes(data[2:])
+# ---------- クリップ出力 ----------
+def on_clip(clip) -> None:
+    if clip.complete:
+        log.info(f"[ID {clip.clip_id:02d}] 全フラグメント受信完了  "
+                 f"({len(clip.data)} B) — 保存キューへ")
+    else:
+        log.warning(f"[ID {clip.clip_id:02d}] {clip.count}/{FRAGS_PER_CLIP} で打ち切り "
+                    f"({clip.reason})  Missing→ {clip.missing}  欠けた所は補間して保存")
+    # 書き込みが詰まっていても待たない (あふれた分は捨てて数える)
+    writer.submit(clip)
 
-    log.debug(f"[ID {clip_id:02d}]  Seq {seq:02d}  "
-              f"{len(frag)} B  {frag[:8].hex()}…")
 
-    if len(frag) != FRAG_PAYLOAD_BYTES:
-        log.warning(f"[ID {clip_id:02d}]  Seq {seq:02d} 長さ異常 "
-                    f"({len(frag)} B)")
+# 断片はクリップごとの固定バッファに書き込み、揃ったら (または打ち切ったら) on_clip
+assembler = ClipAssembler(on_clip, FRAGS_PER_CLIP, FRAG_PAYLOAD_BYTES,
+                          timeout=CLIP_TIMEOUT_S, partial=PARTIAL_CLIPS)
 
-    # 受領フラグメント格納
-    clips[clip_id][seq] = frag
 
-    received = len(clips[clip_id])
-    if received < FRAGS_PER_CLIP:
-        missing = [i for i in range(FRAGS_PER_CLIP) if i not in clips[clip_id]]
-        log.info(f"[ID {clip_id:02d}] 受信 {received}/{FRAGS_PER_CLIP}  "
-                 f"Missing→ {missing}")
+# ---------- 通知ハンドラ ----------
+def handle_audio(_: int, data: bytearray) -> None:
+    if len(data) < 2:
         return
-
-    # ----- 全フラグメント揃った -----
-    adpcm = b"".join(clips[clip_id][i] for i in range(FRAGS_PER_CLIP))
-    log.info(f"[ID {clip_id:02d}] 全フラグメント受信完了  "
-             f"({len(adpcm)} B) — デコード開始")
-    try:
-        save_wav(clip_id, adpcm)
-    except Exception as e:
-        log.exception(f"[ID {clip_id:02d}] デコード失敗: {e}")
-    finally:
-        del clips[clip_id]           # 後片付け
+    log.debug(f"[ID {data[0]:02d}]  Seq {data[1]:02d}  {len(data) - 2} B")
+    if len(data) - 2 != FRAG_PAYLOAD_BYTES:
+        log.warning(f"[ID {data[0]:02d}]  Seq {data[1]:02d} 長さ異常 "
+                    f"({len(data) - 2} B)")
+    assembler.add(data)
 
 
 # ---------- メイン ----------
@@ -99,11 +90,18 @@ async def main() -> None:
 
         asyncio.create_task(rssi_monitor())
         while True:
-            await asyncio.sleep(3600)
+            # 断片が来なくなったクリップもタイムアウトで打ち切れるように
+            await asyncio.sleep(1)
+            assembler.expire()
 
 
 if __name__ == "__main__":
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
-        log.info("停止しました")
\ No newline at end of file
+        log.info("停止しました")
+    finally:
+        assembler.flush()
+        writer.close()
+        log.info(f"clips: {assembler.stats()}")
+        log.info(f"writer: {writer.stats()}")
\ No newline at end of file
@@ -1,65 +1,34 @@
 #!/usr/bin/env python3
-import asyncio, struct, math
-from bleak import BleakScanner, BleakClient
+import asyncio
+import sys
+from pathlib import Path
+from bleak import BleakClient
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))  # nelrx を import するため
+from nelrx.discovery import Discovery
+from nelrx.sensor import SensorBatcher, format_row
+from nelrx.telemetry import TelemetryStore
 
 SERVICE_UUID = "0000180c-0000-1000-8000-00805f9b34fb"   # 0x180C
 CHAR_UUID    = "00002a58-0000-1000-8000-00805f9b34fb"   # 0x2A58
 
-def decode(packet: bytes) -> dict:
-    if len(packet) != 17:
-        raise ValueError(f"期待 17 byte, 取得 {len(packet)} byte")
-    
-    
-    prox = packet[0]
+# 17 バイトのパケットは nelrx.sensor でまとめてデコードする
+# (1 パケットずつ dict にして print するより、溜めて列ごとに変換するほうが速い)
+# python feather_ble_rx.py telemetry_dir のように渡すと、値を列ごとに保存する
+# (nelrx.telemetry.TelemetryReader で読む。長時間分は集計済みの解像度で引ける)
+store = TelemetryStore(sys.argv[1]) if len(sys.argv) > 1 else None
 
-    # 1-3: Acceleration (±16 m/s² → 128段階)
-    ax = (packet[1] - 128) / 8.0
-    ay = (packet[2] - 128) / 8.0
-    az = (packet[3] - 128) / 8.0
 
-    # 4-6: Magnetic field (±100 µT → 0.8 µT刻み)
-    mx = (packet[4] - 128) / 1.25
-    my = (packet[5] - 128) / 1.25
-    mz = (packet[6] - 128) / 1.25
-
-    # 7-12: Gyroscope (±2000 dps → uint16 0–65535)
-    def u16(lo, hi):
-        return lo | (hi << 8)
-    gx_raw = u16(packet[7], packet[8])
-    gy_raw = u16(packet[9], packet[10])
-    gz_raw = u16(packet[11], packet[12])
-    # マッピングの逆変換: g = (raw / 65535) * 4000 - 2000
-    gx = (gx_raw * 4000.0 / 65535.0) - 2000.0
-    gy = (gy_raw * 4000.0 / 65535.0) - 2000.0
-    gz = (gz_raw * 4000.0 / 65535.0) - 2000.0
-
-    # 13: Temperature (-40～+85℃ mapped to 0–255)
-    temp = (packet[13] * 125.0 / 255.0) - 40.0
-
-    # 14: Clear light level (0–255)
-    clear = packet[14]
-
-    # 15-16: RGB565
-    rgb565 = packet[15] | (packet[16] << 8)
-    r = ((rgb565 >> 11) & 0x1F) << 3
-    g = ((rgb565 >> 5) & 0x3F) << 2
-    b = (rgb565 & 0x1F) << 3
-
-    return {
-        "prox": prox,
-        "accel (m/s²)": (ax, ay, az),
-        "mag (µT)": (mx, my, mz),
-        "gyro (dps)": (gx, gy, gz),
-        "temp (°C)": temp,
-        "clear": clear,
-        "rgb": (r, g, b),
-    }
+def print_batch(columns: dict):
+    print(f"{len(columns['prox'])} packets  {format_row(columns)}")
+    if store is not None:
+        store.write(columns)
 
 
 async def main():
-    print("🔍 デバイスをスキャン中 ... (5 s)")
-    devices = await BleakScanner.discover(timeout=5.0)
-    target   = next((d for d in devices if d.name == "FeatherTest"), None)
+    # アドバタイズが届いた時点でスキャンを終える (最大 5 s)
+    print("🔍 デバイスをスキャン中 ... (最大 5 s)")
+    # 名前がまだ届いていなくても 0x180C サービスの広告で見つける
+    target = await Discovery().find("FeatherTest", service_uuids=[SERVICE_UUID], timeout=5.0)
     if not target:
         print("❌ FeatherTest が見つかりません。電源とアドバタイズを確認してください。")
         return
@@ -78,14 +47,8 @@ async def main():
             raise RuntimeError(f"{CHAR_UUID} characteristic が見つかりません。UUID を確認してください。")
         
         print("🔌 接続完了。Notify を開始します。")
-        def handle(sender, data: bytearray):
-            try:
-                decoded = decode(data)
-                print(decoded)
-            except Exception as e:
-                print("⚠️ デコードエラー:", e)
-
-        await client.start_notify(CHAR_UUID, handle)
+        batcher = SensorBatcher(print_batch, batch_size=64, flush_interval=0.5)
+        await client.start_notify(CHAR_UUID, batcher.handle_notify)
         print("📡 Notify 開始。Ctrl-C で終了します。")
         while True:                          # 接続維持
             await asyncio.sleep(60)
@@ -94,4 +57,7 @@ if __name__ == "__main__":
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
-        print("\n🛑 終了しました。")
\ No newline at end of file
+        print("\n🛑 終了しました。")
+    finally:
+        if store is not None:
+            store.close()
\ No newline at end of file
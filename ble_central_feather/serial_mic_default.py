@@ -1,9 +1,12 @@
+import time
 import serial
 import numpy as np
 import sounddevice as sd
+from nelrx.pipeline import Pipeline, DROP_OLDEST
+from nelrx.serialio import SerialReader
 
 # ser = serial.Serial('/dev/cu.usbmodem101', 115200)  # ポートを確認して指定
-ser = serial.Serial('/dev/cu.usbmodem11101', 115200)  # ポートを確認して指定
+ser = serial.Serial('/dev/cu.usbmodem11101', 115200, timeout=0.1)  # ポートを確認して指定
 
 fs = 16000  # サンプリングレート (Arduinoと一致)
 buffer_size = 512  # Arduinoと一致させる
@@ -22,11 +25,18 @@ print("Streaming Audio... Press Ctrl+C to stop.")
 
 try:
     with sd.OutputStream(samplerate=fs, channels=1, dtype='int16') as stream:
-        while True:
-            data = ser.read(buffer_size * 2)
-            audio_data = np.frombuffer(data, dtype=np.int16)
-            stream.write(audio_data)
+        # 再生 (ワーカースレッド側)。stream.write が詰まっても読み取りは止まらない
+        def play_chunk(data: memoryview):
+            stream.write(np.frombuffer(data, dtype=np.int16))
+
+        # 読み取りスレッドは int16 の境界に揃えてリングに積むだけ
+        pipeline = Pipeline(play_chunk, capacity=64, slot_size=buffer_size * 2, policy=DROP_OLDEST)
+        with pipeline, SerialReader(ser, pipeline.push, framed=False, align=2, max_chunk=buffer_size * 2):
+            while True:
+                time.sleep(1.0)
+                st = pipeline.stats()
+                print(f"queue={st['depth']} (max {st['max_depth']}), drop={st['dropped_oldest']}")
 except KeyboardInterrupt:
     print("Stopped by user")
 finally:
-    ser.close()
\ No newline at end of file
+    ser.close()
@@ -2,84 +2,221 @@
 Convert ArduinoBLE debug files into Btsnoop files ready to be analyzed using wireshark or hcidump
 Btsnoop file format reference
  https://www.fte.com/WebHelpII/Sodera/Content/Technical_Information/BT_Snoop_File_Format.htm
+
+The conversion is done in a single streaming pass: every line of the debug log is
+filtered, parsed and encoded as soon as it is read, and records are written through
+a large buffered writer. Lines that are not HCI messages are ignored; HCI lines that
+cannot be decoded (truncated or corrupted hex) are skipped and counted.
+
+Timestamps (--timestamps):
+  log      use the serial monitor timestamps ("12:00:00.000 -> HCI ...") found in the log;
+           lines without one get the last seen timestamp, the date comes from --date
+  arrival  use the time each line was read (for live logs, see --follow)
+  none     all-zero timestamps
+  auto     (default) log timestamps when present, otherwise arrival time in follow mode
+           and zero when converting a finished file
+
+With --follow the input is tailed like "tail -f": new lines are converted and appended
+to the btsnoop file as they arrive, and the output is flushed whenever the input is idle,
+so wireshark can reload a live capture without reconverting the whole log.
 '''
 
-import  os
 import argparse
+import datetime
+import os
+import struct
+import sys
+import time
 
 DEBUG = False
 
-parser = argparse.ArgumentParser()
-parser.add_argument('-i', dest='inputPath', type=str, required=True, help='input file containing debug log')
-parser.add_argument('-o', dest='outputPath', type=str, required=True, help='result file that will contain the btsnoop encoded debug file')
-args = parser.parse_args()
-
-# Extract only hci debug messages
-def extractHCIDebugPrint(inputPath, outputPath):
-  inputFile = open(inputPath, 'r')
-  outputFile = open(outputPath, 'w')
-  for inputLine in inputFile:
-    lineItems = inputLine.split()
-    if (len(lineItems) < 7) or (lineItems[1] != "->") or (lineItems[2] != "HCI"):
-      if (len(lineItems) < 4) or (lineItems[0] != "HCI") or ((lineItems[3] != "<-") and (lineItems[3] != "->")):
-        continue
-    outputFile.write(inputLine)  
-  outputFile.close()
+BTSNOOP_HEADER = b"btsnoop\x00" + struct.pack(">II", 1, 1002)  # version 1, HCI UART (H4)
+RECORD_HEADER = struct.Struct(">IIIIq")  # original length, included length, flags, drops, timestamp
+DIRECTIONS = ("->", "<-")
+WRITE_BUFFER_SIZE = 1 << 20
+READ_BUFFER_SIZE = 1 << 20
+BTSNOOP_EPOCH_DELTA_US = 0x00dcddb30f2f8000  # microseconds from 0000-01-01 to 1970-01-01
+TIMESTAMP_MODES = ("auto", "log", "arrival", "none")
+SECONDS_PER_DAY = 86400
+
+# Parse a serial monitor timestamp ("HH:MM:SS.mmm") into seconds since midnight, or None
+def parseMonitorTimestamp(token):
+  if len(token) < 8 or token[2] != ":" or token[5] != ":":
+    return None
+  try:
+    return int(token[0:2]) * 3600 + int(token[3:5]) * 60 + float(token[6:])
+  except ValueError:
+    return None
+
+# Assign btsnoop timestamps (microseconds since 0000-01-01) to records
+class TimestampAssigner:
+  def __init__(self, mode = "none", baseDate = None, follow = False):
+    if mode == "auto":
+      mode = "auto-arrival" if follow else "auto-log"
+    self.mode = mode
+    baseDate = baseDate or datetime.date.today()
+    # Local midnight of the base date; monitor timestamps are local time of day
+    self.midnight = time.mktime(baseDate.timetuple())
+    self.dayOffset = 0
+    self.lastTimeOfDay = None
+    self.lastTimestamp = 0
+
+  def __call__(self, timeOfDay):
+    if self.mode == "none":
+      return 0
+    if timeOfDay is not None and self.mode != "arrival":
+      # The monitor only prints the time of day: a big step backwards means midnight passed
+      if self.lastTimeOfDay is not None and timeOfDay < self.lastTimeOfDay - SECONDS_PER_DAY / 2:
+        self.dayOffset += 1
+      self.lastTimeOfDay = timeOfDay
+      seconds = self.midnight + self.dayOffset * SECONDS_PER_DAY + timeOfDay
+      self.lastTimestamp = int(round(seconds * 1e6)) + BTSNOOP_EPOCH_DELTA_US
+    elif self.mode in ("arrival", "auto-arrival"):
+      self.lastTimestamp = int(time.time() * 1e6) + BTSNOOP_EPOCH_DELTA_US
+    return self.lastTimestamp
+
+# Parse one line of the debug log
+# Returns (hciType, hciDirection, hciMessage, timeOfDay) or None when the line is not an HCI message.
+# timeOfDay is the serial monitor timestamp in seconds since midnight, or None.
+# Raises ValueError when the line looks like an HCI message but cannot be decoded.
+def parseHCIDebugLine(inputLine):
+  lineItems = inputLine.split()
+  # "HCI <type> <TX|RX> <-|-> <hex>", optionally preceded by a serial monitor timestamp ("12:00:00.000 -> ")
+  try:
+    baseIndex = lineItems.index("HCI")
+  except ValueError:
+    return None
+  if (len(lineItems) < baseIndex + 4) or (lineItems[baseIndex + 3] not in DIRECTIONS):
+    return None
+  if len(lineItems) < baseIndex + 5:
+    raise ValueError("missing HCI payload")
+  timeOfDay = None
+  if baseIndex >= 2 and lineItems[baseIndex - 1] == "->":
+    timeOfDay = parseMonitorTimestamp(lineItems[baseIndex - 2])
+  return lineItems[baseIndex + 1], lineItems[baseIndex + 2], bytes.fromhex(lineItems[baseIndex + 4]), timeOfDay
 
 # Return packet in btsnoop format
-def buildBinaryPacket(hciMessage, hciDirection, hciType):
+def buildBinaryPacket(hciMessage, hciDirection, hciType, timestamp = 0):
+  if isinstance(hciMessage, str):
+    hciMessage = bytes.fromhex(hciMessage)
   commandFlag = 1 if (hciType == "COMMAND" or hciType == "EVENT") else 0
-  directionFlag =  0 if (hciDirection == "TX") else 1
-  flagHex = ("0" * 7) + str((commandFlag * 2) + directionFlag)
-  timestampHex = "0" * 16
-  packetDropHex = "0" * 8
-  dataLengthHex = format( (int(len(hciMessage) / 2)), 'x')
-  packetLengthHex = ("0" * (8 - len(dataLengthHex))) + dataLengthHex
-  binaryPacket = bytearray.fromhex(packetLengthHex + packetLengthHex + flagHex + packetDropHex + timestampHex + hciMessage)
+  directionFlag = 0 if (hciDirection == "TX") else 1
+  flags = (commandFlag * 2) + directionFlag
+  binaryPacket = RECORD_HEADER.pack(len(hciMessage), len(hciMessage), flags, 0, timestamp) + hciMessage
   if DEBUG:
-    print(len(hciMessage))
-    print(dataLengthHex)
-    print(packetLengthHex)
-    print(flagHex)
-    print('\n')
+    print(len(hciMessage), flags)
   return binaryPacket
 
 def buildBinaryHeader():
-  defaultHeader = "6274736e6f6f700000000001000003ea"
-  binaryHeader = bytearray.fromhex(defaultHeader)
-  return binaryHeader
-
-def convertToBtsnoop(inputPath, outputPath):
-  # Open output file and write the Btsnoop header
-  outputFile = open(outputPath,'wb')
-  header = buildBinaryHeader()
-  outputFile.write(header)
-
-  # Open input file containing HCI debug packets
-  inputFile = open(inputPath, 'r')
-  for inputLine in inputFile:
-    lineItems = inputLine.split()
-    # For a safer script, do not use indexes but look for symbols in the line
-    baseIndex = lineItems.index("HCI")
-    hciMessage = lineItems[baseIndex + 4]
-    hciDirection = lineItems[baseIndex + 2]
-    hciType = lineItems[baseIndex + 1]
-    # Build and write the encoded line
-    btsnoopPacket = buildBinaryPacket(hciMessage, hciDirection, hciType)
-    outputFile.write(btsnoopPacket)
-    if DEBUG:
-      print(hciDirection)
-      print(hciMessage)
-      print(hciType)
-      print('\n')
-  outputFile.close()
-
-inputPath = args.inputPath
-outputPath = args.outputPath
-tempFile = "temp-debug-print.txt"
-# Run
-extractHCIDebugPrint(inputPath,tempFile)
-convertToBtsnoop(tempFile, outputPath)
-# Delete temp file
-os.remove(tempFile) 
+  return BTSNOOP_HEADER
+
+class ConversionStats:
+  def __init__(self):
+    self.lines = 0
+    self.records = 0
+    self.skipped = 0
+
+  def __str__(self):
+    return "{} lines, {} records, {} malformed HCI lines skipped".format(self.lines, self.records, self.skipped)
+
+# Generator: debug log lines in, encoded btsnoop records out
+def iterBtsnoopRecords(inputLines, stats, strict = False, timestamps = None):
+  timestamps = timestamps or TimestampAssigner("none")
+  for inputLine in inputLines:
+    stats.lines += 1
+    try:
+      hciLine = parseHCIDebugLine(inputLine)
+    except ValueError as e:
+      if strict:
+        raise ValueError("line {}: {}".format(stats.lines, e))
+      stats.skipped += 1
+      if DEBUG or stats.skipped <= 10:
+        print("skipping line {}: {} ({!r})".format(stats.lines, e, inputLine[:80]), file=sys.stderr)
+      continue
+    if hciLine is None:
+      continue
+    hciType, hciDirection, hciMessage, timeOfDay = hciLine
+    stats.records += 1
+    yield buildBinaryPacket(hciMessage, hciDirection, hciType, timestamps(timeOfDay))
+
+# Generator: yield complete lines of a growing file, like "tail -f"
+# onIdle() is called every time the end of the file is reached (used to flush the output).
+# Stops after idleTimeout seconds without new data (None: never).
+def followLines(inputFile, onIdle, pollInterval = 0.2, idleTimeout = None):
+  pending = ""
+  idleSince = None
+  while True:
+    line = inputFile.readline()
+    if line:
+      idleSince = None
+      if not line.endswith("\n"):
+        pending += line  # the writer has not finished this line yet
+        continue
+      yield pending + line
+      pending = ""
+      continue
+    onIdle()
+    now = time.monotonic()
+    idleSince = idleSince or now
+    if idleTimeout is not None and now - idleSince >= idleTimeout:
+      if pending:
+        yield pending
+      return
+    if inputFile is not sys.stdin and os.fstat(inputFile.fileno()).st_size < inputFile.tell():
+      inputFile.seek(0)  # the log was truncated or rotated: start over
+      pending = ""
+    time.sleep(pollInterval)
+
+def openInput(inputPath):
+  if inputPath == "-":
+    return sys.stdin
+  return open(inputPath, 'r', buffering=READ_BUFFER_SIZE, errors='replace')
+
+def openOutput(outputPath):
+  if outputPath == "-":
+    return sys.stdout.buffer
+  return open(outputPath, 'wb', buffering=WRITE_BUFFER_SIZE)
+
+def convertToBtsnoop(inputPath, outputPath, strict = False, timestamps = None,
+                     follow = False, pollInterval = 0.2, idleTimeout = None):
+  stats = ConversionStats()
+  inputFile = openInput(inputPath)
+  outputFile = openOutput(outputPath)
+  try:
+    outputFile.write(buildBinaryHeader())
+    inputLines = inputFile
+    if follow:
+      inputLines = followLines(inputFile, outputFile.flush, pollInterval, idleTimeout)
+    outputFile.writelines(iterBtsnoopRecords(inputLines, stats, strict, timestamps))
+  except KeyboardInterrupt:
+    pass
+  finally:
+    if inputFile is not sys.stdin:
+      inputFile.close()
+    if outputFile is sys.stdout.buffer:
+      outputFile.flush()
+    else:
+      outputFile.close()
+  return stats
+
+def main(argv = None):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('-i', dest='inputPath', type=str, required=True, help='input file containing debug log ("-" for stdin)')
+  parser.add_argument('-o', dest='outputPath', type=str, required=True, help='result file that will contain the btsnoop encoded debug file ("-" for stdout)')
+  parser.add_argument('--strict', action='store_true', help='stop at the first malformed HCI line instead of skipping it')
+  parser.add_argument('--timestamps', choices=TIMESTAMP_MODES, default='auto', help='where record timestamps come from (default: auto)')
+  parser.add_argument('--date', type=datetime.date.fromisoformat, default=None, help='date of the first log timestamp, YYYY-MM-DD (default: today)')
+  parser.add_argument('-f', '--follow', action='store_true', help='keep reading the input as it grows and append records to the output')
+  parser.add_argument('--poll', type=float, default=0.2, help='follow mode: seconds between checks for new data')
+  parser.add_argument('--idle-timeout', type=float, default=None, help='follow mode: stop after this many seconds without new data')
+  args = parser.parse_args(argv)
+  timestamps = TimestampAssigner(args.timestamps, args.date, args.follow)
+  try:
+    stats = convertToBtsnoop(args.inputPath, args.outputPath, args.strict, timestamps,
+                             args.follow, args.poll, args.idle_timeout)
+  except ValueError as e:
+    sys.exit("error: {}".format(e))
+  print(stats, file=sys.stderr)
 
+if __name__ == "__main__":
+  main()
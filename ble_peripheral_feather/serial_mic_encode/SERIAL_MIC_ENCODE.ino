@@ -5,7 +5,6 @@
 
 volatile int samplesRead;
 int16_t sampleBuffer[SAMPLE_BUFFER_SIZE];
-uint8_t adpcmBuffer[ADPCM_BUFFER_SIZE];
 
 // IMA-ADPCM エンコーダ用状態
 static int predictor = 0;
@@ -64,6 +63,49 @@ void ima_adpcm_encode(const int16_t* inPcm, uint32_t samples, uint8_t* outAdpcm)
   }
 }
 
+// ---------- シリアル送信フレーム ----------
+// [0xA5 0x5A][len u16][seq u8][predictor i16][stepIndex u8][ADPCM ...][CRC16 u16]（すべてリトルエンディアン）
+// len は seq から ADPCM 末尾までのバイト数。CRC16-CCITT（0x1021, 初期値 0xFFFF）は len から ADPCM 末尾まで
+#define FRAME_HEADER_SIZE 8
+uint8_t frameBuffer[FRAME_HEADER_SIZE + ADPCM_BUFFER_SIZE + 2];
+uint8_t frameSeq = 0;
+
+uint16_t crc16_ccitt(const uint8_t* data, int len) {
+  uint16_t crc = 0xFFFF;
+  for (int i = 0; i < len; i++) {
+    crc ^= (uint16_t)data[i] << 8;
+    for (int b = 0; b < 8; b++) {
+      crc = (crc & 0x8000) ? (crc << 1) ^ 0x1021 : (crc << 1);
+    }
+  }
+  return crc;
+}
+
+void send_frame(const int16_t* pcm, int nSamples) {
+  /* エンコード前の状態をヘッダに載せる（受信側はフレームごとに状態を合わせ直せる） */
+  uint16_t pred0 = predictor;
+  uint8_t  idx0  = stepIndex;
+
+  int adpcmBytes = nSamples / 2;
+  ima_adpcm_encode(pcm, nSamples, frameBuffer + FRAME_HEADER_SIZE);
+
+  int len = 4 + adpcmBytes;
+  frameBuffer[0] = 0xA5;
+  frameBuffer[1] = 0x5A;
+  frameBuffer[2] = len & 0xFF;
+  frameBuffer[3] = len >> 8;
+  frameBuffer[4] = frameSeq++;
+  frameBuffer[5] = pred0 & 0xFF;
+  frameBuffer[6] = pred0 >> 8;
+  frameBuffer[7] = idx0;
+
+  uint16_t crc = crc16_ccitt(frameBuffer + 2, 2 + len);
+  frameBuffer[FRAME_HEADER_SIZE + adpcmBytes]     = crc & 0xFF;
+  frameBuffer[FRAME_HEADER_SIZE + adpcmBytes + 1] = crc >> 8;
+
+  Serial.write(frameBuffer, FRAME_HEADER_SIZE + adpcmBytes + 2);
+}
+
 void onPDMdata() {
   int bytesAvailable = PDM.available();
   PDM.read(sampleBuffer, bytesAvailable);
@@ -83,8 +125,7 @@ void setup() {
 
 void loop() {
   if (samplesRead) {
-    ima_adpcm_encode(sampleBuffer, samplesRead, adpcmBuffer);
-    Serial.write(adpcmBuffer, samplesRead / 2);
+    send_frame(sampleBuffer, samplesRead);
     samplesRead = 0;
   }
 }
\ No newline at end of file